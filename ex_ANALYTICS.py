@@ -0,0 +1,202 @@
+import collections
+import threading
+
+import ex_SQL as db
+
+from ex_BUILTINS import (
+    HOME_CURRENCY,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class Columns:
+    """
+    Holds the expenses of an owner as column arrays.
+    > Datetimes are stored to the second.
+    > Amounts are the integer cents of the home currency stored when the expenses were written, so reports agree with summaries and budgets.
+    > Shops, payments and purposes are stored as codes into sorted arrays of labels.
+    archived is the first year whose archived expenses were loaded too, or None.
+    """
+    def __init__(self, rows, archived=None):
+        self.size = len(rows)
+        self.archived = archived
+        updateid, dt, amount, shop, payment, purpose = zip(*rows) if rows else ((),) * 6
+        self.updateid = np.fromiter(updateid, np.int64, self.size)
+        self.dt = np.fromiter(dt, np.int64, self.size).astype('datetime64[s]')
+        self.amount = np.fromiter(amount, np.int64, self.size)
+        self.shop = categories(shop)
+        self.payment = categories(payment)
+        self.purpose = categories(purpose)
+
+    def amend(self, row) -> bool:
+        """
+        Overwrites the columns of a changed database row in place.
+        Returns False if the row is missing or introduces a label without a code.
+        > Rows in a foreign currency are never applied, since only the database holds their home amount.
+        """
+        index = np.flatnonzero(self.updateid == row[1])
+        if not index.size or not isinstance(row[4], int) or row[10] not in ('', HOME_CURRENCY):
+            return False
+        try:
+            dt = np.datetime64(row[2], 's')
+        except ValueError:
+            return False
+        codes = []
+        for (labels, _), value in ((self.shop, row[5]), (self.payment, row[8]), (self.purpose, row[7])):
+            code = np.searchsorted(labels, value or '')
+            if code == len(labels) or labels[code] != (value or ''):
+                return False
+            codes.append(code)
+
+        self.dt[index] = dt
+        self.amount[index] = row[4]
+        for (_, column), code in zip((self.shop, self.payment, self.purpose), codes):
+            column[index] = code
+        return True
+
+class Cache:
+    """
+    Keeps the columns of recently reported owners in memory.
+    > Columns are reloaded once expenses of the owner have been written since they were loaded.
+    > Columns are reloaded with the archived expenses once a report reaches back into an archived year they lack.
+    > The least recently used owners are evicted beyond capacity.
+    Archiving marks the owners it moves as written, so columns never miss expenses moved out of the live database.
+    """
+    def __init__(self, database, capacity=64):
+        self.database = database
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def columns(self, owner, since=None) -> Columns:
+        """
+        Returns the columns of an owner, loading them if they are missing or stale.
+        > since is the earliest month needed, as YYYY-MM, and the archived expenses since its year are loaded if it is archived.
+        """
+        version = self.database.version(owner)
+        year = since[:4] if since is not None and archived(self.database, owner, since) else None
+        with self.lock:
+            entry = self.entries.get(owner)
+            loaded = entry is not None and entry[0] == version
+            if loaded and (year is None or (entry[1].archived is not None and entry[1].archived <= year)):
+                self.entries.move_to_end(owner)
+                return entry[1]
+
+        columns = load(self.database, owner, year)
+        with self.lock:
+            self.entries[owner] = (version, columns)
+            self.entries.move_to_end(owner)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return columns
+
+    def amend(self, owner, rows) -> None:
+        """
+        Applies changed database rows of an owner to the cached columns in place.
+        > The columns are marked current only if no other write to the owner was missed.
+        > Otherwise, or if a row cannot be applied, the columns are reloaded on next use.
+        """
+        version = self.database.version(owner)
+        with self.lock:
+            entry = self.entries.get(owner)
+            if entry is None or entry[0] != version - 1:
+                return
+            if all(entry[1].amend(row) for row in rows):
+                self.entries[owner] = (version, entry[1])
+
+def categories(values) -> tuple:
+    """
+    Encodes a column of labels as the sorted distinct labels and the code of every value.
+    """
+    labels, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+    return labels, codes.reshape(-1)
+
+def archived(database, owner, since) -> bool:
+    """
+    Returns whether expenses of an owner since a month may have been archived.
+    > Archives hold whole years, so the year of the month is compared with the year of every archive.
+    """
+    return any(year >= since[:4] for year, _ in database.shard(owner).archives())
+
+def load(database, owner, since=None) -> Columns:
+    """
+    Loads the expenses of an owner in a single query.
+    > The expenses archived since the start of a year are loaded too through the history view if one is given.
+    """
+    shard = database.shard(owner)
+    rows = shard.fetch(LOAD.format('expenses' if since is None else 'history'), (owner,), since is not None, since)
+    return Columns(rows, since)
+
+def since(now, months) -> str:
+    """
+    Returns the month before the first month of a report, as YYYY-MM, since its change is computed from it.
+    """
+    index = now.year * 12 + now.month - 1 - months
+    return '{:04d}-{:02d}'.format(index // 12, index % 12 + 1)
+
+def breakdown(category, mask, amount, top) -> list:
+    """
+    Returns the (label, total) pairs of the categories with the largest totals.
+    """
+    labels, codes = category
+    totals = np.bincount(codes[mask], weights=amount, minlength=len(labels))
+    order = np.argsort(-totals, kind='stable')[:top]
+    return [(str(labels[index]), int(round(totals[index]))) for index in order if totals[index]]
+
+def report(columns, now, months=6, window=7, top=5) -> dict:
+    """
+    Computes the spending report of the months up to and including the month of now.
+    > Totals of every month and their change from the previous month.
+    > Daily totals and their moving average over window days.
+    > Largest totals by purpose, shop and payment method.
+    > Percentiles of the transaction amounts.
+    """
+    now = np.datetime64(now, 's')
+    month = now.astype('datetime64[M]')
+    first = month - (months - 1)
+    day = first.astype('datetime64[D]')
+    span = int((now.astype('datetime64[D]') - day).astype(np.int64)) + 1
+
+    mask = (columns.dt >= first.astype('datetime64[s]')) & (columns.dt <= now)
+    before = (columns.dt >= (first - 1).astype('datetime64[s]')) & (columns.dt <= now)
+    amount = columns.amount[mask]
+
+    offsets = (columns.dt[before].astype('datetime64[M]') - (first - 1)).astype(np.int64)
+    monthly = np.bincount(offsets, weights=columns.amount[before], minlength=months + 1).round().astype(np.int64)
+
+    offsets = (columns.dt[mask].astype('datetime64[D]') - day).astype(np.int64)
+    daily = np.bincount(offsets, weights=amount, minlength=span)
+    running = np.concatenate(([0.0], np.cumsum(daily)))
+    moving = (running[window:] - running[:-window]) / window if span >= window else np.zeros(0)
+
+    return {
+        'months': [str(label) for label in np.arange(first, month + 1)],
+        'totals': monthly[1:].tolist(),
+        'deltas': np.diff(monthly).tolist(),
+        'daily': daily.round().astype(np.int64),
+        'moving': moving,
+        'purpose': breakdown(columns.purpose, mask, amount, top),
+        'shop': breakdown(columns.shop, mask, amount, top),
+        'payment': breakdown(columns.payment, mask, amount, top),
+        'percentiles': [
+            (percentile, int(round(value)))
+            for percentile, value in zip(PERCENTILES, np.percentile(amount, PERCENTILES) if amount.size else [0] * len(PERCENTILES))
+        ],
+        'count': int(amount.size),
+        'total': int(amount.sum()),
+    }
+
+#############
+# VARIABLES #
+#############
+
+LOAD = (
+    'SELECT updateid, CAST(strftime(\'%s\', dt) AS INTEGER), coalesce(' + db.HOME + ', 0), '
+    'coalesce(shop, \'\'), coalesce(payment, \'\'), coalesce(purpose, \'\') '
+    'FROM {0} WHERE owner = ? AND strftime(\'%s\', dt) IS NOT NULL'
+)
+
+PERCENTILES = [50, 90, 99]
@@ -0,0 +1,160 @@
+import argparse
+import collections
+import json
+import logging
+import sqlite3
+
+from datetime import (
+    datetime,
+    timedelta,
+)
+
+import ex_SQL as db
+
+logger = logging.getLogger(__name__)
+
+def cutoff(now, age) -> str:
+    """
+    Returns the start of the year containing the date age days before now.
+    > Expenses are archived in whole years, so that every current period and at least age days stay live.
+    """
+    return year_start((now - timedelta(days=age)).year)
+
+def year_start(year) -> str:
+    """
+    Returns the start of a year in the format of the dt column.
+    > Bounds are full datetimes, as a bare year would be compared as a number with the dt column.
+    """
+    return '{:04d}-01-01 00:00:00'.format(int(year))
+
+def plan(database, before) -> list:
+    """
+    Returns the (year, count) of the expenses of a single database which are older than before and can be archived.
+    > Split expenses stay live, since the balances of group ledgers are recomputed from them.
+    """
+    return database.fetch(
+        'SELECT substr(dt, 1, 4), COUNT(*) FROM expenses WHERE dt >= ? AND dt < ? AND {} GROUP BY 1 ORDER BY 1'.format(
+            ARCHIVABLE
+        ),
+        (year_start(1), before)
+    )
+
+def archive(database, now, age, dry_run=False, batch_size=None) -> dict:
+    """
+    Moves the expenses older than age days into yearly archive databases next to every shard.
+    > Expenses are moved in batches, each in a single transaction on the live database with the archive attached.
+    > Summaries, the search index and the indexes of the live database shrink with it through the triggers.
+    > Every archive written to is analysed and vacuumed once its year has been moved.
+    > The full-text index of the live database is then merged, dropping the archived expenses, and its write-ahead log is checkpointed.
+    > Years beyond the archives SQLite can attach to a connection at once are kept live, as the whole history attaches every archive.
+    An archive interrupted by a crash is completed by running it again.
+    Returns the number of expenses archived by year, or the number which would be archived on a dry run.
+    """
+    counts = collections.Counter()
+    before = cutoff(now, age)
+    for shard in database.shards:
+        existing = {year for year, _ in db.archives(shard.dbname)}
+        # One attachment is kept free for the archive expenses are moved into
+        maximum = db.attach_limit(shard.connection()) - 1
+        moved = 0
+        for year, planned in plan(shard, before):
+            if year not in existing and len(existing) >= maximum:
+                logger.warning('Keeping the expenses of %s live in %s, it already has %d archives', year, shard.dbname, len(existing))
+                continue
+            if dry_run:
+                counts[year] += planned
+                continue
+            path = db.archive_path(shard.dbname, year)
+            db.setup_archive(path)
+            existing.add(year)
+            count = move(shard, path, year, batch_size or BATCH_SIZE)
+            counts[year] += count
+            moved += count
+            compact(path)
+        if moved:
+            shard.execute('INSERT INTO search (search) VALUES (\'optimize\')')
+            shard.fetch('PRAGMA wal_checkpoint(TRUNCATE)')
+    return dict(counts)
+
+def move(database, path, year, batch_size) -> int:
+    """
+    Moves the archivable expenses of a year from a single database to its archive.
+    Returns the number of expenses moved.
+    """
+    bounds = (year_start(year), year_start(int(year) + 1))
+    conn = database.connection()
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    moved = 0
+    try:
+        while True:
+            batch = conn.execute(
+                'SELECT updateid, owner FROM expenses WHERE dt >= ? AND dt < ? AND {} LIMIT ?'.format(ARCHIVABLE),
+                bounds + (batch_size,)
+            ).fetchall()
+            if not batch:
+                break
+            updateids = json.dumps([updateid for updateid, _ in batch])
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO archive.expenses ({0}) SELECT {0} FROM main.expenses '
+                    'WHERE updateid IN (SELECT value FROM json_each(?)) AND {1}'.format(', '.join(db.STORED), ARCHIVABLE),
+                    (updateids,)
+                )
+                moved += conn.execute(
+                    'DELETE FROM main.expenses WHERE updateid IN (SELECT value FROM json_each(?)) AND {}'.format(ARCHIVABLE),
+                    (updateids,)
+                ).rowcount
+            database.changed(owner for _, owner in batch)
+    finally:
+        conn.execute('DETACH DATABASE archive')
+    return moved
+
+def compact(path) -> None:
+    """
+    Analyses and vacuums an archive, so that it is stored in as few pages as possible.
+    Skips the archive if it is being read.
+    """
+    conn = sqlite3.connect(path, timeout=1)
+    try:
+        conn.execute('ANALYZE')
+        conn.execute('VACUUM')
+    except sqlite3.OperationalError as error:
+        logger.warning('Could not compact %s: %s', path, error)
+    finally:
+        conn.close()
+
+########
+# MAIN #
+########
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Moves old expenses into yearly archive databases.')
+    parser.add_argument('--db', default='expenses.db')
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--age', type=int, default=AGE)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    database = db.Router(args.db, args.shards)
+    db.setup(database)
+    try:
+        counts = archive(database, datetime.now(), args.age, args.dry_run)
+    finally:
+        database.close()
+
+    for year, count in sorted(counts.items()):
+        print('{} {} expenses of {}.'.format('Would archive' if args.dry_run else 'Archived', count, year))
+    if not counts:
+        print('Nothing to archive.')
+
+#############
+# VARIABLES #
+#############
+
+AGE = 730
+BATCH_SIZE = 5000
+
+ARCHIVABLE = 'coalesce(shares, \'\') = \'\''
+
+if __name__ == '__main__':
+    main()
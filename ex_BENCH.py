@@ -0,0 +1,863 @@
+import argparse
+import bisect
+import copy
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from datetime import (
+    datetime,
+    timedelta,
+)
+
+import ex_ANALYTICS as analytics
+import ex_ARCHIVE as archiver
+import ex_BOT as bot
+import ex_BUDGET as budget
+import ex_CURRENCY as exchange
+import ex_DIGEST as digest
+import ex_IMPORT as importer
+import ex_LEDGER as ledger
+import ex_METRICS as metrics
+import ex_OCR as ocr
+import ex_QUERY as query
+import ex_REPLAY as replay
+import ex_SQL as db
+import ex_STATE as state
+import ex_WEBHOOK as webhook
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+##############
+# GENERATORS #
+##############
+
+def synthetic_rows(count, start=1, owners=100) -> list:
+    """
+    Generates database rows with varied owners, dates and amounts.
+    """
+    return [
+        (
+            (i % owners) + 1,
+            i,
+            '20{:02d}-{:02d}-{:02d} {:02d}:{:02d}:00'.format(20 + i % 6, 1 + i % 12, 1 + i % 28, i % 24, i % 60),
+            'Item {}'.format(i % 997),
+            100 + (i * 37) % 10000,
+            'Shop {}'.format(i % 113),
+            'Location {}'.format(i % 17),
+            'Purpose {}'.format(i % 7),
+            ['Credit', 'Debit', 'PayPal', 'PayLah'][i % 4],
+            i % 3 == 0,
+            '',
+            '',
+            '',
+        )
+        for i in range(start, start + count)
+    ]
+
+def percentile(samples, fraction) -> float:
+    """
+    Returns the sample at the fraction of the sorted samples.
+    """
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def recorded_updates(count, chats=1000) -> list:
+    """
+    Replays the recorded updates with distinct update ids spread over many chats.
+    """
+    with open(os.path.join(FIXTURES, 'updates.json'), encoding='utf-8') as file:
+        recorded = json.load(file)
+
+    updates = []
+    for i in range(count):
+        update = copy.deepcopy(recorded[i % len(recorded)])
+        update['update_id'] = i
+        chat = (i // len(recorded)) % chats + 1
+        update['message']['chat']['id'] = update['message']['from']['id'] = chat
+        updates.append(json.dumps(update).encode())
+    return updates
+
+def temporary_database(directory) -> db.Database:
+    """
+    Creates and sets up a fresh database in the directory.
+    """
+    database = db.Database(os.path.join(directory, 'bench.db'))
+    db.setup(database)
+    return database
+
+##############
+# BENCHMARKS #
+##############
+
+def bench_add(count) -> dict:
+    """
+    Compares rows per second of per-row commits against the write-behind writer.
+    """
+    rows = synthetic_rows(count)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = temporary_database(directory)
+        start = time.perf_counter()
+        for row in rows:
+            database.execute(db.INSERT, row)
+        results['per-row commit'] = count / (time.perf_counter() - start)
+        database.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = temporary_database(directory)
+        writer = db.Writer(database, os.path.join(directory, 'bench.journal'))
+        writer.start()
+        start = time.perf_counter()
+        for row in rows:
+            writer.put(row)
+        writer.stop()
+        results['write-behind'] = count / (time.perf_counter() - start)
+        database.close()
+
+    return results
+
+def bench_plans(count) -> dict:
+    """
+    Checks that every supported filter shape is answered without a full table scan.
+    Prints the plan of every offending shape.
+    """
+    results = {'shapes': 0, 'full scans': 0}
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = temporary_database(directory)
+        database.executemany(db.INSERT, synthetic_rows(count))
+        database.execute('ANALYZE')
+        for filter in query.shapes():
+            plan = query.explain(database, filter)
+            results['shapes'] += 1
+            if any(detail.startswith('SCAN expenses') for detail in plan):
+                results['full scans'] += 1
+                print(query.compile(filter.shape()), plan)
+        database.close()
+
+    return results
+
+def bench_report(count, repeats=5) -> dict:
+    """
+    Compares the analytics engine against the equivalent SQL GROUP BY queries for a single owner.
+    > Rows are added tenfold from 10000 up to count.
+    > Loading the columns is measured separately from computing a report on cached columns.
+    """
+    now = datetime(2026, 1, 1)
+    months = 73
+    start = now.replace(year=now.year - 6).strftime('%Y-%m-%d')
+    statements = [
+        'SELECT substr(dt, 1, 7), SUM(amount) FROM expenses WHERE owner = ? AND dt >= ? GROUP BY 1',
+        'SELECT substr(dt, 1, 10), SUM(amount) FROM expenses WHERE owner = ? AND dt >= ? GROUP BY 1',
+    ] + [
+        'SELECT {0}, SUM(amount) AS total FROM expenses WHERE owner = ? AND dt >= ? '
+        'GROUP BY {0} ORDER BY total DESC LIMIT 5'.format(column) for column in ('purpose', 'shop', 'payment')
+    ]
+    percentile = 'SELECT amount FROM expenses WHERE owner = ? AND dt >= ? ORDER BY amount LIMIT 1 OFFSET ?'
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = temporary_database(directory)
+        cache = analytics.Cache(database)
+        size = 0
+        target = 10000
+        while target <= max(count, 10000):
+            database.executemany(db.INSERT, synthetic_rows(target - size, size + 1, owners=1))
+            database.changed([1])
+            size = target
+
+            elapsed = time.perf_counter()
+            columns = cache.columns(1)
+            results['load ms @ {}'.format(size)] = (time.perf_counter() - elapsed) * 1000
+
+            elapsed = time.perf_counter()
+            for _ in range(repeats):
+                report = analytics.report(columns, now, months)
+            results['report ms @ {}'.format(size)] = (time.perf_counter() - elapsed) * 1000 / repeats
+
+            elapsed = time.perf_counter()
+            for _ in range(repeats):
+                grouped = [database.fetch(statement, (1, start)) for statement in statements]
+                matched = database.fetch('SELECT COUNT(*) FROM expenses WHERE owner = ? AND dt >= ?', (1, start))[0][0]
+                for fraction in analytics.PERCENTILES:
+                    database.fetch(percentile, (1, start, (matched - 1) * fraction // 100))
+            results['sql ms @ {}'.format(size)] = (time.perf_counter() - elapsed) * 1000 / repeats
+
+            monthly = {month: total for month, total in zip(report['months'], report['totals']) if total}
+            results['mismatches @ {}'.format(size)] = len(set(monthly.items()) ^ set(grouped[0]))
+            target *= 10
+        database.close()
+
+    return results
+
+def bench_search(count, owners=100, repeats=20) -> dict:
+    """
+    Compares full-text lookups of a single owner against LIKE scans over count rows.
+    > Descriptions are drawn from a vocabulary of 1728 words, so that a word matches about 0.1% of the rows.
+    > Lookups return every match, ranked for full-text and unordered for LIKE.
+    > Both lookups must return the same expenses.
+    """
+    words = [a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES]
+    rows = [
+        row[:3] + ('{} {}'.format(words[row[1] * 7919 % len(words)], words[row[1] * 104729 % len(words)]),) + row[4:]
+        for row in synthetic_rows(count, owners=owners)
+    ]
+    terms = ['bakori', 'bako', 'bakori tume', 'shop 42', 'purpose 3']
+    like = 'SELECT * FROM expenses WHERE owner = ? AND {}'
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = temporary_database(directory)
+        start = time.perf_counter()
+        database.executemany(db.INSERT, rows)
+        results['insert s'] = time.perf_counter() - start
+        start = time.perf_counter()
+        db.rebuild_search(database)
+        results['rebuild s'] = time.perf_counter() - start
+
+        mismatches = 0
+        for text in terms:
+            words = text.split()
+            predicate = ' AND '.join(
+                '(' + ' OR '.join('{0} LIKE ? OR {0} LIKE ?'.format(column) for column in query.SEARCH_COLUMNS) + ')'
+                for _ in words
+            )
+            values = [1] + [pattern for word in words for pattern in ['{}%'.format(word), '% {}%'.format(word)] * 4]
+
+            elapsed = time.perf_counter()
+            for _ in range(repeats):
+                found = query.find(database, 1, text, count)
+            results['fts ms: {}'.format(text)] = (time.perf_counter() - elapsed) * 1000 / repeats
+
+            elapsed = time.perf_counter()
+            for _ in range(repeats):
+                scanned = database.fetch(like.format(predicate), values)
+            results['like ms: {}'.format(text)] = (time.perf_counter() - elapsed) * 1000 / repeats
+
+            mismatches += len({row[1] for row in found} ^ {row[1] for row in scanned})
+        results['mismatches'] = mismatches
+        database.close()
+
+    return results
+
+def bench_currency(count, repeats=3) -> dict:
+    """
+    Measures converting count expenses of a single owner in mixed currencies to the home currency.
+    > A third of the expenses are in foreign currencies, with a rate for every day of six years.
+    > Converting as arrays converts every distinct (currency, day) pair once.
+    > It is compared against converting row by row with the memoized rates, against SQL, and against the home amounts read by the analytics columns.
+    The totals of the four must match.
+    """
+    foreign = ['USD', 'JPY', 'MYR']
+    rows = [row[:10] + (foreign[row[1] % 9 // 3] if row[1] % 3 == 0 else '',) + row[11:] for row in synthetic_rows(count, owners=1)]
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'rates.csv')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write('date,currency,rate\n')
+            day = datetime(2020, 1, 1)
+            for offset in range(6 * 366):
+                date = (day + timedelta(days=offset)).strftime('%Y-%m-%d')
+                for currency, rate in zip(foreign, (1.35, 0.0091, 0.29)):
+                    file.write('{},{},{:.6f}\n'.format(date, currency, rate * (1 + offset % 30 / 1000)))
+
+        rates = exchange.Rates()
+        start = time.perf_counter()
+        results['rates loaded'] = rates.load(path)
+        results['load rates ms'] = (time.perf_counter() - start) * 1000
+
+        database = db.Database(os.path.join(directory, 'bench.db'), rates=rates)
+        db.setup(database)
+        database.executemany(db.INSERT, rows)
+
+        start = time.perf_counter()
+        columns = analytics.load(database, 1)
+        results['load columns ms'] = (time.perf_counter() - start) * 1000
+
+        amounts = np.array([row[4] for row in rows], dtype=np.int64)
+        currencies = analytics.categories([row[10] for row in rows])
+        days = np.array([row[2][:10] for row in rows], dtype='datetime64[D]')
+        elapsed = time.perf_counter()
+        for _ in range(repeats):
+            rates.factors.clear()
+            vectorized = rates.convert_many(amounts, currencies, days)
+        results['vectorized ms'] = (time.perf_counter() - elapsed) * 1000 / repeats
+
+        elapsed = time.perf_counter()
+        for _ in range(repeats):
+            rates.factors.clear()
+            converted = [rates.convert(row[4], row[10], row[2]) for row in rows]
+        results['per-row ms'] = (time.perf_counter() - elapsed) * 1000 / repeats
+
+        elapsed = time.perf_counter()
+        for _ in range(repeats):
+            total = database.fetch('SELECT SUM(convert(amount, currency, dt)) FROM expenses WHERE owner = ?', (1,))[0][0]
+        results['sql ms'] = (time.perf_counter() - elapsed) * 1000 / repeats
+
+        results['distinct pairs'] = len(rates.factors)
+        results['mismatches'] = len({int(columns.amount.sum()), int(vectorized.sum()), sum(converted), total}) - 1
+        database.close()
+
+    return results
+
+def bench_archive(count, growth=(1, 4, 16), recent=500) -> dict:
+    """
+    Measures insert and query latency as the history grows, with and without archiving.
+    > A history of count times growth expenses over six past years is inserted, then recent expenses of the current month.
+    > Recent expenses are inserted with a commit per row, and the current month and the whole history of an owner are paged.
+    > The same is measured again once every past year has been archived.
+    Checks that the whole history of every owner is unchanged by archiving, and that a dry run moves nothing.
+    """
+    results = {}
+    now = datetime.now()
+
+    for factor in growth:
+        size = count * factor
+        rows = synthetic_rows(size, owners=100)
+        fresh = [
+            row[:2] + ((now - timedelta(minutes=i)).strftime(query.DATE_FORMAT),) + row[3:]
+            for i, row in enumerate(synthetic_rows(recent * 2, start=size + 1, owners=100))
+        ]
+        owners = list(range(1, 101))
+        with tempfile.TemporaryDirectory() as directory:
+            database = temporary_database(directory)
+            database.executemany(db.INSERT, rows)
+            before = sorted(row[1] for row in query.search(database, query.Filter(owners)))
+
+            for mode, batch in (('live', fresh[:recent]), ('archived', fresh[recent:])):
+                if mode == 'archived':
+                    planned = archiver.archive(database, now, 0, dry_run=True)
+                    results['dry run moved @ {}'.format(size)] = size + recent - database.fetch('SELECT COUNT(*) FROM expenses')[0][0]
+                    results['archived @ {}'.format(size)] = sum(archiver.archive(database, now, 0).values())
+                    results['planned @ {}'.format(size)] = sum(planned.values())
+
+                start = time.perf_counter()
+                for row in batch:
+                    database.execute(db.INSERT, row)
+                results['insert us @ {} {}'.format(size, mode)] = (time.perf_counter() - start) / len(batch) * 1e6
+
+                for period in ('month', 'all'):
+                    start = time.perf_counter()
+                    for owner in owners:
+                        query.page(database, query.Filter([owner], period=period))
+                    results['{} page ms @ {} {}'.format(period, size, mode)] = (time.perf_counter() - start) / len(owners) * 1000
+
+            after = sorted(row[1] for row in query.search(database, query.Filter(owners)))
+            results['mismatches @ {}'.format(size)] = len(set(before + [row[1] for row in fresh]) ^ set(after))
+            database.close()
+
+    return results
+
+def bench_budgets(count, owners=10, active=100) -> dict:
+    """
+    Compares the latency of recording an expense without budgets and with active budgets for every owner.
+    > Recording checks the expense against the budgets and then writes it.
+    > Writes are measured both through the write-behind writer and as per-row commits.
+    """
+    rows = synthetic_rows(count, owners=owners)
+    keys = [('', '')] + [('payment', payment) for payment in ('Credit', 'Debit', 'PayPal', 'PayLah')]
+    keys += [('purpose', 'Purpose {}'.format(i)) for i in range(active)]
+    limits = [(period, field, value) for field, value in keys for period in budget.PERIODS][:active]
+    results = {}
+
+    for mode in ('write-behind', 'commit'):
+        for size in (0, active):
+            with tempfile.TemporaryDirectory() as directory:
+                database = temporary_database(directory)
+                budgets = budget.Budgets(database)
+                for owner in range(1, owners + 1):
+                    for period, field, value in limits[:size]:
+                        budgets.set(owner, period, field, value, 100000)
+                    budgets.load(owner)
+                writer = db.Writer(database, os.path.join(directory, 'bench.journal'))
+                writer.start()
+                write = writer.put if mode == 'write-behind' else lambda row: database.execute(db.INSERT, row)
+
+                latencies = []
+                for row in rows:
+                    start = time.perf_counter()
+                    budgets.record(row)
+                    write(row)
+                    latencies.append(time.perf_counter() - start)
+                writer.stop()
+                database.close()
+
+            results['{} us @ {} budgets'.format(mode, size)] = sum(latencies) / len(latencies) * 1e6
+        results['{} overhead %'.format(mode)] = 100 * (
+            results['{} us @ {} budgets'.format(mode, active)] / results['{} us @ 0 budgets'.format(mode)] - 1
+        )
+
+    return results
+
+def bench_digest(count) -> dict:
+    """
+    Runs the digest scheduler for count owners against a fake clock and a fake bot.
+    > Half of the owners receive daily digests and half weekly digests.
+    > The scheduler is recreated between runs, as it would be on a restart.
+    Checks that every due owner receives exactly one digest and that sends never exceed the rate limit.
+    """
+    clock = replay.FakeClock(datetime(2026, 1, 4, 20))
+    sends = []
+    fake = replay.FakeBot()
+    fake.send_message = lambda chat_id, text, **kwargs: sends.append((chat_id, clock.monotonic()))
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = temporary_database(directory)
+        database.executemany(db.INSERT, synthetic_rows(count * 3, owners=count))
+        statements = []
+        database.connection().set_trace_callback(statements.append)
+
+        for run, (hours, expected) in enumerate([(1, count), (0, 0), (24, (count + 1) // 2)]):
+            scheduler = digest.Scheduler(
+                database, digest.TokenBucket(bot.DIGEST_RATE, bot.DIGEST_BURST, clock.monotonic, clock.sleep), bot.compose_digest, clock.now
+            )
+            if not run:
+                for owner in range(1, count + 1):
+                    scheduler.set(owner, 'daily' if owner % 2 else 'weekly', 21)
+            clock.advance(hours=hours)
+            sends.clear()
+            statements.clear()
+            simulated = clock.monotonic()
+            elapsed = time.perf_counter()
+            sent = scheduler.run(fake)
+            elapsed = time.perf_counter() - elapsed
+            simulated = clock.monotonic() - simulated
+
+            times = [sent_at for _, sent_at in sends]
+            busiest = max((bisect.bisect_left(times, sent_at + 1) - index for index, sent_at in enumerate(times)), default=0)
+            results['run {} sent'.format(run)] = sent
+            results['run {} duplicates'.format(run)] = sent - len({chat for chat, _ in sends}) + abs(sent - expected)
+            results['run {} queries'.format(run)] = sum(statement.startswith(('SELECT', 'WITH')) for statement in statements)
+            results['run {} max per second'.format(run)] = busiest
+            results['run {} simulated s'.format(run)] = simulated
+            results['run {} wall ms'.format(run)] = elapsed * 1000
+        database.close()
+
+    return results
+
+def bench_dispatch(count) -> dict:
+    """
+    Compares finding the next field of a manual conversation by walking the fields against the lookup by mask.
+    > The walk starts from the field in progress and skips every filled field, as the linked Information did.
+    > The lookup indexes the precomputed table of the schema by the mask of filled fields to request.
+    Every step of the conversation is measured count times.
+    """
+    fields = list(bot.EXPECTED_INFORMATION.values())
+    following = dict(zip(fields, fields[1:] + [None]))
+    steps = []
+    data = {}
+    for field in fields:
+        data = dict(data, **{field.name: '', 'filled': data.get('filled', 0) | field.bit})
+        steps.append((field, data))
+    results = {}
+
+    start = time.perf_counter()
+    for _ in range(count):
+        for info, data in steps:
+            while info is not None and info.name in data:
+                info = following[info]
+    results['walk ns/step'] = (time.perf_counter() - start) / count / len(steps) * 1e9
+
+    start = time.perf_counter()
+    for _ in range(count):
+        for info, data in steps:
+            info = bot.SCHEMA.missing[data['filled'] & bot.SCHEMA.requested]
+    results['lookup ns/step'] = (time.perf_counter() - start) / count / len(steps) * 1e9
+
+    return results
+
+def bench_import(count) -> dict:
+    """
+    Imports a synthetic CSV file of count rows.
+    Measures rows per second and the peak memory allocated during the import.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'import.csv')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write('description,datetime,amount,shop,location,purpose,payment,verified\n')
+            for row in synthetic_rows(count):
+                file.write('{},{},{}.{:02d},{},{},{},{},{}\n'.format(
+                    row[3], row[2], row[4] // 100, row[4] % 100, row[5], row[6], row[7], row[8], 'Yes' if row[9] else 'No'
+                ))
+
+        database = temporary_database(directory)
+        report = importer.Report(os.path.join(directory, 'errors.csv'))
+        tracemalloc.start()
+        start = time.perf_counter()
+        counts = importer.import_file(database, path, 1, report)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report.close()
+        database.close()
+
+    return {
+        'rows/sec': count / elapsed,
+        'imported': counts['imported'],
+        'duplicate': counts['duplicate'],
+        'invalid': counts['invalid'],
+        'peak MiB': peak / 2 ** 20,
+    }
+
+def bench_ocr(count) -> dict:
+    """
+    Measures the per-receipt latency and accuracy of receipt extraction on the labelled fixtures.
+    > Fixtures with an image are recognised with OCR if pytesseract is installed.
+    > Other fixtures are parsed from their recognised text.
+    """
+    with open(os.path.join(FIXTURES, 'receipts.json'), encoding='utf-8') as file:
+        fixtures = json.load(file)
+
+    latencies = []
+    correct = {}
+    for _ in range(max(1, count // len(fixtures))):
+        for fixture in fixtures:
+            start = time.perf_counter()
+            if 'image' in fixture and ocr.pytesseract:
+                fields = ocr.extract(os.path.join(FIXTURES, fixture['image']))
+            else:
+                fields = ocr.parse(fixture['text'])
+            latencies.append(time.perf_counter() - start)
+            for name, label in fixture['labels'].items():
+                correct[name] = correct.get(name, 0) + (fields.get(name) == label)
+
+    results = {
+        'p50 latency (ms)': percentile(latencies, 0.5) * 1000,
+        'p99 latency (ms)': percentile(latencies, 0.99) * 1000,
+    }
+    for name, hits in correct.items():
+        results['{} accuracy (%)'.format(name)] = 100 * hits / len(latencies)
+    return results
+
+def bench_persistence(count) -> dict:
+    """
+    Measures the per-update overhead of the conversation state store.
+    Each update changes the user data and conversation state of one of 100 users.
+    """
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = temporary_database(directory)
+        persistence = state.Persistence(database)
+        persistence.get_user_data()
+        persistence.get_conversations('manual')
+        data = [
+            {'owner': user, 'updateid': user, 'datetime': '2024-01-01 00:00:00', 'info': state.EXPECTED_INFORMATION['amount']}
+            for user in range(100)
+        ]
+
+        start = time.perf_counter()
+        for i in range(count):
+            user = i % 100
+            data[user]['amount'] = i
+            persistence.update_user_data(user, data[user])
+            persistence.update_conversation('manual', (user, user), i % 7)
+        results['per update (us)'] = (time.perf_counter() - start) / count * 1e6
+
+        start = time.perf_counter()
+        persistence.flush()
+        results['flush (ms)'] = (time.perf_counter() - start) * 1000
+        database.close()
+
+    return results
+
+class NullDispatcher:
+    """
+    Stands in for the dispatcher and handles every update instantly.
+    """
+    bot = None
+
+    def process_update(self, update) -> None:
+        pass
+
+def bench_webhook(count, clients=8) -> dict:
+    """
+    Replays recorded updates against a local webhook endpoint.
+    Measures the updates handled per second and the latency from receipt to handling.
+    """
+    updates = recorded_updates(count)
+    server = webhook.Server(NullDispatcher(), '127.0.0.1', 0, '/telegram')
+    server.start()
+
+    def send(payloads) -> None:
+        for payload in payloads:
+            conn = http.client.HTTPConnection('127.0.0.1', server.port)
+            conn.request('POST', '/telegram', payload, {'Content-Type': 'application/json'})
+            conn.getresponse().read()
+            conn.close()
+
+    threads = [threading.Thread(target=send, args=(updates[i::clients],)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.stop()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'updates/sec': server.metrics['handled'] / elapsed,
+        'deferred': server.metrics['deferred'],
+        'p50 latency (ms)': percentile(server.latencies, 0.5) * 1000,
+        'p99 latency (ms)': percentile(server.latencies, 0.99) * 1000,
+    }
+
+def bench_conversations(count, workers=4) -> dict:
+    """
+    Drives complete /add and /simple conversations through the real handlers.
+    > Measures conversations per second and per-handler latency when handled in order.
+    > Measures the peak memory allocated per conversation.
+    > Measures updates per second as the number of concurrent chats grows.
+    """
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        harness = replay.Harness(directory)
+        builders = [replay.manual_conversation, replay.simple_conversation]
+
+        conversations = [builders[chat % 2](harness, chat + 1) for chat in range(count)]
+        start = time.perf_counter()
+        for payload in replay.interleave(conversations):
+            harness.send(payload)
+        results['conversations/sec'] = count / (time.perf_counter() - start)
+        for name, samples in sorted(harness.timings.items()):
+            if not samples:
+                continue
+            results['{} p50 (us)'.format(name)] = percentile(samples, 0.5) * 1e6
+            results['{} p99 (us)'.format(name)] = percentile(samples, 0.99) * 1e6
+
+        allocations = []
+        tracemalloc.start()
+        for chat in range(min(count, 100)):
+            conversation = builders[chat % 2](harness, count + chat + 1)
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            for payload in conversation:
+                harness.send(payload)
+            allocations.append(tracemalloc.get_traced_memory()[1] - base)
+        tracemalloc.stop()
+        results['peak KiB/conversation'] = sum(allocations) / len(allocations) / 1024
+
+        chats = 1
+        while chats <= count:
+            conversations = [builders[chat % 2](harness, 10 * count + chat) for chat in range(chats)]
+            payloads = replay.interleave(conversations)
+            elapsed, deferred = harness.replay(payloads, workers)
+            results['updates/sec @ {} chats'.format(chats)] = len(payloads) / elapsed
+            chats *= 10
+
+        harness.close()
+
+    return results
+
+def bench_shards(count, threads=8, owners=1000) -> dict:
+    """
+    Measures insert throughput as the number of shards grows.
+    > threads writers insert count rows with a commit per row, as concurrent handlers writing directly would.
+    > The same rows are then written behind through the writer of every shard.
+    Checks that growing from 4 to 5 shards moves about a fifth of the owners, and loses or misplaces none of their expenses.
+    """
+    rows = synthetic_rows(count, owners=owners)
+    results = {}
+
+    for shards in (1, 2, 4, 8):
+        with tempfile.TemporaryDirectory() as directory:
+            router = db.Router(os.path.join(directory, 'bench.db'), shards)
+            db.setup(router)
+
+            def insert(part) -> None:
+                for row in part:
+                    router.shard(row[0]).execute(db.INSERT, row)
+
+            workers = [threading.Thread(target=insert, args=(rows[i::threads],)) for i in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            results['per-row commit @ {}'.format(shards)] = count / (time.perf_counter() - start)
+            router.close()
+
+        with tempfile.TemporaryDirectory() as directory:
+            router = db.Router(os.path.join(directory, 'bench.db'), shards)
+            db.setup(router)
+            writers = db.Writers(router, os.path.join(directory, 'bench.journal'))
+            writers.start()
+            start = time.perf_counter()
+            for row in rows:
+                writers.put(row)
+            writers.stop()
+            results['write-behind @ {}'.format(shards)] = count / (time.perf_counter() - start)
+            router.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        router = db.Router(path, 4)
+        db.setup(router)
+        for shard, group in router.partition(range(1, owners + 1)):
+            group = set(group)
+            shard.executemany(db.INSERT, [row for row in rows if row[0] in group])
+        router.close()
+
+        results['owners moved 4 to 5'] = db.rebalance(path, 5, 4)
+        router = db.Router(path, 5)
+        stored = [row for result in router.fan_out('SELECT owner, COUNT(*) FROM expenses GROUP BY owner') for row in result]
+        results['rows lost'] = count - sum(rows for _, rows in stored)
+        results['owners misplaced'] = sum(
+            1 for index, shard in enumerate(router.shards)
+            for owner, in shard.fetch('SELECT DISTINCT owner FROM expenses') if router.index(owner) != index
+        )
+        results['summary drift'] = db.rebuild_summaries(router, repair=False)
+        router.close()
+
+    return results
+
+def bench_ledger(count, sizes=(100, 500, 1000)) -> dict:
+    """
+    Measures group ledgers.
+    > count expenses of one group are inserted, split between a few of 100 members, against the same expenses unsplit.
+    > Reading the balances from their primary key is compared against recomputing them from every expense.
+    > Settling groups of sizes members is timed, with the number of transfers needed.
+    Checks that the balances sum to zero, that the recomputed balances have not drifted and that every settlement settles.
+    """
+    rows = synthetic_rows(count, owners=1)
+    split = [
+        row[:11] + (row[1] % 100, ledger.encode(ledger.split(row[4], [(row[1] * k) % 100 for k in range(1, 2 + row[1] % 6)])))
+        for row in rows
+    ]
+    results = {}
+
+    for name, batch in (('unsplit', rows), ('split', split)):
+        with tempfile.TemporaryDirectory() as directory:
+            database = temporary_database(directory)
+            start = time.perf_counter()
+            database.executemany(db.INSERT, batch)
+            results['{} rows/s'.format(name)] = len(batch) / (time.perf_counter() - start)
+            if name == 'unsplit':
+                database.close()
+                continue
+
+            start = time.perf_counter()
+            for _ in range(100):
+                balances = db.balances(database, 1)
+            results['balances lookup ms'] = (time.perf_counter() - start) * 10
+            start = time.perf_counter()
+            results['balances drift'] = db.rebuild_balances(database, repair=False)
+            results['balances recompute ms'] = (time.perf_counter() - start) * 1000
+            results['balances sum'] = sum(balance for _, balance in balances)
+            database.close()
+
+    for size in sizes:
+        balances = {member: (member * 7919) % 20001 - 10000 for member in range(1, size)}
+        balances[size] = -sum(balances.values())
+        start = time.perf_counter()
+        transfers = ledger.settle(balances)
+        results['settle ms @ {}'.format(size)] = (time.perf_counter() - start) * 1000
+        results['transfers @ {}'.format(size)] = len(transfers)
+        for debtor, creditor, amount in transfers:
+            balances[debtor] += amount
+            balances[creditor] -= amount
+        results['unsettled @ {}'.format(size)] = sum(1 for balance in balances.values() if balance)
+
+    return results
+
+def bench_metrics(count) -> dict:
+    """
+    Measures the overhead of the instrumentation.
+    > The cost of a timed handler call and of a timed statement, against a bare call.
+    > Conversations per second through the real handlers without metrics, with metrics, and with the profiler sampling.
+    > The time taken to export every metric.
+    """
+    registry = metrics.Registry()
+    callback = lambda update, context: None
+    wrapped = metrics.timed(registry, callback)
+    text = db.INSERT
+    results = {}
+
+    start = time.perf_counter()
+    for _ in range(count):
+        callback(None, None)
+    bare = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(count):
+        wrapped(None, None)
+    results['handler overhead (ns)'] = (time.perf_counter() - start - bare) / count * 1e9
+    start = time.perf_counter()
+    for _ in range(count):
+        registry.statement(text, 0.0001)
+    results['statement overhead (ns)'] = (time.perf_counter() - start) / count * 1e9
+
+    conversations = max(count // 100, 10)
+    builders = [replay.manual_conversation, replay.simple_conversation]
+    for name, instrumented, profiled in (('bare', False, False), ('metrics', True, False), ('profiled', True, True)):
+        with tempfile.TemporaryDirectory() as directory:
+            registry = metrics.Registry() if instrumented else None
+            harness = replay.Harness(directory, registry)
+            profiler = metrics.Profiler()
+            payloads = replay.interleave([builders[chat % 2](harness, chat + 1) for chat in range(conversations)])
+            if profiled:
+                profiler.start()
+            start = time.perf_counter()
+            for payload in payloads:
+                harness.send(payload)
+            results['conversations/sec {}'.format(name)] = conversations / (time.perf_counter() - start)
+            profiler.stop()
+            harness.close()
+
+    start = time.perf_counter()
+    exported = registry.export()
+    results['export (ms)'] = (time.perf_counter() - start) * 1000
+    results['exported lines'] = exported.count('\n')
+
+    return results
+
+########
+# MAIN #
+########
+
+BENCHMARKS = {
+    'add': bench_add,
+    'archive': bench_archive,
+    'budgets': bench_budgets,
+    'conversations': bench_conversations,
+    'currency': bench_currency,
+    'digest': bench_digest,
+    'dispatch': bench_dispatch,
+    'import': bench_import,
+    'ledger': bench_ledger,
+    'metrics': bench_metrics,
+    'ocr': bench_ocr,
+    'persistence': bench_persistence,
+    'plans': bench_plans,
+    'report': bench_report,
+    'search': bench_search,
+    'shards': bench_shards,
+    'webhook': bench_webhook,
+}
+
+SYLLABLES = ['ba', 'ko', 'ri', 'tu', 'me', 'sa', 'lo', 'ni', 'pe', 'da', 'gu', 'fi']
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Runs the expenses bot benchmarks.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--count', type=int, default=10000)
+    args = parser.parse_args()
+
+    for name, value in BENCHMARKS[args.benchmark](args.count).items():
+        print('{:<24} {:>12.3f}'.format(name, value))
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,36 @@
 import logging
-import re
+import os
+import secrets
+import shlex
+import tempfile
+import threading
+import ex_ANALYTICS as analytics
+import ex_ARCHIVE as archiver
+import ex_BUDGET as budget
+import ex_CHART as chart
+import ex_CURRENCY as exchange
+import ex_DIGEST as digest
+import ex_IMAGE as image
+import ex_EXPORT as exporter
+import ex_IMPORT as importer
+import ex_LEDGER as ledger
+import ex_METRICS as metrics
+import ex_OCR as ocr
+import ex_QUERY as query
 import ex_SQL as db
+import ex_STATE as state
+import ex_WEBHOOK as webhook
 
 from datetime import (
     datetime,
 )
+from decimal import (
+    Decimal,
+    InvalidOperation,
+)
 from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
     Update,
@@ -14,6 +39,7 @@ from telegram.ext import (
     Updater,
     CommandHandler,
     MessageHandler,
+    CallbackQueryHandler,
     Filters,
     ConversationHandler,
     CallbackContext,
@@ -22,8 +48,24 @@ from ex_BUILTINS import (
     Information,
     InputError,
     KEYBOARDS,
+    SCHEMA,
     EXPECTED_INFORMATION,
     AUTOMATIC_VERIFIED,
+    IMAGE_REPLY,
+    TEXT_REPLY,
+    BOOLEAN_REPLY,
+    DATE_REPLY,
+    AMOUNT_REPLY,
+    PAYMENT_REPLY,
+    DOCUMENT_REPLY,
+    EDIT_REPLY,
+    PAYMENTS,
+    CURRENCIES,
+    HOME_CURRENCY,
+    date_input,
+    amount_input,
+    boolean_input,
+    minor_units,
 )
 
 ###########
@@ -39,32 +81,45 @@ logger = logging.getLogger(__name__)
 # DATA VALIDATION AND INPUT #
 #############################
 
-def record_info(update: Update, context: CallbackContext) -> None:
+def fill(user_data, name, value) -> None:
     """
-    Saves the current message into the corresponding user data field.
+    Saves a value into a user data field and marks the field as filled.
     """
-    context.user_data[context.user_data['info'].name] = update.message.text
+    user_data[name] = value
+    user_data['filled'] = user_data.get('filled', 0) | EXPECTED_INFORMATION[name].bit
 
-def text_input(message) -> str:
+def field_value(row, name):
     """
-    Handles text input.
+    Returns the value of a field in a database row, at the position of the field in the schema.
     """
-    return message
+    return row[SCHEMA.fields[name].index]
 
-def date_input(message) -> datetime:
+def next_info(user_data) -> Information:
     """
-    Validates the current date input.
-    Date inputs are of the format '%y%m%d%H%M'.
-    Pads the date input with as many zeroes as necessary to form a valid input.
-    Returns the validated and padded date input.
+    Looks up the next field to request from the mask of filled fields.
+    Returns None if every field has been filled.
     """
-    format = ''.join(['%y', '%m', '%d', '%H', '%M'][0:len(message)//2])
-    try:
-        date = datetime.strptime(message, format)
-    except ValueError:
+    user_data['info'] = SCHEMA.missing[user_data['filled'] & SCHEMA.requested]
+    return user_data['info']
+
+def validate(context: CallbackContext, name, message) -> dict:
+    """
+    Validates a reply for a field.
+    > Amounts in a currency without any exchange rate are rejected, since they could not be converted to the home currency.
+    Returns the value of every field set by the reply, since an amount also sets its currency.
+    """
+    value = SCHEMA.validators[name](message)
+    if not isinstance(value, dict):
+        return {name: value}
+    if not context.bot_data['database'].rates.known(value.get('currency')):
         raise InputError
+    return value
 
-    return date.strftime('%Y-%m-%d %H:%M:%S')
+def record_info(update: Update, context: CallbackContext) -> None:
+    """
+    Saves the current message into the corresponding user data field.
+    """
+    fill(context.user_data, context.user_data['info'].name, update.message.text)
 
 def date_auto(update: Update) -> datetime:
     """
@@ -73,48 +128,72 @@ def date_auto(update: Update) -> datetime:
     Returns the generated date.
     """
 
-    return update.message.date.strftime('%Y-%m-%d %H:%M:%S'))
+    return update.message.date.strftime('%Y-%m-%d %H:%M:%S')
 
-def amount_input(message) -> int:
+def auto_verify(update: Update, context: CallbackContext, message) -> None:
     """
-    Verifies the regex format of the message.
-    Converts the amount received to cents.
-    Multiplies the message by 100.
+    Automatically populates the verified field if applicable.
+    > Debit, PayPal, PayLah are automatically populated.
     """
-    try:
-        if not re.match(r'^\d*\.?\d{0,2}$', message):
-            raise InputError
-        message = int(float(message) * 100)
-    except ValueError:
-        raise InputError
-
-    return message
+    if message in AUTOMATIC_VERIFIED:
+        fill(context.user_data, 'verified', boolean_input(AUTOMATIC_VERIFIED[message]))
 
-def boolean_input(message) -> bool:
+def image_input(update: Update, context: CallbackContext):
     """
-    Converts 'Yes' to TRUE and 'No' to False.
+    Queues an image to be downloaded and stored in the background.
+    The image is recorded against the update id of the initial message.
+    Returns the future of the stored image.
     """
-    if message == 'Yes':
-        return True
-    if message == 'No':
-        return False
+    file_id = update.message.photo[-1].file_id
+    return context.bot_data['images'].submit(context.bot, file_id, context.user_data['updateid'])
 
-def auto_verify(update: Update, context: CallbackContext, message) -> None:
+def receipt_input(update: Update, context: CallbackContext, stored) -> None:
     """
-    Automatically populates the verified field if applicable.
-    > Debit, PayPal, PayLah are automatically populated.
+    Queues the receipt image to be read in the background, so that the handler replies immediately.
+    The fields read are populated by a job once the receipt has been read.
     """
-    if message in AUTOMATIC_VERIFIED:
-        context.user_data['verified'] = boolean_input(AUTOMATIC_VERIFIED[message])
+    job = (int(update.effective_chat.id), context.user_data['updateid'], context.user_data)
+    fields = context.bot_data['ocr'].submit(stored)
+    fields.add_done_callback(
+        lambda fields: context.job_queue.run_once(receipt_fields, 0, context=job + (fields.result(), 0))
+    )
 
-def image_input(update: Update, context: CallbackContext) -> None:
+def receipt_fields(context: CallbackContext) -> None:
     """
-    Downloads and stores an image.
-    The filename of the image is the update id of the initial message.
+    Populates the fields read from a receipt image.
+    > A transaction still being added picks the fields up at its next step.
+    > A recorded transaction is amended once the writer has stored it.
+    Fields already provided by the user are kept.
     """
-    file_id = update.message.photo[-1]
-    new_file = context.bot.get_file(file_id)
-    new_file.download('{}.png'.format(context.user_data['updateid']))
+    owner, updateid, user_data, fields, attempt = context.job.context
+    if not fields:
+        return
+    if user_data.get('updateid') == updateid:
+        user_data['receipt'] = (updateid, fields)
+        return
+
+    row = retrieve_updateid(context.bot_data['database'], updateid)
+    if row is None or field_value(row, 'owner') != owner:
+        if attempt < RECEIPT_RETRIES:
+            context.job_queue.run_once(
+                receipt_fields, RECEIPT_RETRY_DELAY, context=(owner, updateid, user_data, fields, attempt + 1)
+            )
+        return
+    changes = {name: value for name, value in fields.items() if not field_value(row, name)}
+    if changes:
+        amend(context, owner, updateid, changes)
+
+def receipt_merge(user_data) -> None:
+    """
+    Populates the user data fields read from the receipt of the transaction being added.
+    Fields already provided by the user are kept.
+    """
+    updateid, fields = user_data.pop('receipt', (None, {}))
+    if updateid != user_data.get('updateid'):
+        return
+    for name, value in fields.items():
+        if not user_data.get(name):
+            fill(user_data, name, value)
 
 ##########
 # MANUAL #
@@ -147,22 +226,27 @@ def manual_date(update: Update, context: CallbackContext) -> int:
 def manual_amount(update: Update, context: CallbackContext) -> int:
     """
     Handles amount inputs.
+    The currency of the amount is saved with it.
     """
-    message = update.message.text
+    try:
+        values = validate(context, 'amount', update.message.text)
+    except InputError:
+        return manual_invalid(update, context)
 
-    message = amount_input(message)
+    for name, value in values.items():
+        fill(context.user_data, name, value)
 
-    update.message.text = message
-
-    return manual_progress(update, context)
+    return manual_progress(update, context, save=False)
 
 def manual_image(update: Update, context: CallbackContext) -> int:
     """
     Handles image inputs.
+    Fields read from the receipt are skipped once the receipt has been read.
     """
-    image_input(update, context)
+    stored = image_input(update, context)
+    receipt_input(update, context, stored)
 
-    return manual_progress(update, context)
+    return manual_progress(update, context, save=False)
 
 def manual_payment(update: Update, context: CallbackContext) -> int:
     """
@@ -205,18 +289,15 @@ def manual_progress(update: Update, context: CallbackContext, save=True) -> int:
     """
     if save:
         record_info(update, context)
+    receipt_merge(context.user_data)
 
-    next_info = context.user_data['info']
-    while next_info != Information.empty and next_info.name in context.user_data:
-        context.user_data['info'] = context.user_data['info'].next
-        next_info = context.user_data['info']
-
-    if next_info == Information.empty:
+    info = next_info(context.user_data)
+    if info is None:
         return manual_complete(update, context)
 
-    update.message.reply_text(next_info.message, reply_markup=next_info.keyboard)
+    update.message.reply_text(info.message, reply_markup=info.keyboard)
 
-    return next_info.state
+    return info.state
 
 def manual_complete(update: Update, context: CallbackContext) -> int:
     """
@@ -224,16 +305,19 @@ def manual_complete(update: Update, context: CallbackContext) -> int:
     Informs the user that the transaction is successful.
     Clears user data fields.
     """
-    if len(context.user_data) < 5:
+    if context.user_data.get('filled', 0) & SCHEMA.required != SCHEMA.required:
         update.message.reply_text(
             'Insufficient information has been provided.\n'
             'Description, Date, and Amount is required.'
         )
         return manual_cancel(update, context)
 
-    db.add(context.user_data)
+    record_payer(update, context)
+    alerts = context.bot_data['budgets'].record(db.values(context.user_data))
+    context.bot_data['writer'].add(context.user_data)
 
     update.message.reply_text('Transaction recorded with ID: {}.'.format(context.user_data['updateid']), reply_markup=ReplyKeyboardRemove())
+    warn_budgets(update.message, alerts)
 
     context.user_data.clear()
     return ConversationHandler.END
@@ -260,9 +344,9 @@ def manual_add(update: Update, context: CallbackContext) -> int:
         "Automatic input can be selected using the command /date.\n"
         "Cancel the process at any time using the command /cancel.\n"
     )
-    context.user_data['owner'] = int(update.effective_chat.id)
-    context.user_data['updateid'] = int(update.update_id)
-    context.user_data['info'] = EXPECTED_INFORMATION['datetime']
+    fill(context.user_data, 'owner', int(update.effective_chat.id))
+    fill(context.user_data, 'updateid', int(update.update_id))
+    next_info(context.user_data)
 
     return IMAGE_REPLY
 
@@ -283,7 +367,7 @@ def simple_help(update: Update, context: CallbackContext) -> None:
         '\n'
         'To add a new transaction, use the following format.\n'
         'Description\n'
-        'Amount\n'
+        'Amount, followed by a currency code if not in SGD\n'
         'Shop\n'
         'Location\n'
         'Purpose\n'
@@ -301,8 +385,10 @@ def simple_text(update: Update, context: CallbackContext) -> int:
 def simple_image(update: Update, context: CallbackContext) -> int:
     """
     Handles image inputs.
+    Fields left empty are populated from the receipt once it has been read.
     """
-    image_input(update, context)
+    stored = image_input(update, context)
+    receipt_input(update, context, stored)
 
     return simple_complete(update, context)
 
@@ -352,17 +438,13 @@ def simple_progress(update: Update, context: CallbackContext, save=True) -> int:
     if save:
         record_info(update, context)
 
-    next_info = context.user_data['info']
-    while next_info != Information.empty and next_info.name in context.user_data:
-        context.user_data['info'] = context.user_data['info'].next
-        next_info = context.user_data['info']
-
-    if next_info == Information.empty:
+    info = next_info(context.user_data)
+    if info is None:
         return simple_image_request(update, context)
 
-    update.message.reply_text(next_info.message, reply_markup=next_info.keyboard)
+    update.message.reply_text(info.message, reply_markup=info.keyboard)
 
-    return next_info.state
+    return info.state
 
 def simple_image_request(update: Update, context: CallbackContext) -> int:
     """
@@ -380,9 +462,12 @@ def simple_complete(update: Update, context: CallbackContext) -> int:
     Informs the user that the transaction is successful.
     Clears user data fields.
     """
-    db.add(context.user_data)
+    record_payer(update, context)
+    alerts = context.bot_data['budgets'].record(db.values(context.user_data))
+    context.bot_data['writer'].add(context.user_data)
 
     update.message.reply_text('Transaction recorded with ID: {}.'.format(context.user_data['updateid']), reply_markup=ReplyKeyboardRemove())
+    warn_budgets(update.message, alerts)
 
     context.user_data.clear()
     return ConversationHandler.END
@@ -403,26 +488,21 @@ def simple_add(update: Update, context: CallbackContext) -> int:
     Initiates the process of adding a new expense quickly.
     Immediately stores the owner, updateid, datetime, description, amount, shop, location, and purpose.
     """
-    context.user_data['owner'] = int(update.effective_chat.id)
-    context.user_data['updateid'] = int(update.update_id)
-    context.user_data['datetime'] = date_auto(update)
-    context.user_data['info'] = EXPECTED_INFORMATION['description']
+    fill(context.user_data, 'owner', int(update.effective_chat.id))
+    fill(context.user_data, 'updateid', int(update.update_id))
+    fill(context.user_data, 'datetime', date_auto(update))
 
     messages = update.message.text.split('\n')[1:]
-    messages = messages + [''] * (5 - len(messages))
-    messages.reverse()
-
-    info = context.user_data['info']
-    while messages:
+    messages = messages + [''] * (len(SIMPLE_INFORMATION) - len(messages))
+    for name, message in zip(SIMPLE_INFORMATION, messages):
         try:
-            message = info.function(messages.pop())
+            values = validate(context, name, message)
         except InputError:
             return simple_invalid(update, context, True)
-        context.user_data[info.name] = message
-        print(info.name, context.user_data[info.name])
-        info = info.next
-    context.user_data['info'] = info
+        for field, value in values.items():
+            fill(context.user_data, field, value)
 
+    info = next_info(context.user_data)
     update.message.reply_text(info.message, reply_markup=info.keyboard)
 
     return info.state
@@ -431,7 +511,1057 @@ def simple_add(update: Update, context: CallbackContext) -> int:
 # DATA RETRIEVAL #
 ##################
 
-def retrieve_updateid(updateid) ->
+def retrieve_updateid(database, updateid) -> tuple:
+    """
+    Retrieves the transaction with the given update id.
+    Returns None if no such transaction exists.
+    """
+    return query.by_updateid(database, updateid)
+
+def retrieve(database, filter) -> list:
+    """
+    Retrieves all transactions matching the filter.
+    """
+    return query.search(database, filter)
+
+def retrieve_image(database, updateid) -> tuple:
+    """
+    Retrieves the stored path and thumbnail of the image of a transaction.
+    Returns None if no image was stored.
+    """
+    rows = database.fetch('SELECT path, thumbnail FROM images WHERE updateid = ?', (updateid,))
+    return rows[0] if rows else None
+
+def receipt(update: Update, context: CallbackContext) -> None:
+    """
+    Sends a preview of the receipt of a transaction.
+    The thumbnail is sent if one was generated, otherwise the stored image.
+    """
+    database = context.bot_data['database']
+    owner = int(update.effective_chat.id)
+    try:
+        updateid = int(context.args[0])
+    except (IndexError, ValueError):
+        update.message.reply_text('Usage: /receipt UPDATEID')
+        return
+
+    row = retrieve_updateid(database.shard(owner), updateid)
+    if row is None or field_value(row, 'owner') != owner:
+        update.message.reply_text('Transaction not found.')
+        return
+
+    stored = retrieve_image(database.main, updateid)
+    if stored is None:
+        update.message.reply_text('No receipt was uploaded for this transaction.')
+        return
+
+    path, thumbnail = stored
+    with open(thumbnail or path, 'rb') as file:
+        update.message.reply_photo(file, caption=format_row(row))
+
+def parse_filter(owner, text) -> query.Filter:
+    """
+    Converts search options of the form key=value into a filter.
+    > period=day|week|month|year|all
+    > above=AMOUNT or below=AMOUNT, in the home currency
+    > shop=TEXT, location=TEXT, payment=TEXT
+    > verified=Yes|No
+    > order=date|amount|shop|location|payment
+    Values containing spaces must be quoted.
+    """
+    try:
+        tokens = shlex.split(text)
+    except ValueError:
+        raise InputError
+
+    options = {}
+    for token in tokens:
+        key, _, value = token.partition('=')
+        if key in ('period', 'order', 'shop', 'location', 'payment'):
+            options[key] = value
+        elif key in ('above', 'below'):
+            options['above'] = key == 'above'
+            options['amount'] = amount_input(value)
+        elif key == 'verified':
+            options['verified'] = boolean_input(value.capitalize())
+            if options['verified'] is None:
+                raise InputError
+        else:
+            raise InputError
+
+    filter = query.Filter([owner], **options)
+    filter.shape()
+    return filter
+
+def format_amount(amount, currency=None) -> str:
+    """
+    Converts an amount in cents to a decimal string.
+    Amounts in another currency than the home currency are converted from its minor units and followed by its code.
+    """
+    if not isinstance(amount, int):
+        return '-'
+    if currency and currency != HOME_CURRENCY:
+        return '{} {}'.format(Decimal(amount).scaleb(-CURRENCIES[currency]), currency)
+    return '{}.{:02d}'.format(amount // 100, amount % 100)
+
+def format_row(row) -> str:
+    """
+    Formats a transaction as a single line.
+    """
+    owner, updateid, dt, description, amount, shop, location, purpose, payment, verified, currency, *_ = row
+    return '#{} {} {} {} {} {} {}'.format(
+        updateid, dt, description, format_amount(amount, currency), shop or '-', payment or '-',
+        'verified' if verified else 'pending'
+    )
+
+def chunk_lines(lines, limit=None):
+    """
+    Groups lines into messages no longer than the Telegram message limit.
+    Lines are consumed lazily and each message is yielded once it is full.
+    """
+    limit = limit or MESSAGE_LIMIT
+    chunk, length = [], 0
+    for line in lines:
+        line = line[:limit]
+        if chunk and length + len(line) > limit:
+            yield '\n'.join(chunk)
+            chunk, length = [], 0
+        chunk.append(line)
+        length += len(line) + 1
+    if chunk:
+        yield '\n'.join(chunk)
+
+def encode_cursor(direction, row) -> str:
+    """
+    Encodes the (dt, updateid) keyset cursor of a row as callback data.
+    """
+    return 'page|{}|{}|{}'.format(direction, field_value(row, 'datetime'), field_value(row, 'updateid'))
+
+def decode_cursor(data) -> tuple:
+    """
+    Decodes callback data into a direction and a (dt, updateid) cursor.
+    """
+    _, direction, dt, updateid = data.split('|')
+    return direction == 'older', (dt, int(updateid))
+
+def page_keyboard(rows, more, forward, cursor) -> InlineKeyboardMarkup:
+    """
+    Builds the navigation buttons of a page.
+    > Newer pages exist if the page was reached from a newer page or more rows were found going back.
+    > Older pages exist if more rows were found going forward or the page was reached from an older page.
+    """
+    newer = cursor is not None if forward else more
+    older = more if forward else True
+
+    buttons = []
+    if newer:
+        buttons.append(InlineKeyboardButton('< Newer', callback_data=encode_cursor('newer', rows[0])))
+    if older:
+        buttons.append(InlineKeyboardButton('Older >', callback_data=encode_cursor('older', rows[-1])))
+
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def send_page(message, rows, more, forward=True, cursor=None) -> None:
+    """
+    Sends a page of transactions, split across as many messages as necessary.
+    The navigation buttons are attached to the last message.
+    """
+    if not rows:
+        message.reply_text('No transactions found.')
+        return
+
+    chunks = chunk_lines(format_row(row) for row in rows)
+    previous = next(chunks)
+    for chunk in chunks:
+        message.reply_text(previous)
+        previous = chunk
+
+    message.reply_text(previous, reply_markup=page_keyboard(rows, more, forward, cursor))
+
+def list_expenses(update: Update, context: CallbackContext) -> None:
+    """
+    Lists the transactions of the current chat over a period, newest first.
+    > Default period is all.
+    """
+    period = context.args[0] if context.args else 'all'
+    filter = query.Filter([int(update.effective_chat.id)], period=period)
+    try:
+        filter.shape()
+    except InputError:
+        update.message.reply_text('Usage: /list [day|week|month|year|all]')
+        return
+
+    context.chat_data['filter'] = filter
+    rows, more = query.page(context.bot_data['database'], filter)
+    send_page(update.message, rows, more)
+
+def search_expenses(update: Update, context: CallbackContext) -> None:
+    """
+    Searches the transactions of the current chat, newest first.
+    """
+    text = update.message.text.partition(' ')[2]
+    try:
+        filter = parse_filter(int(update.effective_chat.id), text)
+    except InputError:
+        update.message.reply_text(
+            'Usage: /search [period=month] [above=10 | below=10] [shop=...] '
+            '[location=...] [payment=Credit] [verified=Yes|No]'
+        )
+        return
+
+    context.chat_data['filter'] = filter
+    rows, more = query.page(context.bot_data['database'], filter)
+    send_page(update.message, rows, more)
+
+def find_expenses(update: Update, context: CallbackContext) -> None:
+    """
+    Finds the transactions of the current chat mentioning every search term, best matches first.
+    > Terms match the start of words in the description, shop, location and purpose.
+    > Archived transactions follow, newest first.
+    """
+    text = update.message.text.partition(' ')[2]
+    try:
+        rows = query.find(context.bot_data['database'], int(update.effective_chat.id), text)
+    except InputError:
+        update.message.reply_text('Usage: /find TERMS')
+        return
+
+    send_page(update.message, rows, False)
+
+def rebuild_search(update: Update, context: CallbackContext) -> None:
+    """
+    Rebuilds the full-text index from every recorded transaction.
+    Only available to administrators.
+    """
+    if int(update.effective_chat.id) not in ADMINS:
+        return
+
+    indexed = db.rebuild_search(context.bot_data['database'])
+    update.message.reply_text('Search index rebuilt. {} transactions indexed.'.format(indexed))
+
+def page_expenses(update: Update, context: CallbackContext) -> None:
+    """
+    Sends the next or previous page of the last list or search.
+    """
+    callback = update.callback_query
+    callback.answer()
+
+    filter = context.chat_data.get('filter')
+    if filter is None:
+        callback.message.reply_text('This list has expired. Please use /list or /search again.')
+        return
+
+    forward, cursor = decode_cursor(callback.data)
+    rows, more = query.page(context.bot_data['database'], filter, cursor, forward)
+    send_page(callback.message, rows, more, forward, cursor)
+
+###########
+# EDITING #
+###########
+
+def amend(context: CallbackContext, owner, updateid, changes) -> tuple:
+    """
+    Applies changes to a transaction with a single update keyed on its update id.
+    Updates the cached report columns and budgets in place.
+    Rescales the shares of a split transaction whose amount changed.
+    Returns the changed transaction and the budget alerts it crossed, or None if the transaction was not found.
+    """
+    changed = db.update(context.bot_data['database'], owner, updateid, changes)
+    if changed is None:
+        return None
+    before, after = changed
+    amount, shares = field_value(after, 'amount'), field_value(after, 'shares')
+    if shares and isinstance(amount, int) and amount != field_value(before, 'amount'):
+        shares = ledger.encode(ledger.rescale(ledger.decode(shares), amount))
+        after = db.update(context.bot_data['database'], owner, updateid, {'shares': shares})[1]
+    context.bot_data['analytics'].amend(owner, [after])
+    return after, context.bot_data['budgets'].amend(before, after)
+
+def mark_verified(context: CallbackContext, owner, updateids) -> int:
+    """
+    Marks transactions as verified in a single transaction.
+    Returns the number of transactions verified.
+    """
+    verified = db.verify(context.bot_data['database'], owner, updateids)
+    if verified:
+        context.bot_data['analytics'].amend(owner, [])
+    return verified
+
+def pending_keyboard(updateids) -> InlineKeyboardMarkup:
+    """
+    Builds a button verifying each shown transaction and a button verifying all of them.
+    """
+    buttons = [InlineKeyboardButton('Verify #{}'.format(updateid), callback_data='verify|{}'.format(updateid)) for updateid in updateids]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    if len(updateids) > 1:
+        rows.append([InlineKeyboardButton('Verify all shown', callback_data='verify|all')])
+    return InlineKeyboardMarkup(rows) if rows else None
+
+def pending_expenses(update: Update, context: CallbackContext) -> None:
+    """
+    Lists the latest unverified transactions with buttons to verify them.
+    """
+    filter = query.Filter([int(update.effective_chat.id)], verified=False)
+    rows, more = query.page(context.bot_data['database'], filter, size=PENDING_SIZE)
+    if not rows:
+        update.message.reply_text('All transactions are verified.')
+        return
+
+    context.chat_data['pending'] = [field_value(row, 'updateid') for row in rows]
+    lines = [format_row(row) for row in rows]
+    if more:
+        lines.append('Older unverified transactions are not shown.')
+    update.message.reply_text('\n'.join(lines), reply_markup=pending_keyboard(context.chat_data['pending']))
+
+def verify_shown(update: Update, context: CallbackContext) -> None:
+    """
+    Verifies one or all of the transactions shown by /pending.
+    """
+    callback = update.callback_query
+    shown = context.chat_data.get('pending')
+    if shown is None:
+        callback.answer('This list has expired. Please use /pending again.')
+        return
+
+    target = callback.data.split('|')[1]
+    updateids = shown if target == 'all' else [int(target)]
+    verified = mark_verified(context, int(update.effective_chat.id), updateids)
+    context.chat_data['pending'] = [updateid for updateid in shown if updateid not in updateids]
+    callback.answer('{} transactions verified.'.format(verified))
+    callback.edit_message_reply_markup(pending_keyboard(context.chat_data['pending']))
+
+def verify_expenses(update: Update, context: CallbackContext) -> None:
+    """
+    Verifies the transactions with the given update ids.
+    Lists the unverified transactions if none are given.
+    """
+    if not context.args:
+        pending_expenses(update, context)
+        return
+    try:
+        updateids = [int(arg) for arg in context.args]
+    except ValueError:
+        update.message.reply_text('Usage: /verify UPDATEID [UPDATEID ...]')
+        return
+
+    verified = mark_verified(context, int(update.effective_chat.id), updateids)
+    update.message.reply_text('{} transactions verified.'.format(verified))
+
+def edit_keyboard(updateid) -> InlineKeyboardMarkup:
+    """
+    Builds a button for each field of a transaction which can be corrected.
+    """
+    buttons = [
+        InlineKeyboardButton(name.capitalize(), callback_data='edit|{}|{}'.format(updateid, name)) for name in EDITABLE
+    ]
+    return InlineKeyboardMarkup([buttons[i:i + 4] for i in range(0, len(buttons), 4)])
+
+def edit_prompt(name) -> str:
+    """
+    Returns the first sentence of the request for a field.
+    """
+    return EXPECTED_INFORMATION[name].message.split('. ')[0].rstrip('.') + '.'
+
+def edit_start(update: Update, context: CallbackContext) -> int:
+    """
+    Shows a transaction with a button for each field which can be corrected.
+    """
+    try:
+        updateid = int(context.args[0])
+    except (IndexError, ValueError):
+        update.message.reply_text('Usage: /edit UPDATEID')
+        return ConversationHandler.END
+
+    owner = int(update.effective_chat.id)
+    row = retrieve_updateid(context.bot_data['database'].shard(owner), updateid)
+    if row is None or field_value(row, 'owner') != owner:
+        update.message.reply_text('Transaction not found.')
+        return ConversationHandler.END
+
+    update.message.reply_text(
+        '{}\nSelect the field to correct or /cancel.'.format(format_row(row)), reply_markup=edit_keyboard(updateid)
+    )
+    return EDIT_REPLY
+
+def edit_field(update: Update, context: CallbackContext) -> int:
+    """
+    Handles the field selected for correction.
+    > Verified is flipped immediately.
+    > Payment is chosen with further buttons.
+    > Other fields are requested from the user.
+    """
+    callback = update.callback_query
+    callback.answer()
+    _, updateid, name, *value = callback.data.split('|')
+    updateid = int(updateid)
+
+    if name == 'verified':
+        row = retrieve_updateid(context.bot_data['database'].shard(int(update.effective_chat.id)), updateid)
+        return edit_apply(callback.message, context, updateid, {'verified': not field_value(row, 'verified') if row else True})
+    if name == 'payment' and value:
+        return edit_apply(callback.message, context, updateid, {'payment': value[0]})
+    if name == 'payment':
+        callback.message.reply_text(edit_prompt(name), reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton(payment, callback_data='edit|{}|payment|{}'.format(updateid, payment)) for payment in PAYMENTS
+        ]]))
+        return EDIT_REPLY
+
+    context.chat_data['editing'] = (updateid, name)
+    callback.message.reply_text(edit_prompt(name))
+    return EDIT_REPLY
+
+def edit_value(update: Update, context: CallbackContext) -> int:
+    """
+    Validates the corrected value of the selected field and applies it.
+    """
+    editing = context.chat_data.get('editing')
+    if editing is None:
+        update.message.reply_text('Select the field to correct or /cancel.')
+        return EDIT_REPLY
+
+    updateid, name = editing
+    try:
+        changes = validate(context, name, update.message.text)
+    except InputError:
+        update.message.reply_text('Invalid input. {}'.format(edit_prompt(name)))
+        return EDIT_REPLY
+
+    return edit_apply(update.message, context, updateid, changes)
+
+def edit_apply(message, context: CallbackContext, updateid, changes) -> int:
+    """
+    Applies a correction and shows the corrected transaction.
+    """
+    context.chat_data.pop('editing', None)
+    changed = amend(context, int(message.chat.id), updateid, changes)
+    if changed is None:
+        message.reply_text('Transaction not found.')
+        return ConversationHandler.END
+
+    row, alerts = changed
+    message.reply_text('Transaction corrected.\n{}'.format(format_row(row)))
+    warn_budgets(message, alerts)
+    return ConversationHandler.END
+
+def edit_cancel(update: Update, context: CallbackContext) -> int:
+    """
+    Cancels the correction.
+    """
+    context.chat_data.pop('editing', None)
+    update.message.reply_text('Edit cancelled.')
+
+    return ConversationHandler.END
+
+##########
+# IMPORT #
+##########
+
+def import_start(update: Update, context: CallbackContext) -> int:
+    """
+    Initiates the import of historical transactions from a file.
+    """
+    update.message.reply_text(
+        'Upload a CSV, JSON or JSON Lines file of transactions.\n'
+        'Columns: description, datetime, amount, shop, location, purpose, payment, verified.\n'
+        'Description, datetime and amount are required.\n'
+        'Cancel the process at any time using the command /cancel.'
+    )
+
+    return DOCUMENT_REPLY
+
+def import_document(update: Update, context: CallbackContext) -> int:
+    """
+    Downloads the uploaded file and imports its transactions.
+    Sends the rows which could not be imported back as a CSV report.
+    """
+    document = update.message.document
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, os.path.basename(document.file_name or 'import.csv'))
+        context.bot.get_file(document.file_id).download(custom_path=path)
+        report = importer.Report(os.path.join(directory, 'import_errors.csv'))
+        try:
+            counts = importer.import_file(context.bot_data['database'], path, int(update.effective_chat.id), report)
+            context.bot_data['budgets'].invalidate(int(update.effective_chat.id))
+        except (InputError, UnicodeDecodeError):
+            update.message.reply_text('The file could not be read. Please upload a CSV, JSON or JSON Lines file.')
+            return ConversationHandler.END
+        finally:
+            report.close()
+
+        update.message.reply_text(
+            'Imported {imported} transactions, skipped {duplicate} duplicates and {invalid} invalid rows.'.format(**counts)
+        )
+        if counts['duplicate'] or counts['invalid']:
+            with open(report.path, 'rb') as file:
+                update.message.reply_document(file, filename='import_errors.csv')
+
+    return ConversationHandler.END
+
+def import_cancel(update: Update, context: CallbackContext) -> int:
+    """
+    Cancels the import.
+    """
+    update.message.reply_text('Import cancelled.')
+
+    return ConversationHandler.END
+
+##########
+# EXPORT #
+##########
+
+def export_expenses(update: Update, context: CallbackContext) -> None:
+    """
+    Exports the transactions of the current chat and sends them as a document.
+    > The first option may be a format: csv, jsonl or parquet. Default is csv.
+    > The remaining options are the same as /search.
+    """
+    text = update.message.text.partition(' ')[2]
+    format, _, options = text.partition(' ')
+    if format not in exporter.FORMATS and format != 'parquet':
+        format, options = 'csv', text
+
+    try:
+        filter = parse_filter(int(update.effective_chat.id), options)
+    except InputError:
+        update.message.reply_text('Usage: /export [csv|jsonl|parquet] [period=month] [payment=Credit] [verified=Yes|No]')
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'expenses.{}'.format(format))
+        try:
+            count = exporter.export(context.bot_data['database'], filter, path, format)
+        except InputError as error:
+            update.message.reply_text('Export failed: {}.'.format(error))
+            return
+        with open(path, 'rb') as file:
+            update.message.reply_document(file, filename=os.path.basename(path), caption='{} transactions exported.'.format(count))
+
+#############
+# SUMMARIES #
+#############
+
+def summarise(update: Update, context: CallbackContext) -> None:
+    """
+    Displays the totals of the current period by payment method.
+    > Default period is month.
+    """
+    grain = context.args[0] if context.args else 'month'
+    if grain not in db.GRAINS:
+        update.message.reply_text('Usage: /summary [day|week|month|year]')
+        return
+
+    rows = db.summary(context.bot_data['database'], int(update.effective_chat.id), grain, datetime.now())
+    if not rows:
+        update.message.reply_text('No transactions recorded this {}.'.format(grain))
+        return
+
+    payments = {}
+    pending = 0
+    for payment, verified, total, count in rows:
+        payments[payment or 'Unspecified'] = payments.get(payment or 'Unspecified', 0) + total
+        if not verified:
+            pending += total
+
+    lines = ['SUMMARY FOR THIS {}'.format(grain.upper()), '']
+    lines += ['{}: {}'.format(payment, format_amount(total)) for payment, total in payments.items()]
+    lines += [
+        '',
+        'Total: {} over {} transactions'.format(format_amount(sum(payments.values())), sum(row[3] for row in rows)),
+        'Pending verification: {}'.format(format_amount(pending)),
+    ]
+    update.message.reply_text('\n'.join(lines))
+
+def rebuild_summaries(update: Update, context: CallbackContext) -> None:
+    """
+    Recomputes the summaries from every recorded transaction and reports the drift.
+    Only available to administrators.
+    """
+    if int(update.effective_chat.id) not in ADMINS:
+        return
+
+    drift = db.rebuild_summaries(context.bot_data['database'])
+    update.message.reply_text('Summaries rebuilt. {} summary rows had drifted.'.format(drift))
+
+###########
+# BUDGETS #
+###########
+
+def describe_budget(limit) -> str:
+    """
+    Names a budget by its period and the purpose or payment method it applies to.
+    """
+    name = '{} budget'.format(PERIOD_NAMES[limit.period])
+    if limit.field:
+        name += ' for {} {}'.format(limit.field, limit.value)
+    return name
+
+def warn_budgets(message, alerts) -> None:
+    """
+    Warns the user of every budget threshold crossed by a transaction.
+    """
+    for limit, threshold in alerts:
+        message.reply_text('{}: {}% of your {} used ({} of {}).'.format(
+            'Budget exceeded' if threshold >= 100 else 'Budget warning', threshold,
+            describe_budget(limit), format_amount(limit.spent), format_amount(limit.amount)
+        ))
+
+def parse_budget(text) -> tuple:
+    """
+    Converts budget options into the period, field, value and amount of a budget.
+    > AMOUNT, or remove to remove the budget
+    > day|week|month|year, month by default
+    > purpose=TEXT or payment=TEXT
+    Values containing spaces must be quoted.
+    """
+    try:
+        tokens = shlex.split(text)
+    except ValueError:
+        raise InputError
+
+    period, field, value, amount = 'month', '', '', None
+    for token in tokens:
+        key, _, option = token.partition('=')
+        if key in budget.FIELDS and option:
+            field, value = key, option
+        elif token in budget.PERIODS:
+            period = token
+        elif token == 'remove':
+            amount = 'remove'
+        else:
+            amount = amount_input(token)
+            if not amount:
+                raise InputError
+    if amount is None:
+        raise InputError
+    return period, field, value, amount
+
+def budgets(update: Update, context: CallbackContext) -> None:
+    """
+    Sets or removes a budget, or displays every budget and its spending in the current period.
+    """
+    owner = int(update.effective_chat.id)
+    if context.args:
+        try:
+            period, field, value, amount = parse_budget(' '.join(context.args))
+        except InputError:
+            update.message.reply_text(
+                'Usage: /budget AMOUNT [day|week|month|year] [purpose=TEXT|payment=TEXT]\n'
+                'or /budget remove [day|week|month|year] [purpose=TEXT|payment=TEXT]'
+            )
+            return
+        if amount == 'remove':
+            removed = context.bot_data['budgets'].remove(owner, period, field, value)
+            update.message.reply_text('Budget removed.' if removed else 'There is no such budget.')
+        else:
+            context.bot_data['budgets'].set(owner, period, field, value, amount)
+            update.message.reply_text('Budget set.')
+        return
+
+    status = context.bot_data['budgets'].status(owner, datetime.now().strftime('%Y-%m-%d'))
+    if not status:
+        update.message.reply_text('No budgets set. Use /budget AMOUNT to set a monthly budget.')
+        return
+    lines = []
+    for item, spent in status:
+        name = describe_budget(item)
+        lines.append('{}{}: {} of {} ({}%)'.format(
+            name[0].upper(), name[1:], format_amount(spent), format_amount(item.amount), spent * 100 // item.amount
+        ))
+    update.message.reply_text('\n'.join(lines))
+
+###########
+# LEDGERS #
+###########
+
+def member_name(user) -> str:
+    """
+    Names a member of a group ledger by their username, or their first name if they have none.
+    """
+    return user.username or user.first_name
+
+def record_payer(update: Update, context: CallbackContext) -> None:
+    """
+    Records the sender as the payer of a transaction in a group chat.
+    Splits the transaction equally between every member of the group, including the payer.
+    """
+    if update.effective_chat.type == 'private' or not isinstance(context.user_data.get('amount'), int):
+        return
+    owner, payer = int(update.effective_chat.id), int(update.effective_user.id)
+    ledgers = context.bot_data['ledger']
+    ledgers.join(owner, payer, member_name(update.effective_user))
+    fill(context.user_data, 'payer', payer)
+    fill(context.user_data, 'shares', ledgers.split(owner, context.user_data['amount']))
+
+def join_ledger(update: Update, context: CallbackContext) -> None:
+    """
+    Adds the sender to the ledger of a group chat, so that later transactions are split with them.
+    """
+    if update.effective_chat.type == 'private':
+        update.message.reply_text('Ledgers are only kept in group chats.')
+        return
+    name = member_name(update.effective_user)
+    context.bot_data['ledger'].join(int(update.effective_chat.id), int(update.effective_user.id), name)
+    update.message.reply_text('{} joined the ledger.'.format(name))
+
+def parse_split(text) -> tuple:
+    """
+    Converts split options into the update id, payer name, member names and member amounts of a split.
+    > UPDATEID, followed by
+    > paid=NAME to change the payer, the sender by default
+    > NAME to split equally between the named members, every member by default
+    > NAME=AMOUNT to give the named members exact shares
+    Names containing spaces must be quoted.
+    """
+    try:
+        tokens = shlex.split(text)
+        updateid = int(tokens.pop(0))
+    except (ValueError, IndexError):
+        raise InputError
+
+    payer, names, amounts = None, [], {}
+    for token in tokens:
+        key, _, option = token.partition('=')
+        if key == 'paid' and option:
+            payer = option
+        elif option:
+            amounts[key] = option
+        elif key:
+            names.append(key)
+    if names and amounts:
+        raise InputError
+    return updateid, payer, names, amounts
+
+def share_input(message, currency) -> int:
+    """
+    Converts a share received in the currency of a transaction to its minor units.
+    """
+    try:
+        return minor_units(Decimal(message), currency)
+    except InvalidOperation:
+        raise InputError
+
+def split_expense(update: Update, context: CallbackContext) -> None:
+    """
+    Changes the payer and shares of a transaction of a group chat.
+    The shares of the named members must add up to the amount of the transaction.
+    """
+    if update.effective_chat.type == 'private':
+        update.message.reply_text('Ledgers are only kept in group chats.')
+        return
+    owner = int(update.effective_chat.id)
+    ledgers = context.bot_data['ledger']
+    try:
+        updateid, payer, names, amounts = parse_split(' '.join(context.args))
+    except InputError:
+        update.message.reply_text(
+            'Usage: /split UPDATEID [paid=NAME] [NAME ...]\n'
+            'or /split UPDATEID [paid=NAME] NAME=AMOUNT ...'
+        )
+        return
+
+    row = retrieve_updateid(context.bot_data['database'].shard(owner), updateid)
+    if row is None or field_value(row, 'owner') != owner:
+        update.message.reply_text('Transaction not found.')
+        return
+    amount = field_value(row, 'amount')
+    if not isinstance(amount, int):
+        update.message.reply_text('This transaction has no amount to split.')
+        return
+
+    ledgers.join(owner, int(update.effective_user.id), member_name(update.effective_user))
+    currency = field_value(row, 'currency') or HOME_CURRENCY
+    try:
+        if payer:
+            payer = ledgers.find(owner, [payer])[0]
+        else:
+            payer = field_value(row, 'payer') or int(update.effective_user.id)
+        if amounts:
+            shares = dict(zip(
+                ledgers.find(owner, list(amounts)), (share_input(amount, currency) for amount in amounts.values())
+            ))
+        else:
+            shares = ledger.split(amount, ledgers.find(owner, names) if names else list(ledgers.members(owner)))
+    except InputError as error:
+        update.message.reply_text('Unknown or ambiguous member: {}. Members must /join first.'.format(error))
+        return
+    if sum(shares.values()) != amount:
+        update.message.reply_text('The shares must add up to {}.'.format(format_amount(amount, currency)))
+        return
+
+    changed = amend(context, owner, updateid, {'payer': payer, 'shares': ledger.encode(shares)})
+    if changed is None:
+        update.message.reply_text('Archived transactions cannot be split.')
+        return
+    update.message.reply_text('Transaction split between {} members.\n{}'.format(len(shares), format_row(changed[0])))
+
+def show_balances(update: Update, context: CallbackContext) -> None:
+    """
+    Displays the balance of every member of the ledger of a group chat, in the home currency.
+    """
+    owner = int(update.effective_chat.id)
+    ledgers = context.bot_data['ledger']
+    balances = ledgers.balances(owner)
+    if not balances:
+        update.message.reply_text('Every balance is settled.')
+        return
+    names = ledgers.members(owner)
+    lines = [
+        '{} {} {}'.format(names.get(member, member), 'is owed' if balance > 0 else 'owes', format_amount(abs(balance)))
+        for member, balance in balances
+    ]
+    for text in chunk_lines(lines):
+        update.message.reply_text(text)
+
+def settle_balances(update: Update, context: CallbackContext) -> None:
+    """
+    Displays the transfers settling every balance of the ledger of a group chat, in the home currency.
+    """
+    owner = int(update.effective_chat.id)
+    ledgers = context.bot_data['ledger']
+    transfers = ledgers.settle(owner)
+    if not transfers:
+        update.message.reply_text('Every balance is settled.')
+        return
+    names = ledgers.members(owner)
+    lines = [
+        '{} pays {} {}'.format(names.get(debtor, debtor), names.get(creditor, creditor), format_amount(amount))
+        for debtor, creditor, amount in transfers
+    ]
+    for text in chunk_lines(lines):
+        update.message.reply_text(text)
+
+def rebuild_balances(update: Update, context: CallbackContext) -> None:
+    """
+    Recomputes the balances from every recorded transaction and reports the drift.
+    Only available to administrators.
+    """
+    if int(update.effective_chat.id) not in ADMINS:
+        return
+
+    drift = db.rebuild_balances(context.bot_data['database'])
+    update.message.reply_text('Balances rebuilt. {} balances had drifted.'.format(drift))
+
+###########
+# DIGESTS #
+###########
+
+def compose_digest(frequency, totals, rows, count) -> str:
+    """
+    Composes the digest of the spending of the current period and the unverified transactions.
+    Returns None if nothing was spent and nothing is left to verify.
+    """
+    total, transactions = totals
+    if not transactions and not count:
+        return None
+
+    lines = [
+        '{} DIGEST'.format(frequency.upper()),
+        '',
+        'Spent {}: {} over {} transactions'.format(
+            'today' if frequency == 'daily' else 'this week', format_amount(total), transactions
+        ),
+    ]
+    if count:
+        lines += ['', '{} transactions are not verified yet:'.format(count)]
+        lines += [format_row(row) for row in rows]
+        if count > len(rows):
+            lines.append('and {} more.'.format(count - len(rows)))
+    return '\n'.join(lines)
+
+def schedule_digest(update: Update, context: CallbackContext) -> None:
+    """
+    Schedules, stops or displays the digest of the user.
+    > /digest daily|weekly [HOUR] schedules a digest, at 21:00 by default.
+    > /digest off stops the digest.
+    """
+    owner = int(update.effective_chat.id)
+    scheduler = context.bot_data['digests']
+    args = [arg.lower() for arg in context.args]
+
+    if not args:
+        schedule = scheduler.get(owner)
+        if schedule is None:
+            update.message.reply_text('No digest scheduled. Use /digest daily|weekly [HOUR] to schedule one.')
+        else:
+            update.message.reply_text('Your {} digest is next sent at {}.'.format(schedule[0], schedule[2][:16]))
+        return
+
+    if args == ['off']:
+        scheduler.remove(owner)
+        update.message.reply_text('Digest stopped.')
+        return
+
+    try:
+        if args[0] not in digest.FREQUENCIES or len(args) > 2:
+            raise ValueError
+        hour = int(args[1]) if len(args) > 1 else DIGEST_HOUR
+        if not 0 <= hour <= 23:
+            raise ValueError
+    except ValueError:
+        update.message.reply_text('Usage: /digest daily|weekly [HOUR] or /digest off')
+        return
+
+    due = scheduler.set(owner, args[0], hour)
+    update.message.reply_text('Digest scheduled. The next digest is sent at {}.'.format(due.strftime('%Y-%m-%d %H:%M')))
+
+def send_digests(context: CallbackContext) -> None:
+    """
+    Sends every digest which is due.
+    """
+    context.bot_data['digests'].run(context.bot)
+
+###########
+# ARCHIVE #
+###########
+
+def describe_archive(counts, dry_run) -> str:
+    """
+    Describes the number of transactions archived by year.
+    """
+    if not counts:
+        return 'Nothing to archive.'
+    return '\n'.join(
+        '{} {} transactions of {}.'.format('Would archive' if dry_run else 'Archived', count, year)
+        for year, count in sorted(counts.items())
+    )
+
+def archive_expenses(context: CallbackContext) -> None:
+    """
+    Moves the transactions older than the archive age into the yearly archives.
+    Only counts them if archiving is a dry run.
+    """
+    counts = archiver.archive(context.bot_data['database'], datetime.now(), ARCHIVE_AGE, ARCHIVE_DRY_RUN)
+    logger.info(describe_archive(counts, ARCHIVE_DRY_RUN))
+
+def archive_now(update: Update, context: CallbackContext) -> None:
+    """
+    Archives the transactions older than the archive age immediately, or only counts them with dry.
+    Only available to administrators.
+    """
+    if int(update.effective_chat.id) not in ADMINS:
+        return
+
+    dry_run = ARCHIVE_DRY_RUN or context.args == ['dry']
+    counts = archiver.archive(context.bot_data['database'], datetime.now(), ARCHIVE_AGE, dry_run)
+    update.message.reply_text(describe_archive(counts, dry_run))
+
+###########
+# REPORTS #
+###########
+
+def format_change(amount) -> str:
+    """
+    Converts a change in cents to a signed decimal string.
+    """
+    return ('+' if amount >= 0 else '-') + format_amount(abs(amount))
+
+def send_chart(context: CallbackContext) -> None:
+    """
+    Sends a rendered chart once its rendering has finished.
+    > Runs as a job, so that the chart is never sent from the thread which finished rendering it.
+    """
+    chat_id, caption, future = context.job.context
+    if future.exception() is not None:
+        context.bot.send_message(chat_id, 'The chart could not be drawn. Please try again later.')
+        return
+    with open(future.result(), 'rb') as file:
+        context.bot.send_photo(chat_id, file, caption=caption)
+
+def spending_report(update: Update, context: CallbackContext) -> None:
+    """
+    Displays the monthly totals, trends and largest categories of the last months.
+    > Default is the last 6 months.
+    > Months of archived years are included.
+    > A bar chart of the monthly totals or a pie chart of the payment methods is sent instead if requested.
+    Charts are rendered in the background and sent once ready.
+    """
+    if analytics.np is None:
+        update.message.reply_text('Reports need numpy to be installed.')
+        return
+    months, kind = REPORT_MONTHS, None
+    try:
+        for arg in context.args:
+            if arg.lower() in chart.KINDS:
+                kind = arg.lower()
+            else:
+                months = int(arg)
+        if not 1 <= months <= 120:
+            raise ValueError
+    except ValueError:
+        update.message.reply_text('Usage: /report [months] [bar|pie]')
+        return
+    if kind and chart.matplotlib is None:
+        update.message.reply_text('Charts need matplotlib to be installed.')
+        return
+
+    owner = int(update.effective_chat.id)
+    version = context.bot_data['database'].version(owner)
+    now = datetime.now()
+    columns = context.bot_data['analytics'].columns(owner, analytics.since(now, months))
+    result = analytics.report(columns, now, months, REPORT_WINDOW)
+    if not result['count']:
+        update.message.reply_text('No transactions recorded in the last {} months.'.format(months))
+        return
+
+    if kind:
+        if kind == 'bar':
+            title = 'Spending over the last {} months'.format(months)
+            labels, values = result['months'], result['totals']
+        else:
+            title = 'Spending by payment method over the last {} months'.format(months)
+            labels = [label or 'Unspecified' for label, _ in result['payment']]
+            values = [total for _, total in result['payment']]
+        future = context.bot_data['charts'].chart(
+            owner, kind, [months, now.strftime('%Y-%m-%d')], version, title, labels, [value / 100 for value in values]
+        )
+        caption = 'Total: {} over {} transactions'.format(format_amount(result['total']), result['count'])
+        job = (update.effective_chat.id, caption)
+        future.add_done_callback(lambda done: context.job_queue.run_once(send_chart, 0, context=job + (done,)))
+        return
+
+    lines = ['REPORT FOR THE LAST {} MONTHS'.format(months), '']
+    lines += [
+        '{}: {} ({})'.format(month, format_amount(total), format_change(delta))
+        for month, total, delta in zip(result['months'], result['totals'], result['deltas'])
+    ]
+    lines += ['', 'Total: {} over {} transactions'.format(format_amount(result['total']), result['count'])]
+    if len(result['moving']):
+        lines.append('Daily average over the last {} days: {}'.format(REPORT_WINDOW, format_amount(int(round(result['moving'][-1])))))
+    for name in ('purpose', 'shop', 'payment'):
+        lines += ['', 'Top by {}:'.format(name)]
+        lines += ['{}: {}'.format(label or 'Unspecified', format_amount(total)) for label, total in result[name]]
+    lines += ['', 'Transaction amounts:']
+    lines += ['{}th percentile: {}'.format(percentile, format_amount(value)) for percentile, value in result['percentiles']]
+    update.message.reply_text('\n'.join(lines))
+
+###########
+# METRICS #
+###########
+
+def profile(update: Update, context: CallbackContext) -> None:
+    """
+    Starts or stops the sampling profiler.
+    > /profile start discards the previous samples and starts sampling.
+    > /profile stop stops sampling, writes the collapsed stacks to the profile file and shows the functions sampled most.
+    Only available to administrators.
+    """
+    if int(update.effective_chat.id) not in ADMINS:
+        return
+
+    profiler = context.bot_data['profiler']
+    action = update.message.text.partition(' ')[2].strip().lower()
+    if action == 'start':
+        update.message.reply_text('Profiler started.' if profiler.start() else 'Profiler is already running.')
+    elif action == 'stop':
+        if not profiler.stop():
+            update.message.reply_text('Profiler is not running.')
+            return
+        samples = profiler.dump(PROFILE)
+        lines = ['{} samples written to {}.'.format(samples, PROFILE)]
+        lines.extend('{}: {}'.format(function, count) for function, count in profiler.top(PROFILE_TOP))
+        update.message.reply_text('\n'.join(lines))
+    else:
+        update.message.reply_text('Usage: /profile start|stop')
 
 ##################
 # OTHER COMMANDS #
@@ -445,71 +1575,80 @@ def help(update: Update, context: CallbackContext) -> None:
         '/add to manually add a new transaction.\n'
         '/simple to quickly add a new transaction.\n'
         ' > use /simple_help to show the format.\n'
+        '/list to list transactions over a period.\n'
+        '/search to search transactions.\n'
+        '/find to find transactions mentioning some words.\n'
+        '/summary to show the totals of the current period.\n'
+        '/budget to set budgets and show their spending.\n'
+        '/join to join the ledger of a group chat.\n'
+        '/split to change how a group transaction is split.\n'
+        '/balances to show who owes what in a group chat.\n'
+        '/settle to show the transfers settling a group chat.\n'
+        '/digest to receive a daily or weekly digest.\n'
+        '/report to show the spending trends of the last months.\n'
+        ' > add bar or pie to receive a chart.\n'
+        '/receipt to show the receipt of a transaction.\n'
+        '/pending to list and verify unverified transactions.\n'
+        '/verify to verify transactions by ID.\n'
+        '/edit to correct a transaction.\n'
+        '/import to import transactions from a CSV or JSON file.\n'
+        '/export to export transactions to a file.\n'
     )
 
 #########
 # SETUP #
 #########
 
-def main() -> None:
-    # Initializes necessary processes
-    updater = Updater(token=TOKEN)
-    dispatcher = updater.dispatcher
-    db.setup()
+def flush_state(context: CallbackContext) -> None:
+    """
+    Writes the conversation states changed since the last flush.
+    """
+    context.dispatcher.persistence.flush()
+
+def reply_handlers(handlers) -> dict:
+    """
+    Builds the message handlers of the conversation states of the schema which have a handler.
+    > Each state accepts the replies allowed by the pattern of its fields, or any text if they have none.
+    """
+    return {
+        state: [
+            MessageHandler(
+                (Filters.regex(pattern) if pattern else Filters.text) & ~(Filters.command),
+                handlers[state]
+            )
+        ]
+        for state, pattern in SCHEMA.states.items() if state in handlers
+    }
 
+def register(dispatcher) -> None:
+    """
+    Adds every command and conversation handler to the dispatcher.
+    """
     # Handler for help command
     help_handler = CommandHandler('help', help)
     dispatcher.add_handler(help_handler)
 
     # Handler for manually adding a new expense
+    manual_states = reply_handlers({
+        TEXT_REPLY: manual_text,
+        DATE_REPLY: manual_date,
+        AMOUNT_REPLY: manual_amount,
+        PAYMENT_REPLY: manual_payment,
+        BOOLEAN_REPLY: manual_verified,
+    })
+    manual_states[IMAGE_REPLY] = [
+        MessageHandler(
+            Filters.photo,
+            manual_image
+        ),
+        CommandHandler('date', manual_date)
+    ]
+    manual_states[DATE_REPLY].append(CommandHandler('date', manual_date))
     manual_handler = ConversationHandler(
+        name='manual',
+        persistent=True,
         entry_points=[CommandHandler('add', manual_add)],
-        states={
-            IMAGE_REPLY: [
-                MessageHandler(
-                    Filters.photo,
-                    manual_image
-                ),
-                CommandHandler('date', manual_date)
-            ],
-            TEXT_REPLY: [
-                MessageHandler(
-                    Filters.text & ~(Filters.command),
-                    manual_text
-                )
-            ],
-            BOOLEAN_REPLY: [
-                MessageHandler(
-                    Filters.regex('^(Yes|No)$'),
-                    manual_verified
-                )
-            ],
-            CHOICES_REPLY: [
-                MessageHandler(
-                    Filters.regex('^$'),
-                    manual_text
-                )
-            ],
-            DATE_REPLY: [
-                MessageHandler(
-                    Filters.regex('^(\d{2}){1,5}$') & ~(Filters.command),
-                    manual_date
-                ),
-                CommandHandler('date', manual_date)
-            ],
-            AMOUNT_REPLY: [
-                MessageHandler(
-                    Filters.regex('^\d*\.?\d{0,2}$') & ~(Filters.command),
-                    manual_amount
-                )
-            ],
-            PAYMENT_REPLY: [
-                MessageHandler(
-                    Filters.regex('^(Credit|Debit|PayPal|PayLah)$'),
-                    manual_payment
-                )
-            ],
-        },
+        states=manual_states,
         fallbacks=[
             CommandHandler('complete', manual_complete),
             CommandHandler('cancel', manual_cancel),
@@ -519,53 +1658,184 @@ def main() -> None:
     dispatcher.add_handler(manual_handler)
 
     # Handler for quickly adding a new expense
+    simple_states = reply_handlers({
+        PAYMENT_REPLY: simple_payment,
+        BOOLEAN_REPLY: simple_verified,
+    })
+    simple_states[IMAGE_REPLY] = [
+        MessageHandler(
+            Filters.photo,
+            simple_image
+        ),
+        MessageHandler(
+            Filters.regex('^Skip$'),
+            simple_complete
+        )
+    ]
     simple_handler = ConversationHandler(
+        name='simple',
+        persistent=True,
         entry_points=[CommandHandler('simple', simple_add)],
+        states=simple_states,
+        fallbacks=[
+            CommandHandler('complete', simple_complete),
+            CommandHandler('cancel', simple_cancel),
+            MessageHandler(Filters.text, simple_invalid)
+        ]
+    )
+    dispatcher.add_handler(simple_handler)
+
+    # Handler for simple help command
+    simple_help_handler = CommandHandler('simple_help', simple_help)
+    dispatcher.add_handler(simple_help_handler)
+
+    # Handlers for listing and searching expenses
+    dispatcher.add_handler(CommandHandler('list', list_expenses))
+    dispatcher.add_handler(CommandHandler('search', search_expenses))
+    dispatcher.add_handler(CommandHandler('find', find_expenses))
+    dispatcher.add_handler(CommandHandler('rebuild_search', rebuild_search))
+    dispatcher.add_handler(CallbackQueryHandler(page_expenses, pattern=r'^page\|'))
+    dispatcher.add_handler(CommandHandler('receipt', receipt))
+
+    # Handlers for verifying and correcting expenses
+    dispatcher.add_handler(CommandHandler('pending', pending_expenses))
+    dispatcher.add_handler(CommandHandler('verify', verify_expenses))
+    dispatcher.add_handler(CallbackQueryHandler(verify_shown, pattern=r'^verify\|'))
+    edit_handler = ConversationHandler(
+        entry_points=[CommandHandler('edit', edit_start)],
         states={
-            IMAGE_REPLY: [
-                MessageHandler(
-                    Filters.photo,
-                    simple_image
+            EDIT_REPLY: [
+                CallbackQueryHandler(
+                    edit_field,
+                    pattern=r'^edit\|'
                 ),
                 MessageHandler(
-                    Filters.regex('^Skip$'),
-                    simple_complete
-                )
-            ],
-            BOOLEAN_REPLY: [
-                MessageHandler(
-                    Filters.regex('^(Yes|No)$'),
-                    simple_verified
-                )
-            ],
-            CHOICES_REPLY: [
-                MessageHandler(
-                    Filters.regex('^$'),
-                    simple_text
+                    Filters.text & ~(Filters.command),
+                    edit_value
                 )
             ],
-            PAYMENT_REPLY: [
+        },
+        fallbacks=[
+            CommandHandler('cancel', edit_cancel)
+        ]
+    )
+    dispatcher.add_handler(edit_handler)
+
+    # Handler for importing expenses
+    import_handler = ConversationHandler(
+        name='import',
+        persistent=True,
+        entry_points=[CommandHandler('import', import_start)],
+        states={
+            DOCUMENT_REPLY: [
                 MessageHandler(
-                    Filters.regex('^(Credit|Debit|PayPal|PayLah)$'),
-                    simple_payment
+                    Filters.document,
+                    import_document,
+                    run_async=True
                 )
             ],
         },
         fallbacks=[
-            CommandHandler('complete', simple_complete),
-            CommandHandler('cancel', simple_cancel),
-            MessageHandler(Filters.text, simple_invalid)
+            CommandHandler('cancel', import_cancel)
         ]
     )
-    dispatcher.add_handler(simple_handler)
+    dispatcher.add_handler(import_handler)
 
-    # Handler for simple help command
-    simple_help_handler = CommandHandler('simple_help', simple_help)
-    dispatcher.add_handler(simple_help_handler)
+    # Handler for exporting expenses
+    dispatcher.add_handler(CommandHandler('export', export_expenses, run_async=True))
+
+    # Handlers for summaries
+    dispatcher.add_handler(CommandHandler('summary', summarise))
+    dispatcher.add_handler(CommandHandler('rebuild_summaries', rebuild_summaries))
+
+    # Handler for budgets
+    dispatcher.add_handler(CommandHandler('budget', budgets))
+
+    # Handlers for group ledgers
+    dispatcher.add_handler(CommandHandler('join', join_ledger))
+    dispatcher.add_handler(CommandHandler('split', split_expense))
+    dispatcher.add_handler(CommandHandler('balances', show_balances))
+    dispatcher.add_handler(CommandHandler('settle', settle_balances))
+    dispatcher.add_handler(CommandHandler('rebuild_balances', rebuild_balances))
 
-    updater.start_polling()
+    # Handler for digests
+    dispatcher.add_handler(CommandHandler('digest', schedule_digest))
 
-    updater.idle()
+    # Handler for archiving
+    dispatcher.add_handler(CommandHandler('archive', archive_now, run_async=True))
+
+    # Handler for reports
+    dispatcher.add_handler(CommandHandler('report', spending_report))
+
+    # Handler for profiling
+    dispatcher.add_handler(CommandHandler('profile', profile))
+
+def main() -> None:
+    # Initializes necessary processes
+    rates = exchange.Rates()
+    if os.path.exists(RATES):
+        rates.load(RATES)
+    registry = metrics.Registry()
+    database = db.Router(DBNAME, SHARDS, rates=rates, metrics=registry)
+    db.setup(database)
+    persistence = state.Persistence(database.main)
+    updater = Updater(token=TOKEN, persistence=persistence)
+    dispatcher = updater.dispatcher
+    dispatcher.job_queue.run_repeating(flush_state, interval=FLUSH_INTERVAL)
+    dispatcher.job_queue.run_repeating(send_digests, interval=DIGEST_INTERVAL)
+    dispatcher.job_queue.run_repeating(archive_expenses, interval=ARCHIVE_INTERVAL)
+    writer = db.Writers(database, JOURNAL)
+    writer.start()
+    images = image.Pipeline(database.main, IMAGES, metrics=registry)
+    reader = ocr.Reader(database.main)
+    dispatcher.bot_data['database'] = database
+    dispatcher.bot_data['writer'] = writer
+    dispatcher.bot_data['images'] = images
+    dispatcher.bot_data['ocr'] = reader
+    dispatcher.bot_data['analytics'] = analytics.Cache(database)
+    dispatcher.bot_data['budgets'] = budget.Budgets(database)
+    dispatcher.bot_data['ledger'] = ledger.Ledger(database)
+    dispatcher.bot_data['digests'] = digest.Scheduler(database, digest.TokenBucket(DIGEST_RATE, DIGEST_BURST), compose_digest)
+    dispatcher.bot_data['charts'] = charts = chart.Renderer(CHARTS)
+    dispatcher.bot_data['profiler'] = profiler = metrics.Profiler(PROFILE_INTERVAL)
+
+    register(dispatcher)
+    metrics.instrument(registry, dispatcher)
+    registry.collect(writer.collect)
+    registry.check(writer.health)
+    exporter = metrics.Exporter(registry, METRICS_LISTEN, METRICS_PORT, METRICS_SNAPSHOT or None, METRICS_INTERVAL)
+    exporter.start()
+
+    if MODE == 'webhook':
+        secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        server = webhook.Server(dispatcher, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_WORKERS, WEBHOOK_CAPACITY, secret)
+        registry.collect(server.collect)
+        server.start()
+        updater.bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=secret)
+        updater.job_queue.start()
+        # Starts the workers of asynchronous handlers
+        workers = threading.Thread(target=dispatcher.start, name='dispatcher')
+        workers.start()
+
+        server.idle()
+
+        updater.job_queue.stop()
+        server.stop()
+        dispatcher.stop()
+        workers.join()
+        persistence.flush()
+    else:
+        updater.start_polling()
+
+        updater.idle()
+
+    profiler.stop()
+    exporter.stop()
+    charts.stop()
+    reader.stop()
+    images.stop()
+    writer.stop()
+    database.close()
 
 #############
 # VARIABLES #
@@ -573,8 +1843,54 @@ def main() -> None:
 
 TOKEN = ""
 DBNAME = "expenses.db"
+SHARDS = 1
+JOURNAL = "expenses.journal"
+IMAGES = "receipts"
+CHARTS = "charts"
+RATES = "rates.csv"
+FLUSH_INTERVAL = 5
+
+MODE = "polling"
+WEBHOOK_URL = ""
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_WORKERS = 4
+WEBHOOK_CAPACITY = 256
+# A random secret is generated on every start if none is given
+WEBHOOK_SECRET = ""
+ADMINS = []
+
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 9464
+METRICS_SNAPSHOT = ""
+METRICS_INTERVAL = 60
+PROFILE = "profile.txt"
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 10
+
+MESSAGE_LIMIT = 4096
+PENDING_SIZE = 10
+SIMPLE_INFORMATION = ['description', 'amount', 'shop', 'location', 'purpose']
+EDITABLE = ['datetime', 'description', 'amount', 'shop', 'location', 'purpose', 'payment', 'verified']
+PERIOD_NAMES = {
+    'day': 'daily',
+    'week': 'weekly',
+    'month': 'monthly',
+    'year': 'yearly',
+}
+DIGEST_HOUR = 21
+DIGEST_INTERVAL = 60
+DIGEST_RATE = 25
+DIGEST_BURST = 5
+REPORT_MONTHS = 6
+REPORT_WINDOW = 7
+ARCHIVE_AGE = 730
+ARCHIVE_INTERVAL = 86400
+ARCHIVE_DRY_RUN = False
+RECEIPT_RETRIES = 5
+RECEIPT_RETRY_DELAY = 1
 
-IMAGE_REPLY, TEXT_REPLY, BOOLEAN_REPLY, CHOICES_REPLY, DATE_REPLY, AMOUNT_REPLY, PAYMENT_REPLY = range(7)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,270 @@
+import collections
+import threading
+
+from datetime import (
+    date,
+    timedelta,
+)
+from functools import (
+    lru_cache,
+)
+
+import ex_SQL as db
+
+class Budget:
+    """
+    Limits the spending of an owner over a period.
+    > A budget applies to every expense, or only to the expenses of one purpose or payment method.
+    > The amount spent in the current window is kept up to date as expenses are recorded.
+    > Amounts are converted to the home currency.
+    > The least amount spent reaching every alert threshold is computed once, so that checking an expense is a comparison.
+    """
+    __slots__ = ('period', 'field', 'value', 'amount', 'limits', 'lowest', 'highest', 'window', 'spent')
+
+    def __init__(self, period, field, value, amount):
+        self.period = period
+        self.field = field
+        self.value = value
+        self.amount = amount
+        self.limits = [(-(-threshold * amount // 100), threshold) for threshold in THRESHOLDS]
+        self.lowest = self.limits[0][0]
+        self.highest = self.limits[-1][0]
+        self.window = ''
+        self.spent = 0
+
+    def add(self, window, amount) -> tuple:
+        """
+        Adds an amount spent in a window.
+        > Amounts from earlier windows are ignored.
+        > Amounts from a later window start a new window.
+        Returns the amount spent before and after, or None if the amount was ignored.
+        """
+        if window < self.window:
+            return None
+        if window > self.window:
+            self.window = window
+            self.spent = 0
+        before = self.spent
+        self.spent += amount
+        return before, self.spent
+
+    def subtract(self, window, amount) -> None:
+        """
+        Removes an amount spent in a window, if the window is the current one.
+        """
+        if window == self.window:
+            self.spent -= amount
+
+    def crossed(self, before, after) -> list:
+        """
+        Returns the alert thresholds crossed between two amounts spent.
+        """
+        if before >= self.highest or after < self.lowest:
+            return []
+        return [threshold for limit, threshold in self.limits if before < limit <= after]
+
+class Budgets:
+    """
+    Keeps the budgets of every owner and the amount spent in their current windows.
+    > The budgets of an owner and their spending are loaded from the database on first use.
+    > Recording an expense only updates the budgets it matches.
+    > The budgets matching every purpose and payment method of an owner are looked up once and kept until the budgets change.
+    """
+    def __init__(self, database):
+        self.database = database
+        self.owners = {}
+        self.matched = {}
+        self.lock = threading.Lock()
+
+    def load(self, owner) -> dict:
+        """
+        Returns the budgets of an owner indexed by (field, value).
+        """
+        budgets = self.owners.get(owner)
+        if budgets is not None:
+            return budgets
+
+        budgets = collections.defaultdict(list)
+        today = date.today().strftime('%Y-%m-%d')
+        for period, field, value, amount in self.database.shard(owner).fetch(
+            'SELECT period, field, value, amount FROM budgets WHERE owner = ?', (owner,)
+        ):
+            budget = Budget(period, field, value, amount)
+            budget.add(window(period, today), spent(self.database, owner, budget, window(period, today)))
+            budgets[(field, value)].append(budget)
+
+        with self.lock:
+            if owner not in self.owners:
+                self.owners[owner] = budgets
+                self.matched[owner] = {}
+            return self.owners[owner]
+
+    def invalidate(self, owner) -> None:
+        """
+        Discards the budgets of an owner so that they are reloaded on next use.
+        """
+        with self.lock:
+            self.owners.pop(owner, None)
+            self.matched.pop(owner, None)
+
+    def set(self, owner, period, field, value, amount) -> None:
+        """
+        Adds or replaces a budget.
+        """
+        self.database.shard(owner).execute(
+            'INSERT OR REPLACE INTO budgets VALUES (?,?,?,?,?)', (owner, period, field, value, amount)
+        )
+        self.invalidate(owner)
+
+    def remove(self, owner, period, field, value) -> bool:
+        """
+        Removes a budget.
+        Returns False if there was no such budget.
+        """
+        conn = self.database.shard(owner).connection()
+        with conn:
+            removed = conn.execute(
+                'DELETE FROM budgets WHERE owner = ? AND period = ? AND field = ? AND value = ?', (owner, period, field, value)
+            ).rowcount
+        self.invalidate(owner)
+        return bool(removed)
+
+    def record(self, row) -> list:
+        """
+        Adds a database row to the budgets it matches.
+        Returns a (budget, threshold) pair for every budget whose alert threshold the row crossed.
+        > Only the highest threshold crossed is returned.
+        """
+        budgets = self.load(row[0]) if isinstance(row[4], int) and row[2] else None
+        if not budgets:
+            return []
+
+        amount = self.database.rates.convert(row[4], row[10], row[2])
+        day = row[2][:10]
+        alerts = []
+        with self.lock:
+            # Budgets invalidated since they were loaded are updated without caching their matches
+            matched = self.matched[row[0]] if self.owners.get(row[0]) is budgets else {}
+            group = matched.get((row[7], row[8]))
+            if group is None:
+                if len(matched) >= MAXIMUM_MATCHED:
+                    matched.clear()
+                group = matched[(row[7], row[8])] = periods(matching(budgets, row))
+            for period, members in group:
+                current = window(period, day)
+                for budget in members:
+                    if current == budget.window:
+                        before = budget.spent
+                        budget.spent = after = before + amount
+                    else:
+                        spending = budget.add(current, amount)
+                        if spending is None:
+                            continue
+                        before, after = spending
+                    if before < budget.highest and after >= budget.lowest:
+                        crossed = budget.crossed(before, after)
+                        if crossed:
+                            alerts.append((budget, crossed[-1]))
+        return alerts
+
+    def amend(self, before, after) -> list:
+        """
+        Moves a changed database row between the budgets it matches, without reloading them.
+        Returns the alerts crossed by the change, compared with the spending before the change.
+        """
+        if [before[i] for i in (2, 4, 7, 8, 10)] == [after[i] for i in (2, 4, 7, 8, 10)]:
+            return []
+        removed = self.database.rates.convert(before[4], before[10], before[2])
+        added = self.database.rates.convert(after[4], after[10], after[2])
+        with self.lock:
+            budgets = self.owners.get(before[0])
+            if budgets is None:
+                return []
+
+            previous = {}
+            if isinstance(before[4], int) and before[2]:
+                for budget in matching(budgets, before):
+                    previous[budget] = (budget.window, budget.spent)
+                    budget.subtract(window(budget.period, before[2][:10]), removed)
+
+            alerts = []
+            if isinstance(after[4], int) and after[2]:
+                for budget in matching(budgets, after):
+                    spending = budget.add(window(budget.period, after[2][:10]), added)
+                    if spending and previous.get(budget, ('',))[0] == budget.window:
+                        spending = (previous[budget][1], spending[1])
+                    crossed = budget.crossed(*spending) if spending else None
+                    if crossed:
+                        alerts.append((budget, crossed[-1]))
+        return alerts
+
+    def status(self, owner, today) -> list:
+        """
+        Returns every budget of an owner with the amount spent in the window containing today.
+        """
+        budgets = self.load(owner)
+        with self.lock:
+            return sorted(
+                (
+                    (budget, budget.spent if budget.window == window(budget.period, today) else 0)
+                    for group in budgets.values() for budget in group
+                ),
+                key=lambda item: (PERIODS.index(item[0].period), item[0].field, item[0].value)
+            )
+
+def matching(budgets, row):
+    """
+    Yields the budgets which apply to a database row.
+    """
+    for key in (('', ''), ('purpose', row[7]), ('payment', row[8])):
+        yield from budgets.get(key, ())
+
+def periods(budgets) -> tuple:
+    """
+    Groups budgets by period, so that the window of an expense is found once per period.
+    """
+    grouped = collections.defaultdict(list)
+    for budget in budgets:
+        grouped[budget.period].append(budget)
+    return tuple((period, tuple(members)) for period, members in grouped.items())
+
+@lru_cache(maxsize=4096)
+def window(period, dt) -> str:
+    """
+    Returns the window of a period containing a date or datetime string, matching the summary buckets.
+    """
+    if period == 'week':
+        day = date(int(dt[0:4]), int(dt[5:7]), int(dt[8:10]))
+        return (day - timedelta(days=day.weekday())).strftime('%Y-%m-%d')
+    return dt[:WINDOW_LENGTHS[period]]
+
+def spent(database, owner, budget, current) -> int:
+    """
+    Sums the expenses of an owner matching a budget in a window.
+    """
+    statement = (
+        'SELECT coalesce(SUM({}), 0) FROM expenses '
+        'WHERE owner = ? AND dt >= ? AND {} = ?'.format(db.HOME.format('expenses'), db.GRAINS[budget.period].format('expenses'))
+    )
+    values = [owner, current, current]
+    if budget.field:
+        statement += ' AND {} = ?'.format(budget.field)
+        values.append(budget.value)
+    return database.shard(owner).fetch(statement, values)[0][0]
+
+#############
+# VARIABLES #
+#############
+
+PERIODS = ['day', 'week', 'month', 'year']
+FIELDS = ['purpose', 'payment']
+THRESHOLDS = [80, 100]
+
+# Purposes are free text, so the matches cached for an owner are bounded
+MAXIMUM_MATCHED = 256
+
+WINDOW_LENGTHS = {
+    'day': 10,
+    'month': 7,
+    'year': 4,
+}
@@ -1,26 +1,176 @@
+import re
+
+from datetime import (
+    datetime,
+)
+from decimal import (
+    Decimal,
+    InvalidOperation,
+)
 from telegram import (
+    ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
 )
 
 class Information:
-    empty = ()
-    previous = None
+    """
+    Describes a field of an expense.
+    > column and type define its column in the database.
+    > auto fields are filled by the bot instead of being requested.
+    > required fields must be filled before a transaction is completed.
+    > message, keyboard and state define how the field is requested, and pattern the replies accepted in that state.
+    > function validates a reply and converts it to the stored value.
+    The index and bit of a field are set when its schema is compiled.
+    """
+    __slots__ = ('name', 'column', 'type', 'auto', 'required', 'message', 'function', 'state', 'pattern', 'keyboard', 'index', 'bit')
 
-    def __init__(self, name, auto=False, message=None, function=None, state=None, keyboard=ReplyKeyboardRemove(), next=empty):
+    def __init__(self, name, column=None, type='text', auto=False, required=False, message=None, function=None, state=None, pattern=None, keyboard=ReplyKeyboardRemove()):
         self.name = name
+        self.column = column or name
+        self.type = type
         self.auto = auto
+        self.required = required
         self.message = message
         self.function = function
         self.state = state
+        self.pattern = pattern
         self.keyboard = keyboard
-        self.next = next
-        if Information.previous:
-            Information.previous.next = self
-        Information.previous = self
+        self.index = None
+        self.bit = 0
+
+class Schema:
+    """
+    Compiles a declarative list of fields once, when it is defined.
+    > The DDL of the table storing the fields.
+    > The validator of every field which has one.
+    > The pattern of the replies accepted in every conversation state.
+    > The next field to request for every mask of filled fields to request, so that progressing a conversation is a single lookup.
+    """
+    def __init__(self, table, fields):
+        self.table = table
+        self.fields = {}
+        for index, field in enumerate(fields):
+            field.index = index
+            field.bit = 1 << index
+            self.fields[field.name] = field
+
+        self.columns = [field.column for field in fields]
+        self.create = 'CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            table, ', '.join('{} {}'.format(field.column, field.type) for field in fields)
+        )
+        self.validators = {field.name: field.function for field in fields if field.function}
+        self.required = sum(field.bit for field in fields if field.required)
+
+        self.states = {}
+        for field in fields:
+            if field.state is not None and self.states.setdefault(field.state, field.pattern) != field.pattern:
+                raise ValueError('fields of state {} accept different replies'.format(field.state))
+
+        # Automatic fields never change the next field, so the table is indexed by the filled mask of the requested fields only
+        self.requested = sum(field.bit for field in fields if not field.auto)
+        self.missing = {}
+        subset = self.requested
+        while True:
+            unset = self.requested & ~subset
+            self.missing[subset] = fields[(unset & -unset).bit_length() - 1] if unset else None
+            if not subset:
+                break
+            subset = (subset - 1) & self.requested
+
+    def mask(self, data) -> int:
+        """
+        Returns the mask of the fields present in data.
+        """
+        return sum(field.bit for name, field in self.fields.items() if name in data)
+
+    def values(self, data) -> tuple:
+        """
+        Builds a database row from the fields in data.
+        """
+        return tuple([data.get(name, '') for name in self.fields])
 
 class InputError(Exception):
     pass
 
+#############################
+# DATA VALIDATION AND INPUT #
+#############################
+
+def text_input(message) -> str:
+    """
+    Handles text input.
+    """
+    return message
+
+def date_input(message) -> datetime:
+    """
+    Validates the current date input.
+    Date inputs are of the format '%y%m%d%H%M'.
+    Pads the date input with as many zeroes as necessary to form a valid input.
+    Returns the validated and padded date input.
+    """
+    format = ''.join(['%y', '%m', '%d', '%H', '%M'][0:len(message)//2])
+    try:
+        date = datetime.strptime(message, format)
+    except ValueError:
+        raise InputError
+
+    return date.strftime('%Y-%m-%d %H:%M:%S')
+
+def minor_units(amount, currency) -> int:
+    """
+    Converts a decimal amount to integer minor units of a currency, exactly.
+    Raises an InputError if the amount has more decimal places than the currency.
+    """
+    units = amount.scaleb(CURRENCIES[currency])
+    if units != units.to_integral_value():
+        raise InputError
+    return int(units)
+
+def amount_input(message) -> int:
+    """
+    Verifies the regex format of the message.
+    Converts the amount received in the home currency to cents.
+    The amount is parsed as a decimal so that no rounding occurs.
+    """
+    if not re.match(AMOUNT_PATTERN, message):
+        raise InputError
+    try:
+        return minor_units(Decimal(message), HOME_CURRENCY)
+    except InvalidOperation:
+        raise InputError
+
+def money_input(message) -> dict:
+    """
+    Verifies an amount optionally preceded or followed by a currency code, e.g. '12.50 USD' or 'JPY 1200'.
+    > Amounts without a currency code are in the home currency.
+    Returns the amount in integer minor units of its currency and the currency.
+    """
+    match = re.match(MONEY_PATTERN, message.strip())
+    if not match:
+        raise InputError
+    before, amount, after = match.groups()
+    if before and after:
+        raise InputError
+    currency = (before or after or HOME_CURRENCY).upper()
+    if currency not in CURRENCIES:
+        raise InputError
+    try:
+        return {'amount': minor_units(Decimal(amount), currency), 'currency': currency}
+    except InvalidOperation:
+        raise InputError
+
+def boolean_input(message) -> bool:
+    """
+    Converts 'Yes' to TRUE and 'No' to False.
+    """
+    if message == 'Yes':
+        return True
+    if message == 'No':
+        return False
+
+IMAGE_REPLY, TEXT_REPLY, BOOLEAN_REPLY, CHOICES_REPLY, DATE_REPLY, AMOUNT_REPLY, PAYMENT_REPLY, DOCUMENT_REPLY, EDIT_REPLY = range(9)
+
 KEYBOARDS = {
     'payment': ReplyKeyboardMarkup([
         ['Credit', 'Debit'],
@@ -34,43 +184,78 @@ KEYBOARDS = {
     ], resize_keyboard=True, one_time_keyboard=True)
 }
 
-EXPECTED_INFORMATION = {
-    'owner': Information('owner', auto=True),
-    'updateid': Information('updateid', auto=True),
-    'datetime': Information('datetime',
+PAYMENTS = ['Credit', 'Debit', 'PayPal', 'PayLah']
+AMOUNT_PATTERN = r'^\d*\.?\d{0,2}$'
+MONEY_PATTERN = r'^(?:([A-Za-z]{3}) ?)?(\d*\.?\d{0,2})(?: ?([A-Za-z]{3}))?$'
+
+HOME_CURRENCY = 'SGD'
+
+CURRENCIES = {
+    'AUD': 2,
+    'CNY': 2,
+    'EUR': 2,
+    'GBP': 2,
+    'HKD': 2,
+    'IDR': 2,
+    'INR': 2,
+    'JPY': 0,
+    'KRW': 0,
+    'MYR': 2,
+    'PHP': 2,
+    'SGD': 2,
+    'THB': 2,
+    'TWD': 2,
+    'USD': 2,
+    'VND': 0,
+}
+
+SCHEMA = Schema('expenses', [
+    Information('owner', type='string', auto=True),
+    Information('updateid', type='integer', auto=True),
+    Information('datetime', column='dt', type='datetime', required=True,
         message="Please input the date and time of the transaction in the format YYMMDDHHMM. Automatic input can be selected using the command /date.",
         function=date_input,
-        state=DATE_REPLY),
-    'description': Information('description',
+        state=DATE_REPLY,
+        pattern=r'^(\d{2}){1,5}$'),
+    Information('description', required=True,
         message="Please input the description of the item.",
         function=text_input,
         state=TEXT_REPLY),
-    'amount': Information('amount',
-        message="Please input the amount of the transaction in SGD.",
-        function=amount_input,
-        state=AMOUNT_REPLY),
-    'shop': Information('shop',
+    Information('amount', type='integer', required=True,
+        message="Please input the amount of the transaction in SGD, or follow it with a currency code such as 12.50 USD.",
+        function=money_input,
+        state=AMOUNT_REPLY,
+        pattern=MONEY_PATTERN),
+    Information('shop', type='string',
         message="Please input the shop where the transaction occurred. Conclude the transaction at any time using the command /complete.",
         function=text_input,
         state=TEXT_REPLY),
-    'location': Information('location',
+    Information('location', type='string',
         message="Please input the location of the transaction.",
         function=text_input,
         state=TEXT_REPLY),
-    'purpose': Information('purpose',
+    Information('purpose',
         message="Please input the purpose of the transaction.",
         function=text_input,
         state=TEXT_REPLY),
-    'payment': Information('payment',
+    Information('payment', type='string',
         message="Please select the payment method.",
         state=PAYMENT_REPLY,
+        pattern='^({})$'.format('|'.join(PAYMENTS)),
         keyboard=KEYBOARDS['payment']),
-    'verified': Information('verified',
+    Information('verified', type='string',
         message="Please select if the payment has been verified.",
         state=BOOLEAN_REPLY,
-        keyboard=KEYBOARDS['verified'])
-}
+        pattern='^(Yes|No)$',
+        keyboard=KEYBOARDS['verified']),
+    Information('currency', type='string', auto=True),
+    Information('payer', type='integer', auto=True),
+    Information('shares', type='text', auto=True),
+])
+
+EXPECTED_INFORMATION = SCHEMA.fields
 
 AUTOMATIC_VERIFIED = {
     'Debit': 'No', 'PayPal': 'No', 'PayLah': 'No'
 }
+
@@ -0,0 +1,127 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+)
+
+from ex_BUILTINS import (
+    HOME_CURRENCY,
+)
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+except ImportError:
+    matplotlib = None
+
+logger = logging.getLogger(__name__)
+
+class Renderer:
+    """
+    Renders report charts to PNG files in a process pool.
+    > Charts are cached on disk by owner, chart parameters and data version.
+    > The least recently used charts are removed once the cache exceeds capacity bytes.
+    Charts left by a previous run are removed on start, since data versions restart with the process.
+    """
+    def __init__(self, directory, processes=2, capacity=64 * 2 ** 20):
+        self.directory = directory
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.processes = ProcessPoolExecutor(max_workers=processes) if matplotlib else None
+
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(SUFFIX) or name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+
+    def chart(self, owner, kind, params, version, title, labels, values) -> Future:
+        """
+        Returns a future resolving to the path of a chart.
+        > Cached charts are returned immediately.
+        > Concurrent requests for the same chart share a single rendering.
+        """
+        key = hashlib.sha256(json.dumps([owner, kind, params, version]).encode()).hexdigest()
+        path = os.path.join(self.directory, key + SUFFIX)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                future = Future()
+                future.set_result(path)
+                return future
+            if key in self.pending:
+                return self.pending[key]
+            future = Future()
+            self.pending[key] = future
+
+        rendering = self.processes.submit(render, path, kind, title, labels, values)
+        rendering.add_done_callback(lambda done: self.rendered(key, path, future, done))
+        return future
+
+    def rendered(self, key, path, future, done) -> None:
+        """
+        Records a rendered chart and evicts the least recently used charts beyond capacity.
+        """
+        with self.lock:
+            del self.pending[key]
+            if done.exception() is not None:
+                logger.error('Failed to render chart %s', key, exc_info=done.exception())
+                future.set_exception(done.exception())
+                return
+            self.entries[key] = done.result()
+            self.size += done.result()
+            while self.size > self.capacity and len(self.entries) > 1:
+                evicted, size = self.entries.popitem(last=False)
+                self.size -= size
+                os.remove(os.path.join(self.directory, evicted + SUFFIX))
+        future.set_result(path)
+
+    def stop(self) -> None:
+        """
+        Waits for every queued chart to be rendered.
+        """
+        if self.processes:
+            self.processes.shutdown(wait=True)
+
+def render(path, kind, title, labels, values) -> int:
+    """
+    Renders a bar or pie chart of amounts in the home currency to a PNG file.
+    Returns the size of the file.
+    """
+    figure = Figure(figsize=FIGURE_SIZE, dpi=FIGURE_DPI)
+    canvas = FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    if kind == 'pie':
+        axes.pie(values, labels=labels, autopct='%1.0f%%', startangle=90, counterclock=False)
+        axes.axis('equal')
+    else:
+        axes.bar(range(len(values)), values, tick_label=labels)
+        axes.set_ylabel(HOME_CURRENCY)
+        axes.tick_params(axis='x', labelrotation=45)
+    axes.set_title(title)
+    figure.tight_layout()
+
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as file:
+        canvas.print_png(file)
+    os.replace(temporary, path)
+    return os.path.getsize(path)
+
+#############
+# VARIABLES #
+#############
+
+SUFFIX = '.png'
+KINDS = ['bar', 'pie']
+FIGURE_SIZE = (8, 4.5)
+FIGURE_DPI = 100
@@ -0,0 +1,129 @@
+import bisect
+import csv
+import logging
+import threading
+
+from decimal import (
+    Decimal,
+    InvalidOperation,
+)
+
+from ex_BUILTINS import (
+    InputError,
+    CURRENCIES,
+    HOME_CURRENCY,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+class Rates:
+    """
+    Converts amounts to the home currency with exchange rates loaded from a local file.
+    > The rate of a date is the latest rate on or before it, or the earliest rate for dates before any rate.
+    > Conversion factors are memoized by (currency, date).
+    Amounts in the home currency, or without a currency, are never converted.
+    Amounts in currencies without any rate are rejected when they are entered or imported, see known.
+    > Should one still be converted, it converts to 0 and the currency is logged once.
+    """
+    def __init__(self, home=HOME_CURRENCY):
+        self.home = home
+        self.dates = {}
+        self.rates = {}
+        self.factors = {}
+        self.unknown = set()
+        self.lock = threading.Lock()
+
+    def load(self, path) -> int:
+        """
+        Loads a CSV file of date, currency and rate columns, replacing every rate loaded before.
+        > Dates are of the format YYYY-MM-DD.
+        > Rates are the amount of home currency bought by one unit of the currency.
+        Returns the number of rates loaded.
+        """
+        table = {}
+        with open(path, newline='', encoding='utf-8') as file:
+            for number, record in enumerate(csv.DictReader(file), 2):
+                currency = record['currency'].strip().upper()
+                try:
+                    if currency not in CURRENCIES:
+                        raise InputError
+                    table.setdefault(currency, {})[record['date'].strip()[:10]] = Decimal(record['rate'])
+                except (InputError, InvalidOperation):
+                    raise InputError('invalid rate on line {}'.format(number))
+
+        with self.lock:
+            self.dates = {currency: sorted(rates) for currency, rates in table.items()}
+            self.rates = {currency: [rates[date] for date in self.dates[currency]] for currency, rates in table.items()}
+            self.factors = {}
+            self.unknown = set()
+        return sum(len(rates) for rates in table.values())
+
+    def known(self, currency) -> bool:
+        """
+        Returns whether amounts in a currency can be converted, i.e. it is the home currency or it has a rate.
+        """
+        return not currency or currency == self.home or bool(self.dates.get(currency))
+
+    def factor(self, currency, date) -> float:
+        """
+        Returns the factor converting minor units of a currency on a date to minor units of the home currency.
+        """
+        if not currency or currency == self.home:
+            return 1.0
+        key = (currency, date[:10])
+        factor = self.factors.get(key)
+        if factor is not None:
+            return factor
+
+        with self.lock:
+            dates = self.dates.get(currency)
+            if not dates:
+                if currency not in self.unknown:
+                    self.unknown.add(currency)
+                    logger.warning('No exchange rate for %s, its amounts are converted to 0', currency)
+                factor = 0.0
+            else:
+                index = max(bisect.bisect_right(dates, key[1]) - 1, 0)
+                factor = float(self.rates[currency][index].scaleb(CURRENCIES[self.home] - CURRENCIES.get(currency, 2)))
+            self.factors[key] = factor
+        return factor
+
+    def convert(self, amount, currency, date) -> int:
+        """
+        Converts an amount in minor units of a currency on a date to minor units of the home currency.
+        Amounts which are not integers are left as they are.
+        """
+        if not isinstance(amount, int) or not currency or currency == self.home:
+            return amount
+        return int(round(amount * self.factor(currency, date or '')))
+
+    def convert_many(self, amounts, currencies, days) -> 'np.ndarray':
+        """
+        Converts arrays of amounts at once.
+        > currencies is a (labels, codes) pair of currency columns.
+        > days is an array of datetime64 days.
+        Every distinct (currency, day) pair is looked up once.
+        """
+        labels, codes = currencies
+        foreign = np.array([bool(label) and label != self.home for label in labels], dtype=bool)
+        if not foreign[codes].any():
+            return amounts
+
+        days = days.astype(np.int64)
+        pairs, inverse = np.unique(codes * DAY_SPAN + (days - days.min()), return_inverse=True)
+        first = np.datetime64(int(days.min()), 'D')
+        factors = np.array([
+            self.factor(str(labels[pair // DAY_SPAN]), str(first + int(pair % DAY_SPAN))) for pair in pairs
+        ])
+        return np.rint(amounts * factors[inverse.reshape(-1)]).astype(np.int64)
+
+#############
+# VARIABLES #
+#############
+
+DAY_SPAN = 1 << 24
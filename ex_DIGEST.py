@@ -0,0 +1,191 @@
+import logging
+import threading
+import time
+
+from datetime import (
+    datetime,
+    timedelta,
+)
+from telegram.error import (
+    RetryAfter,
+    TelegramError,
+)
+
+import ex_SQL as db
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """
+    Paces outbound messages below a sustained rate.
+    > Up to capacity messages may be sent at once after a quiet period.
+    > Acquiring a token blocks until one is available.
+    The clock and sleep functions can be replaced to simulate time.
+    """
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Takes a token, waiting for the bucket to refill if it is empty.
+        > A token taken from an empty bucket is paid back by the time refilled while waiting.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            if self.tokens < 0:
+                self.sleep(-self.tokens / self.rate)
+
+class Scheduler:
+    """
+    Sends every owner with a schedule a digest of their spending and unverified transactions.
+    > Schedules are stored in the main database and survive restarts.
+    > Every run reads the due owners in batches, with one query for their totals and one for their unverified transactions.
+    > Messages are paced by a token bucket.
+    Runs missed while the bot was down are sent once, not once per missed period.
+    """
+    def __init__(self, database, bucket, compose, clock=datetime.now, limit=10, batch_size=500):
+        self.database = database
+        self.bucket = bucket
+        self.compose = compose
+        self.clock = clock
+        self.limit = limit
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+
+    def set(self, owner, frequency, hour) -> datetime:
+        """
+        Schedules the digest of an owner.
+        Returns the time of the next digest.
+        """
+        due = next_run(frequency, hour, self.clock())
+        self.database.main.execute(
+            'INSERT OR REPLACE INTO schedules VALUES (?,?,?,?)', (owner, frequency, hour, due.strftime(DATE_FORMAT))
+        )
+        return due
+
+    def remove(self, owner) -> None:
+        """
+        Stops the digest of an owner.
+        """
+        self.database.main.execute('DELETE FROM schedules WHERE owner = ?', (owner,))
+
+    def get(self, owner) -> tuple:
+        """
+        Returns the frequency, hour and next run of the digest of an owner, or None.
+        """
+        rows = self.database.main.fetch('SELECT frequency, hour, next FROM schedules WHERE owner = ?', (owner,))
+        return rows[0] if rows else None
+
+    def run(self, bot) -> int:
+        """
+        Sends the digests of every owner due at the current time.
+        Returns the number of digests sent.
+        """
+        sent = 0
+        while True:
+            with self.lock:
+                now = self.clock()
+                due = self.database.main.fetch(
+                    'SELECT owner, frequency, hour FROM schedules WHERE next <= ? LIMIT ?',
+                    (now.strftime(DATE_FORMAT), self.batch_size)
+                )
+                if not due:
+                    return sent
+
+                totals, pending = self.collect({owner: GRAINS[frequency] for owner, frequency, _ in due}, now)
+                self.database.main.executemany(
+                    'UPDATE schedules SET next = ? WHERE owner = ?',
+                    [(next_run(frequency, hour, now).strftime(DATE_FORMAT), owner) for owner, frequency, hour in due]
+                )
+
+            for owner, frequency, _ in due:
+                text = self.compose(frequency, totals.get(owner, (0, 0)), *pending.get(owner, ([], 0)))
+                if text and self.send(bot, owner, text):
+                    sent += 1
+
+    def collect(self, owners, now) -> tuple:
+        """
+        Reads the totals of the current period and the latest unverified transactions of the owners.
+        > Owners are read with one query of each kind on every shard storing any of them.
+        Returns the (total, count) of every owner with any spending.
+        Returns the latest unverified rows and the number of unverified rows of every owner with any.
+        > Rows whose verified status was never answered are unverified too.
+        """
+        totals = {}
+        pending = {}
+        for shard, group in self.database.partition(owners):
+            due = ','.join(['(?,?,?)'] * len(group))
+            values = [value for owner in group for value in (owner, owners[owner], db.bucket(owners[owner], now))]
+            totals.update(
+                (owner, (total, count)) for owner, total, count in shard.fetch(
+                    'WITH due (owner, grain, bucket) AS (VALUES {}) '
+                    'SELECT summaries.owner, SUM(total), SUM(count) FROM summaries JOIN due USING (owner, grain, bucket) '
+                    'GROUP BY summaries.owner'.format(due), values
+                )
+            )
+
+            for row in shard.fetch(
+                'SELECT * FROM (SELECT {}, row_number() OVER latest AS position, COUNT(*) OVER (PARTITION BY owner) '
+                'FROM expenses WHERE {} AND owner IN ({}) WINDOW latest AS (PARTITION BY owner ORDER BY dt DESC)) '
+                'WHERE position <= ? ORDER BY owner, position'.format(', '.join(db.COLUMNS), db.UNVERIFIED, ','.join('?' * len(group))),
+                group + [self.limit]
+            ):
+                rows, count = pending.setdefault(row[0], ([], row[-1]))
+                rows.append(row[:-2])
+        return totals, pending
+
+    def send(self, bot, owner, text) -> bool:
+        """
+        Sends a digest once a token is available, waiting once if Telegram asks to retry later.
+        Returns False if the digest could not be sent.
+        """
+        for attempt in range(2):
+            self.bucket.acquire()
+            try:
+                bot.send_message(owner, text)
+                return True
+            except RetryAfter as error:
+                if attempt:
+                    logger.warning('Failed to send the digest of %s: %s', owner, error)
+                    return False
+                self.bucket.sleep(error.retry_after)
+            except TelegramError as error:
+                logger.warning('Failed to send the digest of %s: %s', owner, error)
+                return False
+
+def next_run(frequency, hour, now) -> datetime:
+    """
+    Returns the first time after now at which a digest is due.
+    > Daily digests are due every day at hour.
+    > Weekly digests are due every Sunday at hour.
+    """
+    due = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if frequency == 'weekly':
+        due += timedelta(days=6 - due.weekday())
+    while due <= now:
+        due += timedelta(days=FREQUENCIES[frequency])
+    return due
+
+#############
+# VARIABLES #
+#############
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+FREQUENCIES = {
+    'daily': 1,
+    'weekly': 7,
+}
+
+GRAINS = {
+    'daily': 'day',
+    'weekly': 'week',
+}
@@ -0,0 +1,190 @@
+import argparse
+import csv
+import itertools
+import json
+
+from decimal import (
+    Decimal,
+)
+
+import ex_QUERY as query
+import ex_SQL as db
+
+from ex_BUILTINS import (
+    InputError,
+    EXPECTED_INFORMATION,
+    CURRENCIES,
+    HOME_CURRENCY,
+)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+def iterate(database, filter, size=None):
+    """
+    Streams the expenses matching the filter in chunks of at most size rows.
+    The expenses of owners on different shards are merged in the order of the filter.
+    """
+    rows = query.merge([stream(shard, part) for shard, part in query.partition(database, filter)], filter.order)
+    while True:
+        chunk = list(itertools.islice(rows, size or CHUNK_SIZE))
+        if not chunk:
+            return
+        yield chunk
+
+def stream(database, filter):
+    """
+    Streams the expenses of a single database matching the filter, one row at a time.
+    """
+    conn = database.history() if query.archived(filter) else database.connection()
+    cursor = conn.execute(*query.statement(filter))
+    try:
+        while True:
+            rows = cursor.fetchmany(CHUNK_SIZE)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        cursor.close()
+
+def amount_text(amount, currency=None) -> str:
+    """
+    Converts an amount in integer minor units of a currency to an exact decimal string.
+    """
+    if not isinstance(amount, int):
+        return ''
+    return str(Decimal(amount).scaleb(-CURRENCIES.get(currency or HOME_CURRENCY, 2)))
+
+def verified_text(verified) -> str:
+    """
+    Converts a verified status to 'Yes', 'No' or an empty string.
+    """
+    if verified == '' or verified is None:
+        return ''
+    return 'Yes' if verified else 'No'
+
+def records(rows):
+    """
+    Converts database rows into lists of exported values in COLUMNS order.
+    The owner is left out.
+    Amounts without a currency are given the home currency.
+    """
+    for row in rows:
+        values = list(row[1:])
+        values[CURRENCY] = values[CURRENCY] or HOME_CURRENCY
+        values[AMOUNT] = amount_text(values[AMOUNT], values[CURRENCY])
+        values[VERIFIED] = verified_text(values[VERIFIED])
+        yield values
+
+def write_csv(chunks, file) -> int:
+    """
+    Writes every chunk to a CSV file with a header row.
+    """
+    writer = csv.writer(file)
+    writer.writerow(COLUMNS)
+    count = 0
+    for rows in chunks:
+        writer.writerows(records(rows))
+        count += len(rows)
+    return count
+
+def write_jsonl(chunks, file) -> int:
+    """
+    Writes every row to a JSON Lines file as an object.
+    """
+    count = 0
+    for rows in chunks:
+        for values in records(rows):
+            file.write(json.dumps(dict(zip(COLUMNS, values))) + '\n')
+        count += len(rows)
+    return count
+
+def write_parquet(chunks, path) -> int:
+    """
+    Writes every chunk as one row group of a Parquet file.
+    Amounts are stored as decimals with two places.
+    Requires pyarrow.
+    """
+    if pyarrow is None:
+        raise InputError('pyarrow is required for Parquet exports')
+
+    types = {'updateid': pyarrow.int64(), 'amount': pyarrow.decimal128(18, 2)}
+    schema = pyarrow.schema([(name, types.get(name, pyarrow.string())) for name in COLUMNS])
+    count = 0
+    with pyarrow.parquet.ParquetWriter(path, schema, compression='zstd') as writer:
+        for rows in chunks:
+            columns = list(zip(*records(rows)))
+            arrays = []
+            for name, values in zip(COLUMNS, columns):
+                if name == 'amount':
+                    values = [Decimal(value) if value else None for value in values]
+                elif name != 'updateid':
+                    values = ['' if value is None else str(value) for value in values]
+                arrays.append(pyarrow.array(values, types.get(name, pyarrow.string())))
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            count += len(rows)
+    return count
+
+def export(database, filter, path, format) -> int:
+    """
+    Exports the expenses matching the filter to a CSV, JSON Lines or Parquet file.
+    Rows are streamed from the database in fixed size chunks.
+    Returns the number of exported rows.
+    """
+    chunks = iterate(database, filter)
+    if format == 'parquet':
+        return write_parquet(chunks, path)
+    if format not in FORMATS:
+        raise InputError('unsupported format')
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        return FORMATS[format](chunks, file)
+
+########
+# MAIN #
+########
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Exports expenses to a CSV, JSON Lines or Parquet file.')
+    parser.add_argument('path')
+    parser.add_argument('--owner', type=int, action='append', required=True)
+    parser.add_argument('--format', choices=sorted(list(FORMATS) + ['parquet']), default='csv')
+    parser.add_argument('--period', choices=query.PERIODS, default='all')
+    parser.add_argument('--payment')
+    parser.add_argument('--verified', choices=['yes', 'no'])
+    parser.add_argument('--db', default='expenses.db')
+    parser.add_argument('--shards', type=int, default=1)
+    args = parser.parse_args()
+
+    verified = None if args.verified is None else args.verified == 'yes'
+    filter = query.Filter(args.owner, period=args.period, payment=args.payment, verified=verified)
+    database = db.Router(args.db, args.shards)
+    try:
+        count = export(database, filter, args.path, args.format)
+    except InputError as error:
+        parser.error(str(error))
+    finally:
+        database.close()
+
+    print('Exported {} transactions to {}.'.format(count, args.path))
+
+#############
+# VARIABLES #
+#############
+
+CHUNK_SIZE = 1000
+
+COLUMNS = list(EXPECTED_INFORMATION)[1:]
+AMOUNT = COLUMNS.index('amount')
+VERIFIED = COLUMNS.index('verified')
+CURRENCY = COLUMNS.index('currency')
+
+FORMATS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+}
+
+if __name__ == '__main__':
+    main()
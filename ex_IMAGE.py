@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from telegram.error import (
+    NetworkError,
+)
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+class Pipeline:
+    """
+    Downloads and stores receipt images in the background.
+    > Downloads run on a bounded thread pool and are retried with exponential backoff.
+    > Images are stored once per content hash in a sharded directory tree.
+    > Images are normalised into a compressed copy and a thumbnail in a process pool.
+    > The hash, paths and format of every image are recorded against the updateid of its transaction.
+    Images which cannot be normalised are removed and never recorded.
+    Processes are spawned rather than forked, since forking the threaded bot can deadlock.
+    Downloads and failures are counted if a metrics registry is given.
+    """
+    def __init__(self, database, directory, workers=4, processes=2, pending=64, retries=3, backoff=1.0, metrics=None):
+        self.database = database
+        self.metrics = metrics
+        self.directory = directory
+        self.retries = retries
+        self.backoff = backoff
+        self.slots = threading.BoundedSemaphore(pending)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image')
+        self.processes = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) if Image else None
+
+    def submit(self, bot, file_id, updateid):
+        """
+        Queues an image for download and returns its future.
+        Blocks only if the maximum number of pending images has been reached.
+        """
+        self.slots.acquire()
+        future = self.executor.submit(self.process, bot, file_id, updateid)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def stop(self) -> None:
+        """
+        Waits for every queued image to be stored.
+        """
+        self.executor.shutdown(wait=True)
+        if self.processes:
+            self.processes.shutdown(wait=True)
+
+    def process(self, bot, file_id, updateid) -> tuple:
+        """
+        Downloads, stores, normalises and records an image.
+        Returns the hash and path of the stored image.
+        """
+        try:
+            start = time.perf_counter()
+            data = self.download(bot, file_id)
+            if self.metrics is not None:
+                self.metrics.observe('image_download_seconds', (), time.perf_counter() - start)
+            digest, path, format = self.store(data)
+            thumbnail = None
+            if self.processes:
+                try:
+                    path, thumbnail = self.processes.submit(normalise, path, digest).result()
+                except Exception:
+                    remove(path)
+                    raise
+                format = FULL_FORMAT
+            self.database.execute(
+                'INSERT OR REPLACE INTO images VALUES (?,?,?,?,?)', (updateid, digest, path, format, thumbnail)
+            )
+        except Exception:
+            if self.metrics is not None:
+                self.metrics.count('image_failures_total')
+            logger.exception('Failed to store the image of transaction %s', updateid)
+            raise
+        return digest, path
+
+    def download(self, bot, file_id) -> bytes:
+        """
+        Downloads an image, retrying network errors with exponential backoff.
+        """
+        for attempt in range(self.retries):
+            try:
+                return bytes(bot.get_file(file_id).download_as_bytearray())
+            except NetworkError:
+                if attempt == self.retries - 1:
+                    raise
+                if self.metrics is not None:
+                    self.metrics.count('image_download_retries_total')
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def store(self, data) -> tuple:
+        """
+        Writes an image to its content addressed path unless it is already stored.
+        Returns the hash, path and detected format of the image.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        format = detect_format(data)
+        path = image_path(self.directory, digest, '.' + format)
+        if self.processes and os.path.exists(image_path(self.directory, digest, FULL_SUFFIX)):
+            return digest, path, format
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+            with open(temporary, 'wb') as file:
+                file.write(data)
+            os.replace(temporary, path)
+        return digest, path, format
+
+def detect_format(data) -> str:
+    """
+    Detects the format of an image from its leading bytes.
+    Returns 'bin' if the format is not recognised.
+    """
+    for signature, format in SIGNATURES:
+        if data.startswith(signature):
+            if format == 'webp' and data[8:12] != b'WEBP':
+                continue
+            return format
+    return 'bin'
+
+def normalise(source, digest) -> tuple:
+    """
+    Writes a compressed copy and a thumbnail of an image next to the source.
+    Large JPEG images are decoded at a reduced scale to cap peak memory.
+    Removes the source once both files are written.
+    > An identical image stored concurrently may normalise and remove the source first, which is not an error.
+    Returns the paths of the compressed copy and the thumbnail.
+    """
+    directory = os.path.dirname(source)
+    full = os.path.join(directory, digest + FULL_SUFFIX)
+    thumbnail = os.path.join(directory, digest + THUMBNAIL_SUFFIX)
+    if os.path.exists(full) and os.path.exists(thumbnail):
+        remove(source)
+        return full, thumbnail
+
+    temporary = '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+    try:
+        with Image.open(source) as image:
+            image.draft('RGB', (FULL_SIZE, FULL_SIZE))
+            image = image.convert('RGB')
+            image.thumbnail((FULL_SIZE, FULL_SIZE))
+            image.save(full + temporary, 'JPEG', quality=FULL_QUALITY, optimize=True)
+            image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            image.save(thumbnail + temporary, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+    except FileNotFoundError:
+        if os.path.exists(full) and os.path.exists(thumbnail):
+            return full, thumbnail
+        raise
+
+    os.replace(full + temporary, full)
+    os.replace(thumbnail + temporary, thumbnail)
+    remove(source)
+    return full, thumbnail
+
+def remove(path) -> None:
+    """
+    Removes a file unless it has already been removed.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def image_path(directory, digest, suffix='') -> str:
+    """
+    Returns the sharded path of an image.
+    > The first two pairs of hexadecimal digits of the hash name the directories.
+    """
+    return os.path.join(directory, digest[0:2], digest[2:4], digest + suffix)
+
+#############
+# VARIABLES #
+#############
+
+SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'RIFF', 'webp'),
+    (b'BM', 'bmp'),
+]
+
+FULL_FORMAT = 'jpg'
+FULL_SUFFIX = '.full.' + FULL_FORMAT
+FULL_SIZE = 2048
+FULL_QUALITY = 85
+
+THUMBNAIL_SUFFIX = '.thumb.jpg'
+THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 70
@@ -0,0 +1,223 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import re
+
+import ex_SQL as db
+
+from ex_BUILTINS import (
+    InputError,
+    EXPECTED_INFORMATION,
+    AUTOMATIC_VERIFIED,
+    PAYMENTS,
+    date_input,
+    money_input,
+    boolean_input,
+)
+
+class Report:
+    """
+    Writes the rows which could not be imported to a CSV file as they are found.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(['row', 'reason'])
+        self.counts = {'imported': 0, 'duplicate': 0, 'invalid': 0}
+
+    def record(self, number, reason) -> None:
+        self.writer.writerow([number, reason])
+
+    def close(self) -> None:
+        self.file.close()
+
+def read_records(file, format):
+    """
+    Streams the records of a CSV, JSON Lines or JSON array document one at a time.
+    """
+    if format == 'csv':
+        yield from csv.DictReader(file)
+    elif format == 'jsonl':
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+    elif format == 'json':
+        yield from read_array(file)
+    else:
+        raise InputError
+
+def read_array(file, size=65536):
+    """
+    Streams the elements of a JSON array without loading the whole document.
+    """
+    decoder = json.JSONDecoder()
+    buffer = file.read(size).lstrip()
+    if not buffer.startswith('['):
+        raise InputError
+    index = 1
+    while True:
+        while index < len(buffer) and buffer[index] in ' \t\r\n,':
+            index += 1
+        if index < len(buffer) and buffer[index] == ']':
+            return
+        try:
+            record, index = decoder.raw_decode(buffer, index)
+        except ValueError:
+            chunk = file.read(size)
+            if not chunk:
+                raise InputError
+            buffer, index = buffer[index:] + chunk, 0
+            continue
+        yield record
+
+def validate(record, owner, updateid, rates) -> tuple:
+    """
+    Validates a record with the same validators as the conversation.
+    > Dates may be given as YYMMDDHHMM or as YYYY-MM-DD HH:MM.
+    > Amounts are in the currency column if there is one, in the home currency otherwise.
+    > Currencies without any exchange rate in rates are rejected.
+    > Description, date and amount are required.
+    > Verified defaults to the automatic value of the payment method.
+    Returns the database row of the record.
+    """
+    record = {key.strip().lower(): str(value).strip() for key, value in record.items() if value is not None}
+    if not record.get('description'):
+        raise InputError('description is required')
+
+    date = record.get('datetime', record.get('date', ''))
+    digits = re.sub(r'\D', '', date)
+    if re.match(r'^\d{4}\D', date):
+        digits = digits[2:]
+    if not digits:
+        raise InputError('date is required')
+    try:
+        record['datetime'] = date_input(digits[:10])
+    except InputError:
+        raise InputError('invalid date')
+
+    try:
+        record.update(money_input('{} {}'.format(record.get('amount', ''), record.get('currency', '')).strip()))
+    except InputError:
+        raise InputError('invalid amount')
+    if not rates.known(record['currency']):
+        raise InputError('no exchange rate for {}'.format(record['currency']))
+
+    payment = record.get('payment', '')
+    if payment and payment not in PAYMENTS:
+        raise InputError('invalid payment method')
+    if record.get('verified'):
+        record['verified'] = boolean_input(record['verified'].capitalize())
+        if record['verified'] is None:
+            raise InputError('invalid verified status')
+    elif payment in AUTOMATIC_VERIFIED:
+        record['verified'] = boolean_input(AUTOMATIC_VERIFIED[payment])
+
+    record['owner'] = owner
+    record['updateid'] = updateid
+    return db.values({name: record[name] for name in EXPECTED_INFORMATION if name in record})
+
+def import_file(database, path, owner, report, batch_size=10000) -> dict:
+    """
+    Imports the expenses in a CSV, JSON Lines or JSON file for an owner.
+    > Rows are validated as they are read, and inserted in transactions of batch_size rows.
+    > Every batch is staged in a temporary table, deduplicated with a single query, and inserted with a single statement.
+    > Rows matching an existing or earlier expense by owner, date, amount and description are skipped, including archived expenses.
+    > Invalid and duplicate rows are recorded in the report.
+    Imported rows are given negative update ids so they never clash with Telegram update ids.
+    > Update ids are reserved from a sequence in the main database, so that concurrent imports into any shard never share one.
+    Returns the number of imported, duplicate and invalid rows.
+    """
+    format = os.path.splitext(path)[1].lstrip('.').lower()
+    format = {'ndjson': 'jsonl', 'txt': 'csv'}.get(format, format)
+
+    shard = database.shard(owner)
+    conn = shard.history()
+    for statement in STAGE:
+        conn.execute(statement)
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        records = enumerate(read_records(file, format), 1)
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            rows, rejected = [], []
+            for number, record in batch:
+                try:
+                    rows.append((number,) + validate(record, owner, 0, database.rates))
+                except (InputError, AttributeError) as error:
+                    rejected.append((number, str(error) or 'invalid row'))
+
+            with conn:
+                # Taking the write lock first keeps the duplicates found valid until the rows are inserted
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('DELETE FROM temp.staged')
+                conn.executemany(STAGE_ROW, rows)
+                duplicates = [number for number, in conn.execute(DUPLICATES)]
+                conn.execute('DELETE FROM temp.staged WHERE number IN (SELECT value FROM json_each(?))', (json.dumps(duplicates),))
+                if len(rows) > len(duplicates):
+                    conn.execute(INSERT_STAGED, (db.allocate(database, 'import', len(rows) - len(duplicates)),))
+                conn.execute('DELETE FROM temp.staged')
+            shard.changed([owner])
+
+            report.counts['imported'] += len(rows) - len(duplicates)
+            report.counts['duplicate'] += len(duplicates)
+            report.counts['invalid'] += len(rejected)
+            for number, reason in sorted(rejected + [(number, 'duplicate') for number in duplicates]):
+                report.record(number, reason)
+
+    return report.counts
+
+########
+# MAIN #
+########
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Imports historical expenses from a CSV or JSON file.')
+    parser.add_argument('path')
+    parser.add_argument('--owner', type=int, required=True)
+    parser.add_argument('--db', default='expenses.db')
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--report', default='import_errors.csv')
+    args = parser.parse_args()
+
+    database = db.Router(args.db, args.shards)
+    db.setup(database)
+    report = Report(args.report)
+    counts = import_file(database, args.path, args.owner, report)
+    report.close()
+    database.close()
+
+    print('Imported {imported}, skipped {duplicate} duplicates and {invalid} invalid rows.'.format(**counts))
+
+#############
+# VARIABLES #
+#############
+
+# The staging table takes the column types of the expenses, so that its values compare the same way
+STAGE = [
+    'CREATE TEMP TABLE IF NOT EXISTS staged AS SELECT 0 AS number, {} FROM main.expenses WHERE 0'.format(', '.join(db.COLUMNS)),
+    'CREATE INDEX IF NOT EXISTS temp.stagedIndex ON staged (owner, dt, amount, description, number)',
+]
+STAGE_ROW = 'INSERT INTO temp.staged VALUES ({})'.format(','.join('?' * (len(db.COLUMNS) + 1)))
+DUPLICATES = (
+    'SELECT number FROM temp.staged AS new WHERE EXISTS ('
+    'SELECT 1 FROM history AS old WHERE old.owner = new.owner AND old.dt = new.dt '
+    'AND old.amount = new.amount AND old.description = new.description'
+    ') OR EXISTS ('
+    'SELECT 1 FROM temp.staged AS old WHERE old.owner = new.owner AND old.dt = new.dt '
+    'AND old.amount = new.amount AND old.description = new.description AND old.number < new.number'
+    ') ORDER BY number'
+)
+INSERT_STAGED = 'INSERT INTO main.expenses ({0}) SELECT {1} FROM temp.staged ORDER BY number'.format(
+    ', '.join(db.STORED),
+    ', '.join(
+        ['? + 1 - row_number() OVER (ORDER BY number)' if column == 'updateid' else column for column in db.COLUMNS]
+        + db.conversions()
+    )
+)
+
+if __name__ == '__main__':
+    main()
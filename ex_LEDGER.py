@@ -0,0 +1,156 @@
+import heapq
+import json
+import threading
+
+import ex_SQL as db
+
+from ex_BUILTINS import (
+    InputError,
+)
+
+class Ledger:
+    """
+    Keeps the members of every group ledger.
+    > A group ledger is the owner of a group chat; its members are the users who paid or shared an expense.
+    > Every expense of a group records its payer and the share of every member, in the currency of the expense.
+    > The balance of every member is kept up to date by the database triggers and read from its primary key.
+    The members of an owner are loaded from the database on first use.
+    """
+    def __init__(self, database):
+        self.database = database
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def members(self, owner) -> dict:
+        """
+        Returns the names of the members of an owner indexed by member.
+        """
+        with self.lock:
+            if owner in self.owners:
+                return self.owners[owner]
+
+        members = dict(self.database.shard(owner).fetch(
+            'SELECT member, name FROM members WHERE owner = ? ORDER BY member', (owner,)
+        ))
+
+        with self.lock:
+            return self.owners.setdefault(owner, members)
+
+    def join(self, owner, member, name) -> bool:
+        """
+        Adds a member to an owner, or renames it.
+        Returns False if the member was already known under that name.
+        """
+        if self.members(owner).get(member) == name:
+            return False
+        self.database.shard(owner).execute('INSERT OR REPLACE INTO members VALUES (?,?,?)', (owner, member, name))
+        with self.lock:
+            self.owners[owner][member] = name
+        return True
+
+    def find(self, owner, names) -> list:
+        """
+        Returns the members of an owner with the given names, ignoring case and a leading @.
+        Raises an InputError if a name is unknown or shared by several members.
+        """
+        found = {}
+        for member, name in self.members(owner).items():
+            found.setdefault(name.lower(), []).append(member)
+        members = []
+        for name in names:
+            matches = found.get(name.lstrip('@').lower(), [])
+            if len(matches) != 1:
+                raise InputError(name)
+            members.append(matches[0])
+        return members
+
+    def split(self, owner, amount, members=None) -> str:
+        """
+        Returns the encoded shares of an amount split equally between members, or every member of an owner.
+        """
+        return encode(split(amount, members or list(self.members(owner))))
+
+    def balances(self, owner) -> list:
+        """
+        Returns the (member, balance) pairs of an owner whose balance is not settled.
+        """
+        return db.balances(self.database, owner)
+
+    def settle(self, owner) -> list:
+        """
+        Returns the (debtor, creditor, amount) transfers settling every balance of an owner.
+        """
+        return settle(dict(self.balances(owner)))
+
+def encode(shares) -> str:
+    """
+    Encodes the shares of an expense as a JSON object keyed by member.
+    """
+    return json.dumps({str(member): share for member, share in sorted(shares.items())}, separators=(',', ':'))
+
+def decode(shares) -> dict:
+    """
+    Decodes the shares of an expense, or returns no shares if the expense is not split.
+    """
+    if not shares:
+        return {}
+    return {int(member): share for member, share in json.loads(shares).items()}
+
+def split(amount, members) -> dict:
+    """
+    Splits an amount in integer minor units equally between members.
+    > The units left over are given to the first members, one each, so that the shares sum to the amount.
+    """
+    members = sorted(set(members))
+    share, remainder = divmod(amount, len(members))
+    return {member: share + (index < remainder) for index, member in enumerate(members)}
+
+def rescale(shares, amount) -> dict:
+    """
+    Scales shares proportionally so that they sum to a new amount.
+    > The units left over are given to the shares with the largest remainders.
+    Shares summing to zero are split equally instead.
+    """
+    total = sum(shares.values())
+    if not total:
+        return split(amount, shares)
+    scaled = {member: divmod(share * amount, total) for member, share in shares.items()}
+    left = amount - sum(quotient for quotient, _ in scaled.values())
+    order = sorted(scaled, key=lambda member: (-scaled[member][1], member))
+    return {member: scaled[member][0] + (member in order[:left]) for member in scaled}
+
+def settle(balances) -> list:
+    """
+    Computes the transfers settling a set of balances which sum to zero.
+    > Debtors and creditors owing exactly the same amount are paired first, with a single transfer each.
+    > The largest remaining debtor then pays the largest remaining creditor, until every balance is settled.
+    > Every transfer settles at least one balance, so n members need at most n - 1 transfers.
+    The fewest possible transfers is NP-hard to find; this greedy settlement runs in O(n log n).
+    Returns (debtor, creditor, amount) transfers.
+    """
+    transfers = []
+    debts = {}
+    for member, balance in sorted(balances.items()):
+        if balance < 0:
+            debts.setdefault(-balance, []).append(member)
+
+    creditors = []
+    for member, balance in sorted(balances.items()):
+        if balance > 0 and debts.get(balance):
+            transfers.append((debts[balance].pop(), member, balance))
+        elif balance > 0:
+            creditors.append((-balance, member))
+    debtors = [(-amount, member) for amount, members in debts.items() for member in members]
+
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append((debtor, creditor, amount))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+    return transfers
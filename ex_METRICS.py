@@ -0,0 +1,499 @@
+import bisect
+import collections
+import functools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+from telegram.ext import (
+    ConversationHandler,
+)
+
+logger = logging.getLogger(__name__)
+
+class Histogram:
+    """
+    Counts observations in fixed buckets, and keeps their sum.
+    > Every thread observes into its own shard, so that observing never waits for a lock.
+    > Shards are only merged, and bucket counts made cumulative, when they are exported.
+    """
+    __slots__ = ('buckets', 'shards', 'local', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.shards = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def observe(self, value) -> None:
+        """
+        Adds an observation.
+        """
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def shard(self) -> list:
+        """
+        Returns a new shard of the current thread: a count per bucket followed by the sum.
+        """
+        shard = self.local.shard = [0] * (len(self.buckets) + 1) + [0.0]
+        with self.lock:
+            self.shards.append(shard)
+        return shard
+
+    def snapshot(self) -> tuple:
+        """
+        Returns the bucket counts and the sum of every shard added together.
+        """
+        with self.lock:
+            shards = list(self.shards)
+        totals = [sum(column) for column in zip(*shards)] or [0] * (len(self.buckets) + 1) + [0.0]
+        return totals[:-1], totals[-1]
+
+class Registry:
+    """
+    Keeps the counters and histograms of the bot.
+    > Every metric is described in METRICS, and its series are identified by a tuple of label values.
+    > Histograms are resolved once by their callers and then observed without any lookup.
+    > Collectors are called at every export to report samples read from elsewhere, such as gauges.
+    > Health checks are called on every health request, and return the problems they found.
+    Statements are labelled by their shape, so that their values never appear in a label.
+    """
+    def __init__(self, prefix=None, buckets=None):
+        self.prefix = PREFIX if prefix is None else prefix
+        self.buckets = tuple(buckets or BUCKETS)
+        self.counters = {name: {} for name, (kind, _, _) in METRICS.items() if kind == 'counter'}
+        self.histograms = {name: {} for name, (kind, _, _) in METRICS.items() if kind == 'histogram'}
+        self.statements = {}
+        self.collectors = []
+        self.checks = []
+        self.lock = threading.Lock()
+
+    def count(self, name, labels=(), amount=1) -> None:
+        """
+        Increases a counter.
+        """
+        series = self.counters[name]
+        with self.lock:
+            series[labels] = series.get(labels, 0) + amount
+
+    def histogram(self, name, labels=()) -> Histogram:
+        """
+        Returns the histogram of a series, creating it on first use.
+        """
+        series = self.histograms[name]
+        histogram = series.get(labels)
+        if histogram is None:
+            with self.lock:
+                histogram = series.setdefault(labels, Histogram(self.buckets))
+        return histogram
+
+    def observe(self, name, labels, value) -> None:
+        """
+        Adds an observation to the histogram of a series.
+        """
+        self.histogram(name, labels).observe(value)
+
+    def statement(self, text, seconds) -> None:
+        """
+        Adds the duration of an SQL statement to the histogram of its shape.
+        """
+        histogram = self.statements.get(text)
+        if histogram is None:
+            histogram = self.histogram('sql_seconds', (shape(text),))
+            if len(self.statements) < STATEMENT_CACHE:
+                self.statements[text] = histogram
+        histogram.observe(seconds)
+
+    def collect(self, collector) -> None:
+        """
+        Adds a function returning (name, labels, value) samples, called at every export.
+        > Collected samples are exported as they are, in addition to any series of the same name kept by the registry.
+        """
+        self.collectors.append(collector)
+
+    def check(self, check) -> None:
+        """
+        Adds a function returning the problems of a component, called on every health request.
+        """
+        self.checks.append(check)
+
+    def health(self) -> list:
+        """
+        Returns the problems found by every health check.
+        A check which raises is reported as a problem.
+        """
+        problems = []
+        for check in list(self.checks):
+            try:
+                problems.extend(check())
+            except Exception as error:
+                problems.append('{} failed: {!r}'.format(getattr(check, '__qualname__', check), error))
+        return problems
+
+    def export(self) -> str:
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        collected = collections.defaultdict(dict)
+        for collector in list(self.collectors):
+            try:
+                for name, labels, value in collector():
+                    collected[name][labels] = value
+            except Exception:
+                logger.exception('Failed to collect metrics from %s', collector)
+
+        lines = []
+        for name, (kind, description, labels) in METRICS.items():
+            full = self.prefix + name
+            lines.append('# HELP {} {}'.format(full, description))
+            lines.append('# TYPE {} {}'.format(full, kind))
+            if kind == 'histogram':
+                with self.lock:
+                    series = list(self.histograms[name].items())
+                bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+                for values, histogram in series:
+                    counts, total = histogram.snapshot()
+                    cumulative = 0
+                    for bound, count in zip(bounds, counts):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(full, label_text(labels + ('le',), values + (bound,)), cumulative))
+                    lines.append('{}_sum{} {}'.format(full, label_text(labels, values), format_value(total)))
+                    lines.append('{}_count{} {}'.format(full, label_text(labels, values), cumulative))
+            else:
+                with self.lock:
+                    series = list(self.counters.get(name, {}).items())
+                series += collected[name].items()
+                for values, value in series:
+                    lines.append('{}{} {}'.format(full, label_text(labels, values), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path) -> None:
+        """
+        Writes every metric to a file, replacing it atomically.
+        """
+        temporary = path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            file.write(self.export())
+        os.replace(temporary, path)
+
+class Exporter:
+    """
+    Exposes the metrics of a registry.
+    > Serves them on a local HTTP endpoint if a port is given.
+    > Writes a snapshot of them to a file every interval seconds if a path is given.
+    """
+    def __init__(self, registry, listen='127.0.0.1', port=None, path=None, interval=60):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.threads = []
+        self.httpd = ThreadingHTTPServer((listen, port), request_handler(registry)) if port is not None else None
+        if self.httpd:
+            self.httpd.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self) -> None:
+        """
+        Starts the HTTP server and the snapshot thread.
+        """
+        if self.httpd:
+            self.threads.append(threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True))
+        if self.path:
+            self.threads.append(threading.Thread(target=self.run, name='metrics-snapshot', daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the HTTP server and writes a last snapshot.
+        """
+        self.stopped.set()
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        for thread in self.threads:
+            thread.join()
+
+    def run(self) -> None:
+        """
+        Writes snapshots until the exporter is stopped.
+        """
+        while not self.stopped.wait(self.interval):
+            self.snapshot()
+        self.snapshot()
+
+    def snapshot(self) -> None:
+        """
+        Writes a snapshot, logging any failure instead of raising it.
+        """
+        try:
+            self.registry.dump(self.path)
+        except OSError:
+            logger.exception('Failed to write the metrics snapshot %s', self.path)
+
+class Profiler:
+    """
+    Samples the stacks of every thread at a fixed interval while it is running.
+    > Samples are counted per collapsed stack, the input format of flame graph tools.
+    > It can be started and stopped at any time and costs nothing while it is stopped.
+    """
+    def __init__(self, interval=0.005, depth=64):
+        self.interval = interval
+        self.depth = depth
+        self.samples = collections.Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self) -> bool:
+        """
+        Discards the previous samples and starts sampling.
+        Returns False if the profiler was already running.
+        """
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.samples.clear()
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+            self.thread.start()
+        return True
+
+    def stop(self) -> bool:
+        """
+        Stops sampling and keeps the samples taken.
+        Returns False if the profiler was not running.
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None:
+            return False
+        self.stopped.set()
+        thread.join()
+        return True
+
+    def run(self) -> None:
+        """
+        Takes samples until the profiler is stopped.
+        """
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    stacks.append(collapse(frame, names.get(ident, 'thread'), self.depth))
+            with self.lock:
+                self.samples.update(stacks)
+
+    def top(self, limit=10, prefix=None) -> list:
+        """
+        Returns the functions of the bot most often found running, with their number of samples.
+        > A sample counts towards the innermost function of a module whose name starts with prefix.
+        > Samples without any such function, such as idle library threads, are ignored.
+        """
+        prefix = prefix or MODULE_PREFIX
+        functions = collections.Counter()
+        with self.lock:
+            for stack, count in self.samples.items():
+                frames = [frame for frame in stack.split(';') if frame.startswith(prefix)]
+                if frames:
+                    functions[frames[-1]] += count
+        return functions.most_common(limit)
+
+    def dump(self, path) -> int:
+        """
+        Writes the collapsed stacks and their number of samples to a file.
+        Returns the number of samples written.
+        """
+        with self.lock:
+            samples = sorted(self.samples.items())
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in samples:
+                file.write('{} {}\n'.format(stack, count))
+        return sum(count for _, count in samples)
+
+def collapse(frame, thread, depth) -> str:
+    """
+    Returns the stack of a frame as its thread name and functions, outermost first, separated by semicolons.
+    """
+    functions = []
+    while frame is not None and len(functions) < depth:
+        code = frame.f_code
+        functions.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    functions.append(thread)
+    return ';'.join(reversed(functions))
+
+def timed(registry, callback, conversation=None, entry=False):
+    """
+    Wraps a handler callback to time it and count its errors.
+    > Callbacks of a conversation also count the conversations they start and end.
+    > Conversations ended by a callback named *_cancel are cancelled, and by any other callback completed.
+    """
+    name = callback.__name__
+    histogram = registry.histogram('handler_seconds', (name,))
+    clock = time.perf_counter
+    if conversation is None:
+        outcome = None
+    elif entry:
+        outcome = lambda state: 'rejected' if state == ConversationHandler.END else 'started'
+    else:
+        ending = 'cancelled' if name.endswith('_cancel') else 'completed'
+        outcome = lambda state: ending if state == ConversationHandler.END else None
+
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        start = clock()
+        try:
+            state = callback(update, context)
+        except Exception:
+            registry.count('handler_errors_total', (name,))
+            raise
+        finally:
+            histogram.observe(clock() - start)
+        if outcome is not None:
+            result = outcome(state)
+            if result is not None:
+                registry.count('conversations_total', (conversation, result))
+        return state
+
+    return wrapper
+
+def instrument(registry, dispatcher) -> int:
+    """
+    Wraps the callback of every handler registered with a dispatcher, including the handlers of conversations.
+    The number of active conversations of every conversation handler is collected as a gauge.
+    Returns the number of callbacks wrapped.
+    """
+    wrapped = 0
+    for group in dispatcher.handlers.values():
+        for handler in group:
+            if not isinstance(handler, ConversationHandler):
+                handler.callback = timed(registry, handler.callback)
+                wrapped += 1
+                continue
+
+            conversation = handler.name or handler.entry_points[0].command[0]
+            for entry in handler.entry_points:
+                entry.callback = timed(registry, entry.callback, conversation, True)
+                wrapped += 1
+            for child in [child for children in handler.states.values() for child in children] + handler.fallbacks:
+                child.callback = timed(registry, child.callback, conversation)
+                wrapped += 1
+            registry.collect(functools.partial(active, handler, conversation))
+    return wrapped
+
+def active(handler, conversation) -> list:
+    """
+    Returns the gauge of the conversations of a handler which have not ended.
+    """
+    return [('conversations_active', (conversation,), len(handler.conversations))]
+
+@functools.lru_cache(maxsize=1024)
+def shape(text) -> str:
+    """
+    Reduces an SQL statement to its shape.
+    > Whitespace is collapsed, literals are replaced by placeholders, and lists of placeholders by a single one.
+    """
+    text = ' '.join(text.split())
+    text = LITERAL.sub('?', text)
+    text = NUMBER.sub('?', text)
+    return PLACEHOLDERS.sub('?', text)
+
+def label_text(names, values) -> str:
+    """
+    Formats the labels of a series.
+    """
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    ) + '}'
+
+def format_value(value) -> str:
+    """
+    Formats a sample value, without a fraction for integers.
+    """
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+def request_handler(registry) -> type:
+    """
+    Builds the HTTP request handler class serving the metrics of a registry.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            path = self.path.split('?')[0]
+            if path == HEALTH_PATH:
+                problems = registry.health()
+                body = ('\n'.join(problems) if problems else 'ok').encode('utf-8') + b'\n'
+                self.send_response(503 if problems else 200)
+            elif path == METRICS_PATH:
+                body = registry.export().encode('utf-8')
+                self.send_response(200)
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) -> None:
+            logger.debug(format, *args)
+
+    return Handler
+
+#############
+# VARIABLES #
+#############
+
+PREFIX = 'expenses_bot_'
+MODULE_PREFIX = 'ex_'
+METRICS_PATH = '/metrics'
+HEALTH_PATH = '/health'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_CACHE = 1024
+
+LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'(?<![\w.])\d+(?:\.\d+)?\b')
+PLACEHOLDERS = re.compile(r'\?(?:\s*,\s*\?)+')
+
+METRICS = {
+    'handler_seconds': ('histogram', 'Time spent in each handler callback.', ('handler',)),
+    'handler_errors_total': ('counter', 'Handler callbacks which raised an exception.', ('handler',)),
+    'conversations_total': ('counter', 'Conversations started, rejected, completed or cancelled.', ('conversation', 'outcome')),
+    'conversations_active': ('gauge', 'Conversations which have not ended.', ('conversation',)),
+    'sql_seconds': ('histogram', 'Time spent executing each shape of SQL statement.', ('statement',)),
+    'image_download_seconds': ('histogram', 'Time spent downloading receipt images, retries included.', ()),
+    'image_download_retries_total': ('counter', 'Receipt image downloads retried after a network error.', ()),
+    'image_failures_total': ('counter', 'Receipt images which could not be stored.', ()),
+    'webhook_updates_total': ('counter', 'Webhook updates by what happened to them.', ('result',)),
+    'writer_up': ('gauge', 'Whether the write-behind writer of a shard is running and its last flush succeeded.', ('journal',)),
+    'writer_pending_rows': ('gauge', 'Rows queued by the write-behind writer of a shard.', ('journal',)),
+    'writer_failures_total': ('counter', 'Batches the write-behind writer of a shard failed to flush.', ('journal',)),
+}
@@ -0,0 +1,158 @@
+import json
+import logging
+import re
+
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+)
+from datetime import (
+    datetime,
+)
+
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:
+    pytesseract = None
+
+logger = logging.getLogger(__name__)
+
+class Reader:
+    """
+    Extracts the total amount, date and time and merchant of receipt images.
+    > Extraction runs on a worker pool once the image is stored, and never blocks the caller.
+    > Tesseract is killed after timeout seconds, so that a hung recognition never holds a worker.
+    > Results are cached by image hash in the database.
+    > Nothing is extracted if pytesseract is not installed.
+    """
+    def __init__(self, database, workers=2, timeout=5.0):
+        self.database = database
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ocr')
+
+    def stop(self) -> None:
+        """
+        Waits for every running extraction to finish.
+        """
+        self.executor.shutdown(wait=True)
+
+    def submit(self, stored) -> Future:
+        """
+        Queues the fields of an image to be extracted once the future of the stored image is done.
+        Returns the future of the extracted fields, which are empty if the image cannot be read.
+        """
+        fields = Future()
+        if pytesseract is None:
+            fields.set_result({})
+            return fields
+
+        def queue(stored):
+            try:
+                self.executor.submit(self.read, stored, fields)
+            except RuntimeError:
+                fields.set_result({})
+
+        stored.add_done_callback(queue)
+        return fields
+
+    def read(self, stored, fields) -> None:
+        """
+        Extracts the fields of a stored image, or reads them from the cache, into a future.
+        """
+        try:
+            digest, path = stored.result()
+            cached = self.database.fetch('SELECT fields FROM ocr WHERE hash = ?', (digest,))
+            if cached:
+                result = json.loads(cached[0][0])
+            else:
+                result = extract(path, self.timeout)
+                self.database.execute('INSERT OR REPLACE INTO ocr VALUES (?,?)', (digest, json.dumps(result)))
+        except Exception:
+            logger.warning('Could not read the receipt', exc_info=True)
+            result = {}
+        fields.set_result(result)
+
+def extract(path, timeout=0) -> dict:
+    """
+    Recognises the text of a receipt image and parses its fields.
+    Raises a RuntimeError if recognition takes longer than timeout seconds, unless timeout is 0.
+    """
+    with Image.open(path) as image:
+        text = pytesseract.image_to_string(image.convert('L'), timeout=timeout)
+    return parse(text)
+
+def parse(text) -> dict:
+    """
+    Parses the fields of a receipt from its recognised text.
+    > shop is the first line containing letters.
+    > amount is the amount on the last total line, or the largest amount otherwise.
+    > datetime is the first date found, with the first time found.
+    Fields which cannot be found are left out.
+    """
+    fields = {}
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+
+    for line in lines:
+        if re.search(r'[A-Za-z]{2}', line):
+            fields['shop'] = line
+            break
+
+    totals, amounts = [], []
+    for line in lines:
+        found = [int(whole) * 100 + int(cents) for whole, cents in AMOUNT.findall(line.replace(',', ''))]
+        amounts.extend(found)
+        if found and TOTAL.search(line):
+            totals.append(found[-1])
+    if totals or amounts:
+        fields['amount'] = totals[-1] if totals else max(amounts)
+
+    date = parse_date(text)
+    if date:
+        fields['datetime'] = date
+
+    return fields
+
+def parse_date(text) -> str:
+    """
+    Finds the date and time of a receipt.
+    Dates are of the format '%Y-%m-%d %H:%M:%S'.
+    Returns None if no valid date is found.
+    """
+    time_found = TIME.search(text)
+    hour, minute = (int(time_found.group(1)), int(time_found.group(2))) if time_found else (0, 0)
+
+    for pattern, order in DATES:
+        for match in pattern.finditer(text):
+            parts = dict(zip(order, match.groups()))
+            year = int(parts['y'])
+            year = year + 2000 if year < 100 else year
+            month = parts['m']
+            month = MONTHS.get(month[:3].lower()) if month.isalpha() else int(month)
+            if month is None:
+                continue
+            try:
+                return datetime(year, month, int(parts['d']), hour, minute).strftime('%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                continue
+    return None
+
+#############
+# VARIABLES #
+#############
+
+AMOUNT = re.compile(r'(?<![\d.])(\d{1,6})\.(\d{2})(?![\d.])')
+TOTAL = re.compile(r'(?<!sub)(?<!sub )total|amount due|grand', re.IGNORECASE)
+TIME = re.compile(r'\b([01]?\d|2[0-3]):([0-5]\d)\b')
+
+MONTHS = {
+    name: number for number, name in enumerate(
+        ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], 1
+    )
+}
+
+DATES = [
+    (re.compile(r'\b(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})\b'), 'ymd'),
+    (re.compile(r'\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{2,4})\b'), 'dmy'),
+    (re.compile(r'\b(\d{1,2})[ -]([A-Za-z]{3})[A-Za-z]*[ ,-]+(\d{2,4})\b'), 'dmy'),
+]
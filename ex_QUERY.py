@@ -0,0 +1,340 @@
+import copy
+import functools
+import heapq
+import itertools
+import re
+
+from datetime import (
+    datetime,
+    timedelta,
+)
+
+import ex_SQL as db
+
+from ex_BUILTINS import (
+    InputError,
+    SCHEMA,
+)
+
+class Filter:
+    """
+    Describes a search over the expenses of one or more owners.
+    > period can be day, week, month, year, all.
+    > above selects amounts above amount if True, below amount otherwise.
+    > amount is in the home currency, and compared with the amounts converted when the expenses were written.
+    > verified can be True, False or None for either, and expenses whose verified status was never answered are unverified.
+    > order can be date, amount, shop, location, payment.
+    """
+    def __init__(self, owners, period='all', above=True, amount=None, shop=None, location=None, payment=None, verified=None, order='date'):
+        self.owners = tuple(owners)
+        self.period = period
+        self.above = above
+        self.amount = amount
+        self.shop = shop
+        self.location = location
+        self.payment = payment
+        self.verified = verified
+        self.order = order
+
+    def shape(self) -> tuple:
+        """
+        Returns the parts of the filter which change the statement text.
+        """
+        if not self.owners:
+            raise InputError
+        if self.period not in PERIODS or self.order not in ORDERS:
+            raise InputError
+        return (
+            len(self.owners),
+            self.period != 'all',
+            None if self.amount is None else bool(self.above),
+            self.shop is not None,
+            self.location is not None,
+            self.payment is not None,
+            None if self.verified is None else bool(self.verified),
+            self.order,
+        )
+
+    def values(self, now=None) -> tuple:
+        """
+        Returns the parameters of the statement in the order of its placeholders.
+        """
+        values = list(self.owners)
+        if self.period != 'all':
+            values.extend(period_range(self.period, now))
+        for value in (self.amount, self.shop, self.location, self.payment):
+            if value is not None:
+                values.append(value)
+        return tuple(values)
+
+def period_range(period, now=None) -> tuple:
+    """
+    Returns the start and end of the current period.
+    Dates are of the format '%Y-%m-%d %H:%M:%S' to match the dt column.
+    """
+    now = now or datetime.now()
+    start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'day':
+        end = start + timedelta(days=1)
+    elif period == 'week':
+        start = start - timedelta(days=start.weekday())
+        end = start + timedelta(weeks=1)
+    elif period == 'month':
+        start = start.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+    elif period == 'year':
+        start = start.replace(month=1, day=1)
+        end = start.replace(year=start.year + 1)
+    else:
+        raise InputError
+
+    return start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT)
+
+@functools.lru_cache(maxsize=256)
+def compile(shape) -> str:
+    """
+    Compiles a filter shape into a parameterized statement.
+    Date predicates are ranges on dt so that the composite indexes apply.
+    > Current periods only query the live expenses.
+    > The whole history is queried through the history view, which includes the archives.
+    """
+    owners, period, above, shop, location, payment, verified, order = shape
+    table = 'expenses' if period else 'history'
+
+    predicates = ['owner IN ({})'.format(','.join('?' * owners))]
+    if period:
+        predicates.append('dt >= ? AND dt < ?')
+    if above is not None:
+        predicates.append('{} {} ?'.format(db.HOME.format(table), '>' if above else '<'))
+    if shop:
+        predicates.append('shop = ?')
+    if location:
+        predicates.append('location = ?')
+    if payment:
+        predicates.append('payment = ?')
+    if verified is not None:
+        predicates.append('verified = 1' if verified else db.UNVERIFIED)
+
+    columns = list(db.COLUMNS)
+    if order == 'amount':
+        # Amounts are ordered by their home amount, selected last so that the rows of every shard can be merged on it
+        columns.append(db.HOME.format(table))
+    return 'SELECT {} FROM {} WHERE {} ORDER BY {}'.format(
+        ', '.join(columns), table, ' AND '.join(predicates), ORDERS[order].format(table)
+    )
+
+def statement(filter) -> tuple:
+    """
+    Returns the statement and parameters of a filter.
+    """
+    return compile(filter.shape()), filter.values()
+
+def archived(filter) -> bool:
+    """
+    Returns whether the statement of a filter queries the archives.
+    """
+    return filter.period == 'all'
+
+def partition(database, filter) -> list:
+    """
+    Splits a filter into a filter over the owners of every shard storing any of them.
+    """
+    if len(database.shards) == 1:
+        return [(database.main, filter)]
+    parts = []
+    for shard, owners in database.partition(filter.owners):
+        part = copy.copy(filter)
+        part.owners = tuple(owners)
+        parts.append((shard, part))
+    return parts
+
+def merge(results, order, forward=True):
+    """
+    Merges rows sorted by an order on every shard into a single sorted sequence.
+    > Rows sorted in reverse of the order are merged if forward is False.
+    > Values are compared as SQLite orders them: NULL, then numbers, then text.
+    > The home amount selected after the columns to order by amount is dropped once the rows are merged.
+    """
+    names, descending = ORDER_KEYS[order]
+    indexes = [SCHEMA.fields[name].index if name in SCHEMA.fields else len(db.COLUMNS) for name in names]
+    if len(results) == 1:
+        rows = iter(results[0])
+    else:
+        rows = heapq.merge(
+            *results, key=lambda row: tuple(sort_key(row[index]) for index in indexes), reverse=descending == forward
+        )
+    if len(db.COLUMNS) in indexes:
+        return (row[:len(db.COLUMNS)] for row in rows)
+    return rows
+
+def sort_key(value) -> tuple:
+    """
+    Returns a key comparing values of any type as SQLite does.
+    """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, bytes):
+        return (3, value)
+    return (2, value)
+
+def search(database, filter) -> list:
+    """
+    Returns every expense matching the filter.
+    The expenses of owners on different shards are merged in the order of the filter.
+    """
+    return list(merge(
+        [shard.fetch(*statement(part), archived(part)) for shard, part in partition(database, filter)], filter.order
+    ))
+
+@functools.lru_cache(maxsize=256)
+def compile_page(shape, cursor, forward) -> str:
+    """
+    Compiles a filter shape into a keyset paginated statement on (dt, updateid).
+    Forward pages move towards older transactions.
+    """
+    text = compile(shape[:-1] + ('date',)).split(' ORDER BY ')[0]
+    if cursor:
+        text += ' AND (dt, updateid) {} (?, ?)'.format('<' if forward else '>')
+    order = 'DESC' if forward else 'ASC'
+    return text + ' ORDER BY dt {0}, updateid {0} LIMIT ?'.format(order)
+
+def page(database, filter, cursor=None, forward=True, size=None) -> tuple:
+    """
+    Returns one page of expenses matching the filter, newest first.
+    The cursor is the (dt, updateid) of the row the page continues from.
+    Also returns whether further rows exist beyond the page.
+    """
+    size = size or PAGE_SIZE
+    results = []
+    for shard, part in partition(database, filter):
+        text = compile_page(part.shape(), cursor is not None, forward)
+        values = part.values() + (tuple(cursor) if cursor else ()) + (size + 1,)
+        results.append(shard.fetch(text, values, archived(part)))
+    rows = list(itertools.islice(merge(results, 'date', forward), size + 1))
+    more = len(rows) > size
+    rows = rows[:size]
+    if not forward:
+        rows.reverse()
+    return rows, more
+
+def by_updateid(database, updateid) -> tuple:
+    """
+    Returns the expense with the updateid, or None.
+    > Update ids are unique across shards, so the expense is found on at most one of them.
+    > Archived expenses are found too, through the history view.
+    """
+    for rows in database.fan_out('SELECT {} FROM history WHERE updateid = ?'.format(', '.join(db.COLUMNS)), (updateid,), True):
+        if rows:
+            return rows[0]
+    return None
+
+def match(owner, text) -> str:
+    """
+    Converts search terms into a full-text query over the expenses of an owner.
+    > Every term must match the start of a word in the description, shop, location or purpose.
+    Raises an InputError if the text contains no terms.
+    """
+    terms = WORD.findall(text)
+    if not terms:
+        raise InputError
+    return 'owner : "{}" AND {{{}}} : ({})'.format(
+        abs(int(owner)), ' '.join(SEARCH_COLUMNS), ' AND '.join('"{}"*'.format(term) for term in terms)
+    )
+
+def find(database, owner, text, size=None) -> list:
+    """
+    Returns the expenses of an owner matching search terms, best matches first.
+    > Archived expenses are no longer indexed, so they are scanned once the index runs out of matches.
+    > Archived matches follow the indexed ones, newest first, and their terms may match anywhere in a word.
+    """
+    size = size or PAGE_SIZE
+    shard = database.shard(owner)
+    rows = shard.fetch(
+        'SELECT {} FROM search JOIN expenses ON expenses.updateid = search.rowid '
+        'WHERE search MATCH ? AND expenses.owner = ? ORDER BY bm25(search, {}) LIMIT ?'.format(
+            ', '.join('expenses.{}'.format(column) for column in db.COLUMNS), ', '.join(str(weight) for weight in SEARCH_WEIGHTS)
+        ),
+        (match(owner, text), owner, size)
+    )
+    if len(rows) < size and db.archives(shard.dbname):
+        rows += find_archived(shard, owner, WORD.findall(text), size - len(rows))
+    return rows
+
+def find_archived(shard, owner, terms, size) -> list:
+    """
+    Returns the archived expenses of an owner containing every search term, newest first.
+    > Live expenses are skipped, as the index already matched them.
+    """
+    statement = (
+        'SELECT {} FROM history WHERE owner = ? AND updateid NOT IN (SELECT updateid FROM main.expenses WHERE owner = ?){} '
+        'ORDER BY dt DESC, updateid DESC LIMIT ?'
+    ).format(
+        ', '.join(db.COLUMNS),
+        ''.join(
+            ' AND ({})'.format(' OR '.join("{} LIKE ? ESCAPE '\\'".format(column) for column in SEARCH_COLUMNS))
+            for _ in terms
+        )
+    )
+    patterns = ['%{}%'.format(term.replace('_', '\\_')) for term in terms for _ in SEARCH_COLUMNS]
+    return shard.fetch(statement, [owner, owner] + patterns + [size], True)
+
+def explain(database, filter) -> list:
+    """
+    Returns the query plan details of a filter.
+    """
+    text, values = statement(filter)
+    return [row[-1] for row in database.fetch('EXPLAIN QUERY PLAN ' + text, values, archived(filter))]
+
+def shapes(owners=(1, 2)) -> list:
+    """
+    Returns a filter for every supported filter shape.
+    """
+    filters = []
+    for count in (1, len(owners)):
+        for period in PERIODS:
+            for order in ORDERS:
+                for above in (None, True, False):
+                    for field, value in ((None, None), ('shop', 'x'), ('location', 'x'), ('payment', 'x'), ('verified', True), ('verified', False)):
+                        options = {field: value} if field else {}
+                        filters.append(Filter(
+                            owners[:count],
+                            period=period,
+                            above=above,
+                            amount=None if above is None else 100,
+                            order=order,
+                            **options
+                        ))
+    return filters
+
+#############
+# VARIABLES #
+#############
+
+PAGE_SIZE = 20
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+WORD = re.compile(r'\w+')
+SEARCH_COLUMNS = ('description', 'shop', 'location', 'purpose')
+SEARCH_WEIGHTS = (0.0, 2.0, 2.0, 1.0, 1.0)
+
+PERIODS = ('day', 'week', 'month', 'year', 'all')
+
+# Rows are merged on fields of the schema, or on the home amount selected after them
+ORDER_KEYS = {
+    'date': (('datetime', 'updateid'), True),
+    'amount': (('home',), True),
+    'shop': (('shop',), False),
+    'location': (('location',), False),
+    'payment': (('payment',), False),
+}
+
+ORDERS = {
+    'date': 'dt DESC, updateid DESC',
+    'amount': db.HOME + ' DESC',
+    'shop': 'shop ASC',
+    'location': 'location ASC',
+    'payment': 'payment ASC',
+}
@@ -0,0 +1,261 @@
+import collections
+import functools
+import os
+import queue
+import threading
+import time
+
+from datetime import (
+    timedelta,
+)
+from telegram import (
+    Update,
+)
+from telegram.error import (
+    NetworkError,
+)
+from telegram.ext import (
+    Dispatcher,
+    JobQueue,
+)
+
+import ex_ANALYTICS as analytics
+import ex_BOT as bot
+import ex_BUDGET as budget
+import ex_CHART as chart
+import ex_DIGEST as digest
+import ex_IMAGE as image
+import ex_LEDGER as ledger
+import ex_METRICS as metrics
+import ex_OCR as ocr
+import ex_SQL as db
+import ex_STATE as state
+import ex_WEBHOOK as webhook
+
+class FakeFile:
+    """
+    Stands in for a Telegram file and returns fixed content.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def download_as_bytearray(self) -> bytearray:
+        return bytearray(self.data)
+
+    def download(self, custom_path=None, out=None, timeout=None):
+        if out is not None:
+            out.write(self.data)
+            return out
+        with open(custom_path, 'wb') as file:
+            file.write(self.data)
+        return custom_path
+
+class FakeBot:
+    """
+    Stands in for the Telegram bot and records every reply instead of sending it.
+    > Files hold the content served by get_file for a file id, which otherwise serves the file id itself.
+    > Failures hold the number of network errors get_file raises for a file id before it succeeds.
+    """
+    def __init__(self, files=None, failures=None):
+        self.replies = collections.Counter()
+        self.username = 'replay_bot'
+        self.id = 0
+        self.defaults = None
+        self.files = dict(files or {})
+        self.failures = collections.Counter(failures or {})
+        self.downloads = collections.Counter()
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs) -> None:
+        self.replies[chat_id] += 1
+
+    def send_photo(self, chat_id, photo, **kwargs) -> None:
+        self.replies[chat_id] += 1
+
+    def send_document(self, chat_id, document, **kwargs) -> None:
+        self.replies[chat_id] += 1
+
+    def answer_callback_query(self, callback_query_id, **kwargs) -> None:
+        pass
+
+    def edit_message_reply_markup(self, chat_id=None, message_id=None, **kwargs) -> None:
+        pass
+
+    def get_file(self, file_id) -> FakeFile:
+        with self.lock:
+            self.downloads[file_id] += 1
+            if self.failures[file_id] > 0:
+                self.failures[file_id] -= 1
+                raise NetworkError('Fake network error')
+        return FakeFile(self.files.get(file_id, file_id.encode()))
+
+class FakeClock:
+    """
+    Stands in for the clock.
+    Time only passes when the clock is advanced or asked to sleep.
+    """
+    def __init__(self, start):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def monotonic(self) -> float:
+        return self.time.timestamp()
+
+    def sleep(self, seconds) -> None:
+        self.time += timedelta(seconds=seconds)
+
+    def advance(self, **kwargs) -> None:
+        self.time += timedelta(**kwargs)
+
+class Harness:
+    """
+    Drives the real conversation handlers offline against a temporary database.
+    > Replies are recorded by a fake bot.
+    > Handlers and database writes are timed while the harness is open.
+    > Updates can be handled in order, or concurrently by the webhook workers.
+    Handlers, statements and images are instrumented as in the bot if a metrics registry is given.
+    Expenses are spread over as many shard databases as requested.
+    """
+    def __init__(self, directory, registry=None, shards=1):
+        self.timings = collections.defaultdict(list)
+        self.originals = {name: getattr(bot, name) for name in TIMED}
+        for name in TIMED:
+            setattr(bot, name, timed(self.timings[name], self.originals[name]))
+
+        self.database = db.Router(os.path.join(directory, 'replay.db'), shards, metrics=registry)
+        db.setup(self.database)
+        self.writer = db.Writers(self.database, os.path.join(directory, 'replay.journal'))
+        self.writer.start()
+        self.writer.add = timed(self.timings['db.add'], self.writer.add)
+        self.images = image.Pipeline(self.database.main, os.path.join(directory, 'receipts'), metrics=registry)
+        self.reader = ocr.Reader(self.database.main)
+        self.charts = chart.Renderer(os.path.join(directory, 'charts'))
+
+        self.bot = FakeBot()
+        self.persistence = state.Persistence(self.database.main)
+        self.jobs = JobQueue()
+        self.dispatcher = Dispatcher(self.bot, queue.Queue(), workers=1, job_queue=self.jobs, persistence=self.persistence)
+        self.jobs.set_dispatcher(self.dispatcher)
+        self.dispatcher.bot_data.update(
+            database=self.database, writer=self.writer, images=self.images, ocr=self.reader,
+            analytics=analytics.Cache(self.database), budgets=budget.Budgets(self.database),
+            ledger=ledger.Ledger(self.database), charts=self.charts,
+            digests=digest.Scheduler(self.database, digest.TokenBucket(bot.DIGEST_RATE, bot.DIGEST_BURST), bot.compose_digest)
+        )
+        bot.register(self.dispatcher)
+        if registry is not None:
+            metrics.instrument(registry, self.dispatcher)
+        self.workers = threading.Thread(target=self.dispatcher.start, name='dispatcher')
+        self.workers.start()
+        self.jobs.start()
+        self.update_id = 0
+
+    def close(self) -> None:
+        """
+        Flushes every pending write and restores the timed handlers.
+        """
+        self.jobs.stop()
+        self.dispatcher.stop()
+        self.workers.join()
+        self.persistence.flush()
+        self.charts.stop()
+        self.reader.stop()
+        self.images.stop()
+        self.writer.stop()
+        self.database.close()
+        for name, original in self.originals.items():
+            setattr(bot, name, original)
+
+    def message(self, chat, text=None, photo=None, sender=None, document=None) -> dict:
+        """
+        Builds the payload of an update carrying a message from a chat.
+        Messages from a sender other than the chat come from a group chat.
+        Documents are given by file name, which is also their file id.
+        """
+        self.update_id += 1
+        message = {
+            'message_id': self.update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat, 'type': 'private', 'first_name': 'Replay'},
+            'from': {'id': chat, 'is_bot': False, 'first_name': 'Replay'},
+        }
+        if sender is not None:
+            message['chat'] = {'id': chat, 'type': 'group', 'title': 'Replay'}
+            message['from'] = {'id': sender, 'is_bot': False, 'first_name': 'Member{}'.format(sender)}
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                command = text.split()[0]
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        if photo is not None:
+            message['photo'] = [{'file_id': photo, 'file_unique_id': photo, 'width': 1, 'height': 1}]
+        if document is not None:
+            message['document'] = {'file_id': document, 'file_unique_id': document, 'file_name': document}
+        return {'update_id': self.update_id, 'message': message}
+
+    def send(self, payload) -> None:
+        """
+        Handles an update immediately on the current thread.
+        """
+        self.dispatcher.process_update(Update.de_json(payload, self.bot))
+
+    def replay(self, payloads, workers=4, capacity=1024) -> tuple:
+        """
+        Handles updates concurrently with the webhook workers, redelivering deferred updates.
+        Returns the elapsed time and the number of deferrals.
+        """
+        server = webhook.Server(self.dispatcher, '127.0.0.1', 0, '/replay', workers, capacity)
+        server.start()
+        start = time.perf_counter()
+        for payload in payloads:
+            while not server.receive(payload):
+                time.sleep(0.001)
+        while server.metrics['handled'] < len(payloads):
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        server.stop()
+        return elapsed, server.metrics['deferred']
+
+def timed(samples, function):
+    """
+    Wraps a function to record the duration of every call.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+    return wrapper
+
+def manual_conversation(harness, chat) -> list:
+    """
+    Builds the updates of a complete /add conversation.
+    """
+    texts = ['/add', '/date', 'Lunch', '12.50', 'Hawker Centre', 'Clementi', 'Work', 'Credit', 'Yes']
+    return [harness.message(chat, text) for text in texts]
+
+def simple_conversation(harness, chat) -> list:
+    """
+    Builds the updates of a complete /simple conversation.
+    """
+    texts = ['/simple\nCoffee\n4.20\nStarbucks\nRaffles Place\nBreakfast', 'Debit', 'Skip']
+    return [harness.message(chat, text) for text in texts]
+
+def interleave(conversations) -> list:
+    """
+    Interleaves the updates of many conversations as concurrent chats would send them.
+    """
+    updates = []
+    for step in range(max(len(conversation) for conversation in conversations)):
+        updates.extend(conversation[step] for conversation in conversations if step < len(conversation))
+    return updates
+
+#############
+# VARIABLES #
+#############
+
+TIMED = ['manual_progress', 'manual_complete', 'simple_add', 'simple_progress']
@@ -1,55 +1,1142 @@
+import argparse
+import collections
+import functools
+import json
+import logging
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+
+from datetime import (
+    timedelta,
+)
 
 from ex_BUILTINS import (
+    SCHEMA,
     EXPECTED_INFORMATION,
 )
+from ex_CURRENCY import (
+    Rates,
+)
+
+logger = logging.getLogger(__name__)
+
+class Database:
+    """
+    Manages long-lived connections to the SQL database.
+    Each thread that touches the database keeps its own connection.
+    > Connections are opened lazily and reused for every later statement.
+    > Prepared statements are cached per connection.
+    The version of an owner is increased whenever expenses of that owner are written.
+    Every connection can convert amounts to the home currency with the SQL functions convert(amount, currency, dt) and factor(currency, dt).
+    > They are only called when expenses are written, so the stored home amounts never change when rates are reloaded.
+    The yearly archives of the database are only attached to a connection when its history is queried, and only those the query needs.
+    Statements executed through the manager are timed if a metrics registry is given.
+    """
+    def __init__(self, dbname, pragmas=None, cached_statements=256, rates=None, metrics=None):
+        self.dbname = dbname
+        self.pragmas = PRAGMAS if pragmas is None else pragmas
+        self.cached_statements = cached_statements
+        self.rates = rates or Rates()
+        self.metrics = metrics
+        self.local = threading.local()
+        self.connections = []
+        self.versions = collections.Counter()
+        self.listing = None
+        self.lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the current thread.
+        Opens and tunes a new connection if the thread does not have one yet.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.dbname,
+                cached_statements=self.cached_statements,
+                check_same_thread=False
+            )
+            for pragma in self.pragmas:
+                conn.execute(pragma)
+            conn.create_function('convert', 3, self.rates.convert)
+            conn.create_function('factor', 2, lambda currency, dt: self.rates.factor(currency, dt or ''))
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def archives(self) -> list:
+        """
+        Returns the (year, path) of every archive of the database, oldest first.
+        > The directory of the database is only listed again once it changed since it was last listed.
+        > Directory times are coarse, so a listing is not kept until the directory has been unchanged for a second.
+        """
+        try:
+            modified = os.stat(os.path.dirname(os.path.abspath(self.dbname))).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        listing = self.listing
+        if listing is not None and listing[0] == modified:
+            return listing[1]
+        current = archives(self.dbname)
+        if time.time_ns() - modified > SETTLED_NS:
+            self.listing = (modified, current)
+        return current
+
+    def history(self, since=None) -> sqlite3.Connection:
+        """
+        Returns the connection of the current thread with the archives of the years since a date attached, or every archive without one.
+        > The temporary view history is the union of the live expenses and the expenses of the attached archives.
+        > Archives hold whole years, so the archive of the year of the date is attached, and those of every later year.
+        > Archives are only attached and detached as the archives a query needs change, and archives still needed stay attached.
+        """
+        conn = self.connection()
+        attached = getattr(self.local, 'archives', None)
+        needed = [(year, path) for year, path in self.archives() if since is None or year >= since[:4]]
+        if needed != attached:
+            conn.execute('DROP VIEW IF EXISTS temp.history')
+            for year, path in attached or []:
+                if (year, path) not in needed:
+                    conn.execute('DETACH DATABASE archive_{}'.format(year))
+            for year, path in needed:
+                if (year, path) not in (attached or []):
+                    conn.execute('ATTACH DATABASE ? AS archive_{}'.format(year), (path,))
+            conn.execute('CREATE TEMP VIEW history AS {}'.format(' UNION ALL '.join(
+                'SELECT {} FROM {}.expenses'.format(', '.join(STORED), schema)
+                for schema in ['main'] + ['archive_{}'.format(year) for year, _ in needed]
+            )))
+            self.local.archives = needed
+        return conn
+
+    def execute(self, statement, values=()) -> None:
+        """
+        Executes a single statement in its own transaction.
+        """
+        start = time.perf_counter()
+        conn = self.connection()
+        with conn:
+            conn.execute(statement, values)
+        if self.metrics is not None:
+            self.metrics.statement(statement, time.perf_counter() - start)
+
+    def executemany(self, statement, rows) -> None:
+        """
+        Executes a statement for every row in a single transaction.
+        """
+        start = time.perf_counter()
+        conn = self.connection()
+        with conn:
+            conn.executemany(statement, rows)
+        if self.metrics is not None:
+            self.metrics.statement(statement, time.perf_counter() - start)
+
+    def fetch(self, statement, values=(), archives=False, since=None) -> list:
+        """
+        Executes a single statement and returns all resulting rows.
+        Statements querying the history view require archives, and only the archives since a date are attached if one is given.
+        """
+        start = time.perf_counter()
+        conn = self.history(since) if archives else self.connection()
+        rows = conn.execute(statement, values).fetchall()
+        if self.metrics is not None:
+            self.metrics.statement(statement, time.perf_counter() - start)
+        return rows
+
+    def changed(self, owners) -> None:
+        """
+        Increases the version of every owner whose expenses were written.
+        """
+        with self.lock:
+            for owner in set(owners):
+                self.versions[owner] += 1
+
+    def version(self, owner) -> int:
+        """
+        Returns the number of times expenses of an owner were written.
+        """
+        return self.versions[owner]
+
+    def close(self) -> None:
+        """
+        Closes every connection opened by the manager.
+        """
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+    @property
+    def main(self) -> 'Database':
+        return self
+
+    @property
+    def shards(self) -> list:
+        return [self]
+
+    def shard(self, owner) -> 'Database':
+        """
+        Returns the database storing the expenses of an owner, which is always this one.
+        A single database behaves as a router with a single shard.
+        """
+        return self
+
+    def partition(self, owners) -> list:
+        """
+        Returns the owners grouped by the database storing their expenses.
+        """
+        return [(self, list(owners))]
+
+    def fan_out(self, statement, values=(), archives=False) -> list:
+        """
+        Executes a single statement and returns its rows as the rows of a single shard.
+        """
+        return [self.fetch(statement, values, archives)]
 
-def setup(dbname) -> None:
+class Router:
     """
-    Sets up the SQL database.
+    Spreads the expenses of owners over several shard databases.
+    > Owners are mapped to shards by jump consistent hashing, so that adding a shard only moves the owners it takes over.
+    > Every shard is a separate database file with its own connections, and is written by its own writer.
+    > The first shard is the main database, which also stores the data shared by every owner.
+    Tables whose rows belong to an owner are sharded, and every other table is only used in the main database.
+    > Statements read the main database, the shard of an owner, or every shard through fan_out.
     """
+    def __init__(self, dbname, count=1, rates=None, **options):
+        self.dbname = dbname
+        self.rates = rates or Rates()
+        self.shards = [Database(shard_path(dbname, index), rates=self.rates, **options) for index in range(count)]
+        self.main = self.shards[0]
+
+    def index(self, owner) -> int:
+        """
+        Returns the index of the shard storing the expenses of an owner.
+        """
+        return jump(int(owner), len(self.shards))
+
+    def shard(self, owner) -> Database:
+        """
+        Returns the shard storing the expenses of an owner.
+        """
+        return self.shards[jump(int(owner), len(self.shards))]
+
+    def partition(self, owners) -> list:
+        """
+        Returns the owners grouped by the shard storing their expenses.
+        """
+        groups = collections.defaultdict(list)
+        for owner in owners:
+            groups[self.index(owner)].append(owner)
+        return [(self.shards[index], group) for index, group in sorted(groups.items())]
+
+    def fetch(self, statement, values=(), archives=False) -> list:
+        """
+        Executes a single statement on the main database, which stores every table shared by the owners.
+        > Statements over the rows of an owner must be executed on the shard of the owner.
+        """
+        return self.main.fetch(statement, values, archives)
+
+    def fan_out(self, statement, values=(), archives=False) -> list:
+        """
+        Executes a single statement on every shard and returns the rows of every shard separately, in shard order.
+        > Rows are never concatenated, as the order, limit and aggregates of a statement only hold within a shard.
+        """
+        return [shard.fetch(statement, values, archives) for shard in self.shards]
+
+    def changed(self, owners) -> None:
+        """
+        Increases the version of every owner whose expenses were written.
+        """
+        for shard, group in self.partition(set(owners)):
+            shard.changed(group)
+
+    def version(self, owner) -> int:
+        """
+        Returns the number of times expenses of an owner were written.
+        """
+        return self.shard(owner).version(owner)
+
+    def close(self) -> None:
+        """
+        Closes the connections of every shard.
+        """
+        for shard in self.shards:
+            shard.close()
+
+class Writer:
+    """
+    Writes rows to the database behind the handlers.
+    Handlers enqueue rows and return immediately.
+    A single writer thread drains the queue in batched transactions.
+    > A batch is flushed once it reaches batch_size rows or interval seconds.
+    > Every queued row is appended to a journal first and replayed on start.
+    > A batch which fails to flush is retried with exponential backoff, and never dropped.
+    Failures are counted, and the writer reports itself unhealthy while its last flush failed or its thread has died.
+    """
+    def __init__(self, database, journal, batch_size=500, interval=0.5, sync=False, backoff=0.1, retries=None):
+        self.database = database
+        self.journal = journal
+        self.batch_size = batch_size
+        self.interval = interval
+        self.sync = sync
+        self.backoff = backoff
+        self.retries = STOP_RETRIES if retries is None else retries
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.file = None
+        self.thread = None
+        self.failures = 0
+        self.error = None
+        self.held = 0
+
+    def start(self) -> None:
+        """
+        Replays the journal left behind by a previous run.
+        Starts the writer thread.
+        """
+        self.replay()
+        self.file = open(self.journal, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self.run, name='writer', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """
+        Flushes every queued row and stops the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+    def add(self, user_data) -> None:
+        """
+        Journals the values from user_data and queues them for the database.
+        """
+        self.put(values(user_data))
+
+    def put(self, row) -> None:
+        """
+        Journals a row and queues it for the database.
+        """
+        with self.lock:
+            self.file.write(json.dumps(row) + '\n')
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+            self.queue.put(row)
+
+    def replay(self) -> None:
+        """
+        Inserts every row recorded in the journal.
+        Rows which were already flushed are ignored.
+        > A last line cut short by a crash is skipped, as its row was never queued.
+        Raises a ValueError if any other line is corrupt.
+        """
+        if not os.path.exists(self.journal):
+            return
+        with open(self.journal, encoding='utf-8') as file:
+            lines = [line for line in file if line.strip()]
+        rows = []
+        for number, line in enumerate(lines, 1):
+            try:
+                rows.append(tuple(json.loads(line)))
+            except ValueError:
+                if number < len(lines):
+                    raise
+                logger.warning('Skipping the partial last line of the journal %s', self.journal)
+        # Rows journaled before columns were added to the schema are padded
+        rows = [row + ('',) * (len(COLUMNS) - len(row)) for row in rows]
+        if rows:
+            self.database.executemany(INSERT, rows)
+            self.database.changed(row[0] for row in rows)
+        open(self.journal, 'w').close()
+
+    def healthy(self) -> bool:
+        """
+        Returns whether the writer thread is running and its last flush succeeded.
+        """
+        return self.thread is not None and self.thread.is_alive() and self.error is None
+
+    def health(self) -> list:
+        """
+        Returns the problems of the writer, if any.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return ['writer {} is not running'.format(self.journal)]
+        if self.error is not None:
+            return ['writer {} is failing: {}'.format(self.journal, self.error)]
+        return []
+
+    def collect(self) -> list:
+        """
+        Returns the state of the writer as (name, labels, value) samples of a metrics registry.
+        """
+        labels = (os.path.basename(self.journal),)
+        return [
+            ('writer_up', labels, int(self.healthy())),
+            ('writer_pending_rows', labels, self.queue.qsize() + self.held),
+            ('writer_failures_total', labels, self.failures),
+        ]
+
+    def run(self) -> None:
+        """
+        Drains the queue until a stop request is received.
+        A batch which fails is retried until it is stored.
+        > Once a stop request is received, a failing batch is only retried a few times, and stays in the journal.
+        """
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if batch[-1] is None or timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            attempt = 0
+            self.held = len(batch)
+            while not self.flush(batch):
+                attempt += 1
+                if not running and attempt > self.retries:
+                    logger.error('Leaving %d rows in the journal %s after %d failed flushes', len(batch), self.journal, attempt)
+                    return
+                time.sleep(min(self.backoff * 2 ** (attempt - 1), MAXIMUM_BACKOFF))
+            self.held = 0
+
+    def flush(self, batch) -> bool:
+        """
+        Inserts a batch of rows in a single transaction.
+        Truncates the journal once every journaled row has been stored.
+        Returns False if the batch could not be stored.
+        """
+        try:
+            if batch:
+                self.database.executemany(INSERT, batch)
+                self.database.changed(row[0] for row in batch)
+        except Exception as error:
+            self.failures += 1
+            self.error = error
+            logger.exception('Failed to write %d rows to %s', len(batch), self.database.dbname)
+            return False
+        self.error = None
+        with self.lock:
+            if self.queue.empty():
+                self.file.truncate(0)
+        return True
+
+class Writers:
+    """
+    Keeps a writer for every shard of a router, each with its own thread and journal.
+    Rows are queued on the writer of the shard of their owner.
+    """
+    def __init__(self, router, journal, **options):
+        self.router = router
+        self.writers = [
+            Writer(shard, shard_path(journal, index), **options) for index, shard in enumerate(router.shards)
+        ]
+
+    def start(self) -> None:
+        """
+        Starts the writer of every shard.
+        """
+        for writer in self.writers:
+            writer.start()
+
+    def stop(self) -> None:
+        """
+        Flushes and stops the writer of every shard.
+        """
+        for writer in self.writers:
+            writer.stop()
+
+    def add(self, user_data) -> None:
+        """
+        Journals the values from user_data and queues them for the shard of their owner.
+        """
+        self.put(values(user_data))
+
+    def put(self, row) -> None:
+        """
+        Journals a row and queues it for the shard of its owner.
+        """
+        self.writers[self.router.index(row[0])].put(row)
+
+    def health(self) -> list:
+        """
+        Returns the problems of every writer.
+        """
+        return [problem for writer in self.writers for problem in writer.health()]
+
+    def collect(self) -> list:
+        """
+        Returns the state of every writer as (name, labels, value) samples of a metrics registry.
+        """
+        return [sample for writer in self.writers for sample in writer.collect()]
+
+def setup(database) -> None:
+    """
+    Sets up the SQL database, or every shard of a router.
+    Columns added to the schema since the expenses table was created are added to it.
+    The summary triggers are recreated so that databases set up by earlier versions use the current definitions.
+    Archives are given the columns added since they were created.
+    The sequence of imported update ids starts below the lowest update id stored in any shard or archive.
+    """
+    for shard in database.shards:
+        setup_shard(shard)
+
+    if not database.main.fetch('SELECT 1 FROM sequences WHERE name = ?', ('import',)):
+        lowest = [
+            row[0] for shard in database.shards
+            for row in shard.fetch('SELECT MIN(updateid) FROM history', archives=True) if row[0] is not None
+        ]
+        database.main.execute('INSERT OR IGNORE INTO sequences VALUES (?,?)', ('import', min([0] + lowest)))
+
+def setup_shard(database) -> None:
+    """
+    Sets up a single SQL database and its archives.
+    > Expenses stored by earlier versions are given their home amounts with the rates currently loaded, and the summaries and balances are rebuilt from them.
+    """
+    for _, path in archives(database.dbname):
+        setup_archive(path)
+
     statements = [
-        'CREATE TABLE IF NOT EXISTS expenses (\
-            owner string, \
-            updateid integer, \
-            dt datetime, \
-            description text, \
-            amount integer, \
-            shop string, \
-            location string, \
-            purpose text, \
-            payment string, \
-            verified string)',
+        SCHEMA.create,
+        'CREATE UNIQUE INDEX IF NOT EXISTS updateidIndex ON expenses (updateid)',
         'CREATE INDEX IF NOT EXISTS itemIndex ON expenses (description ASC)',
         'CREATE INDEX IF NOT EXISTS ownerIndex ON expenses (owner ASC)',
-        'CREATE INDEX IF NOT EXISTS datetimeIndex ON expenses (datetime DESC)',
-        'CREATE INDEX IF NOT EXISTS pendingIndex ON expenses (verified ASC)'
+        'CREATE INDEX IF NOT EXISTS datetimeIndex ON expenses (dt DESC)',
+        'CREATE INDEX IF NOT EXISTS pendingIndex ON expenses (verified ASC)',
+        'CREATE INDEX IF NOT EXISTS ownerDateIndex ON expenses (owner, dt, updateid)',
+        'CREATE INDEX IF NOT EXISTS ownerShopIndex ON expenses (owner, shop, dt)',
+        'CREATE INDEX IF NOT EXISTS ownerLocationIndex ON expenses (owner, location, dt)',
+        'CREATE INDEX IF NOT EXISTS ownerPaymentIndex ON expenses (owner, payment, dt)',
+        'CREATE INDEX IF NOT EXISTS ownerVerifiedIndex ON expenses (owner, verified, dt)',
+        'CREATE TABLE IF NOT EXISTS images (\
+            updateid integer PRIMARY KEY, \
+            hash text, \
+            path text, \
+            format text, \
+            thumbnail text)',
+        # Earlier versions recorded the format of the downloaded image instead of its normalised copy
+        'UPDATE images SET format = \'jpg\' WHERE path LIKE \'%.full.jpg\' AND format != \'jpg\'',
+        'CREATE TABLE IF NOT EXISTS ocr (\
+            hash text PRIMARY KEY, \
+            fields text)',
+        'CREATE TABLE IF NOT EXISTS user_data (\
+            user_id integer PRIMARY KEY, \
+            data text)',
+        'CREATE TABLE IF NOT EXISTS conversations (\
+            name text, \
+            key text, \
+            state integer, \
+            PRIMARY KEY (name, key)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS summaries (\
+            owner string, \
+            grain text, \
+            bucket text, \
+            payment string, \
+            verified string, \
+            total integer, \
+            count integer, \
+            PRIMARY KEY (owner, grain, bucket, payment, verified)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS budgets (\
+            owner string, \
+            period text, \
+            field text, \
+            value text, \
+            amount integer, \
+            PRIMARY KEY (owner, period, field, value)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS members (\
+            owner string, \
+            member integer, \
+            name text, \
+            PRIMARY KEY (owner, member)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS balances (\
+            owner string, \
+            member integer, \
+            balance integer, \
+            PRIMARY KEY (owner, member)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS sequences (\
+            name text PRIMARY KEY, \
+            value integer) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS schedules (\
+            owner integer PRIMARY KEY, \
+            frequency text, \
+            hour integer, \
+            next text)',
+        'CREATE INDEX IF NOT EXISTS scheduleIndex ON schedules (next)',
+        'CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5 (\
+            owner, \
+            description, \
+            shop, \
+            location, \
+            purpose, \
+            content = expenses, \
+            content_rowid = updateid, \
+            prefix = \'2 3\', \
+            tokenize = \'unicode61 remove_diacritics 2\')',
+        'CREATE TRIGGER IF NOT EXISTS searchInsert AFTER INSERT ON expenses BEGIN {} END'.format(
+            search_statement('NEW', False)
+        ),
+        'CREATE TRIGGER IF NOT EXISTS searchDelete AFTER DELETE ON expenses BEGIN {} END'.format(
+            search_statement('OLD', True)
+        ),
+        'CREATE TRIGGER IF NOT EXISTS searchUpdate AFTER UPDATE OF owner, updateid, description, shop, location, purpose ON expenses BEGIN {} {} END'.format(
+            search_statement('OLD', True), search_statement('NEW', False)
+        ),
+        'DROP TRIGGER IF EXISTS summariesInsert',
+        'DROP TRIGGER IF EXISTS summariesDelete',
+        'DROP TRIGGER IF EXISTS summariesUpdate',
+        'CREATE TRIGGER summariesInsert AFTER INSERT ON expenses BEGIN {} END'.format(
+            summary_statements('NEW', 1)
+        ),
+        'CREATE TRIGGER summariesDelete AFTER DELETE ON expenses BEGIN {} END'.format(
+            summary_statements('OLD', -1)
+        ),
+        'CREATE TRIGGER summariesUpdate AFTER UPDATE OF owner, dt, amount, payment, verified, currency, home ON expenses BEGIN {} {} END'.format(
+            summary_statements('OLD', -1), summary_statements('NEW', 1)
+        ),
+        'DROP TRIGGER IF EXISTS balancesInsert',
+        'DROP TRIGGER IF EXISTS balancesDelete',
+        'DROP TRIGGER IF EXISTS balancesUpdate',
+        'CREATE TRIGGER balancesInsert AFTER INSERT ON expenses WHEN NEW.shares != \'\' BEGIN {} END'.format(
+            balance_statements('NEW', 1)
+        ),
+        'CREATE TRIGGER balancesDelete AFTER DELETE ON expenses WHEN OLD.shares != \'\' BEGIN {} END'.format(
+            balance_statements('OLD', -1)
+        ),
+        'CREATE TRIGGER balancesUpdate AFTER UPDATE OF owner, dt, currency, payer, shares, rate ON expenses BEGIN {} {} END'.format(
+            balance_statements('OLD', -1), balance_statements('NEW', 1)
+        ),
     ]
 
-    with sqlite3.connect(dbname) as conn:
-        cur = conn.cursor()
-        for statement in statements:
-            cur.execute(statement)
-        conn.commit()
+    indexed = database.fetch('SELECT 1 FROM sqlite_master WHERE name = \'search\'')
+    conn = database.connection()
+    with conn:
+        conn.execute(statements[0])
+        existing = {row[1] for row in conn.execute('PRAGMA table_info({})'.format(SCHEMA.table))}
+        for field in EXPECTED_INFORMATION.values():
+            if field.column not in existing:
+                conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(SCHEMA.table, field.column, field.type))
+        converted = 0
+        if 'home' not in existing:
+            for column, (type, _) in CONVERTED.items():
+                conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(SCHEMA.table, column, type))
+            converted = conn.execute('UPDATE {} SET {}'.format(SCHEMA.table, ', '.join(
+                '{} = {}'.format(column, expression) for column, expression in zip(CONVERTED, conversions())
+            ))).rowcount
+        for statement in statements[1:]:
+            conn.execute(statement)
+
+    if converted or not database.fetch('SELECT 1 FROM summaries LIMIT 1'):
+        rebuild_summaries(database)
+    if not indexed:
+        rebuild_search(database)
+    if converted or not database.fetch('SELECT 1 FROM balances LIMIT 1'):
+        rebuild_balances(database)
+
+def setup_archive(path) -> None:
+    """
+    Creates or upgrades a yearly archive of the expenses.
+    > An archive only stores expenses, with the indexes answering queries over the expenses of an owner.
+    > A new archive is built under a temporary name, so that it is never attached before its table exists.
+    > Expenses archived before home amounts were stored keep none, and are read as amounts in the home currency.
+    """
+    target = path if os.path.exists(path) else path + '.tmp'
+    conn = sqlite3.connect(target)
+    try:
+        with conn:
+            conn.execute(SCHEMA.create)
+            existing = {row[1] for row in conn.execute('PRAGMA table_info({})'.format(SCHEMA.table))}
+            for field in EXPECTED_INFORMATION.values():
+                if field.column not in existing:
+                    conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(SCHEMA.table, field.column, field.type))
+            for column, (type, _) in CONVERTED.items():
+                if column not in existing:
+                    conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(SCHEMA.table, column, type))
+            for statement in ARCHIVE_INDEXES:
+                conn.execute(statement)
+    finally:
+        conn.close()
+    if target != path:
+        os.replace(target, path)
+
+def conversions(amount='amount', currency='currency', dt='dt') -> list:
+    """
+    Returns the expressions of the converted columns of an expense from the expressions of its amount, currency and date.
+    """
+    return [expression.format(amount=amount, currency=currency, dt=dt) for _, expression in CONVERTED.values()]
+
+def summary_statements(row, sign) -> str:
+    """
+    Builds the statements applying a row to every summary grain.
+    > A sign of 1 adds the row, a sign of -1 removes it.
+    > Amounts are the home amounts stored with the row, so that a row is removed with the amount it was added with.
+    """
+    statement = (
+        'INSERT INTO summaries VALUES ({0}.owner, \'{1}\', coalesce({2}, \'\'), {0}.payment, {0}.verified, '
+        '{3} * {4}, {3}) '
+        'ON CONFLICT (owner, grain, bucket, payment, verified) DO UPDATE SET '
+        'total = total + excluded.total, count = count + excluded.count;'
+    )
+    return ' '.join(
+        statement.format(row, grain, bucket.format(row), sign, HOME.format(row)) for grain, bucket in GRAINS.items()
+    )
+
+def balance_statements(row, sign) -> str:
+    """
+    Builds the statements applying the shares of a row to the balances of the members of its owner.
+    > A sign of 1 adds the row, a sign of -1 removes it.
+    > Every member is debited their share and the payer is credited the sum of the shares, so balances always sum to zero.
+    > Shares are converted to the home currency one by one with the rate stored with the row, so that rounding cannot break the sum.
+    """
+    share = SHARE.format(row)
+    shares = 'json_each(CASE WHEN json_valid({0}.shares) THEN {0}.shares END)'.format(row)
+    upsert = 'ON CONFLICT (owner, member) DO UPDATE SET balance = balance + excluded.balance;'
+    return (
+        'INSERT INTO balances SELECT {0}.owner, CAST(key AS INTEGER), {1} * -{2} FROM {3} WHERE 1 {4} '
+        'INSERT INTO balances SELECT {0}.owner, {0}.payer, {1} * SUM({2}) FROM {3} '
+        'WHERE {0}.payer != \'\' HAVING COUNT(*) > 0 {4}'
+    ).format(row, sign, share, shares, upsert)
+
+def search_statement(row, delete) -> str:
+    """
+    Builds the statement adding a row to the full-text index, or removing it if delete is requested.
+    """
+    columns = ', '.join('{}.{}'.format(row, column) for column in SEARCH_COLUMNS)
+    if delete:
+        return 'INSERT INTO search (search, rowid, {}) VALUES (\'delete\', {}.updateid, {});'.format(
+            ', '.join(SEARCH_COLUMNS), row, columns
+        )
+    return 'INSERT INTO search (rowid, {}) VALUES ({}.updateid, {});'.format(', '.join(SEARCH_COLUMNS), row, columns)
+
+def bucket(grain, now) -> str:
+    """
+    Returns the summary bucket of a datetime, matching the buckets built by the triggers.
+    """
+    if grain == 'week':
+        now = now - timedelta(days=now.weekday())
+    return now.strftime(BUCKET_FORMATS[grain])
+
+def summary(database, owner, grain, now) -> list:
+    """
+    Returns the (payment, verified, total, count) summaries of an owner for the bucket containing now.
+    """
+    return database.shard(owner).fetch(
+        'SELECT payment, verified, total, count FROM summaries '
+        'WHERE owner = ? AND grain = ? AND bucket = ? AND count > 0 ORDER BY payment, verified',
+        (owner, grain, bucket(grain, now))
+    )
+
+def rebuild_summaries(database, repair=True) -> int:
+    """
+    Recomputes the summaries from the expenses table, in every shard of a router.
+    Returns the number of summary rows which had drifted.
+    Replaces the stored summaries with the recomputed ones if repair is requested.
+    """
+    return sum(rebuild_shard_summaries(shard, repair) for shard in database.shards)
+
+def rebuild_shard_summaries(database, repair) -> int:
+    """
+    Recomputes the summaries of a single database.
+    """
+    rows = ' UNION ALL '.join(
+        'SELECT owner, \'{}\' AS grain, coalesce({}, \'\') AS bucket, payment, verified, '
+        '{} AS amount FROM expenses'.format(grain, bucket.format('expenses'), HOME.format('expenses'))
+        for grain, bucket in GRAINS.items()
+    )
+    computed = (
+        'SELECT owner, grain, bucket, payment, verified, SUM(amount), COUNT(*) FROM ({}) '
+        'GROUP BY owner, grain, bucket, payment, verified'.format(rows)
+    )
+    stored = 'SELECT * FROM summaries WHERE count != 0'
+
+    conn = database.connection()
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS temp.computed')
+        conn.execute('CREATE TEMP TABLE computed AS ' + computed)
+        drift = conn.execute(
+            'SELECT (SELECT COUNT(*) FROM (SELECT * FROM temp.computed EXCEPT {0})) '
+            '+ (SELECT COUNT(*) FROM ({0} EXCEPT SELECT * FROM temp.computed))'.format(stored)
+        ).fetchone()[0]
+        if repair and drift:
+            conn.execute('DELETE FROM summaries')
+            conn.execute('INSERT INTO summaries SELECT * FROM temp.computed')
+        conn.execute('DROP TABLE temp.computed')
+
+    return drift
+
+def balances(database, owner) -> list:
+    """
+    Returns the (member, balance) pairs of an owner whose balance is not settled, from the primary key alone.
+    > A positive balance is owed to the member, a negative balance is owed by the member.
+    """
+    return database.shard(owner).fetch(
+        'SELECT member, balance FROM balances WHERE owner = ? AND balance != 0 ORDER BY member', (owner,)
+    )
+
+def rebuild_balances(database, repair=True) -> int:
+    """
+    Recomputes the balances from the payer and shares of every expense, in every shard of a router.
+    Returns the number of balances which had drifted.
+    Replaces the stored balances with the recomputed ones if repair is requested.
+    """
+    return sum(rebuild_shard_balances(shard, repair) for shard in database.shards)
+
+def rebuild_shard_balances(database, repair) -> int:
+    """
+    Recomputes the balances of a single database.
+    """
+    shares = (
+        'SELECT expenses.owner AS owner, expenses.payer AS payer, CAST(key AS INTEGER) AS member, '
+        '{} AS share '
+        'FROM expenses, json_each(CASE WHEN json_valid(expenses.shares) THEN expenses.shares END) '
+        'WHERE expenses.shares != \'\''.format(SHARE.format('expenses'))
+    )
+    computed = (
+        'SELECT owner, member, SUM(balance) FROM ('
+        'SELECT owner, member, -share AS balance FROM shares '
+        'UNION ALL SELECT owner, payer, share FROM shares WHERE payer != \'\') '
+        'GROUP BY owner, member HAVING SUM(balance) != 0'
+    )
+    stored = 'SELECT * FROM balances WHERE balance != 0'
+
+    conn = database.connection()
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS temp.computed')
+        conn.execute('CREATE TEMP TABLE computed AS WITH shares AS ({}) {}'.format(shares, computed))
+        drift = conn.execute(
+            'SELECT (SELECT COUNT(*) FROM (SELECT * FROM temp.computed EXCEPT {0})) '
+            '+ (SELECT COUNT(*) FROM ({0} EXCEPT SELECT * FROM temp.computed))'.format(stored)
+        ).fetchone()[0]
+        if repair and drift:
+            conn.execute('DELETE FROM balances')
+            conn.execute('INSERT INTO balances SELECT * FROM temp.computed')
+        conn.execute('DROP TABLE temp.computed')
 
-def execute(statement, values) -> None:
-    with sqlite3.connect(DBNAME) as conn:
-        cur = conn.cursor()
-        cur.execute(statement, values)
-        conn.commit()
+    return drift
 
-def fetch(statement, values) -> list:
-    with sqlite3.connect(DBNAME) as conn:
-        cur = conn.cursor()
-        cur.execute(statement, values)
-        conn.commit()
-        return cur.fetchall()
+def rebuild_search(database) -> int:
+    """
+    Rebuilds the full-text index from the expenses table and checks it against the table, in every shard of a router.
+    Returns the number of expenses indexed.
+    """
+    indexed = 0
+    for shard in database.shards:
+        conn = shard.connection()
+        with conn:
+            conn.execute('INSERT INTO search (search) VALUES (\'rebuild\')')
+            conn.execute('INSERT INTO search (search, rank) VALUES (\'integrity-check\', 1)')
+        indexed += shard.fetch('SELECT COUNT(*) FROM search_docsize')[0][0]
+    return indexed
 
-def add(user_data) -> None:
+def values(user_data) -> tuple:
+    """
+    Builds a database row from the values in user_data.
+    """
+    return SCHEMA.values(user_data)
+
+def allocate(database, name, count) -> int:
+    """
+    Reserves count values of a descending sequence stored in the main database.
+    > The reservation is part of the open transaction of the main database on the current thread, if any.
+    > Otherwise it commits on its own, and values reserved by a transaction which then fails are never reused.
+    Returns the highest value reserved; the others follow it downwards.
+    """
+    conn = database.main.connection()
+    statement = 'UPDATE sequences SET value = value - ? WHERE name = ? RETURNING value'
+    if conn.in_transaction:
+        lowest = conn.execute(statement, (count, name)).fetchall()[0][0]
+    else:
+        with conn:
+            lowest = conn.execute(statement, (count, name)).fetchall()[0][0]
+    return lowest + count - 1
+
+def update(database, owner, updateid, changes) -> tuple:
+    """
+    Changes fields of an expense of an owner with a single UPDATE keyed on its unique updateid.
+    > Changes are keyed by the name of their information.
+    > The home amount is converted again if the amount, currency or date changes.
+    > The summaries are kept up to date by the update trigger.
+    Returns the expense before and after the change, or None if the owner has no such expense.
+    """
+    database = database.shard(owner)
+    conn = database.connection()
+    with conn:
+        before = conn.execute(
+            'SELECT {} FROM expenses WHERE updateid = ? AND owner = ?'.format(', '.join(COLUMNS)), (updateid, owner)
+        ).fetchone()
+        if before is None:
+            return None
+        after = tuple(changes.get(name, value) for name, value in zip(EXPECTED_INFORMATION, before))
+        assignments = ['{} = ?'.format(EXPECTED_INFORMATION[name].column) for name in changes]
+        values = list(changes.values())
+        if {'datetime', 'amount', 'currency'} & set(changes):
+            assignments += ['{} = {}'.format(column, expression) for column, expression in zip(CONVERTED, conversions('?', '?', '?'))]
+            amount, currency, dt = (after[SCHEMA.fields[name].index] for name in ('amount', 'currency', 'datetime'))
+            values += [amount, currency, dt, currency, dt]
+        conn.execute('UPDATE expenses SET {} WHERE updateid = ?'.format(', '.join(assignments)), values + [updateid])
+    database.changed([owner])
+    return before, after
+
+def verify(database, owner, updateids) -> int:
+    """
+    Marks unverified expenses of an owner as verified in a single transaction.
+    Returns the number of expenses verified.
+    """
+    database = database.shard(owner)
+    conn = database.connection()
+    with conn:
+        verified = conn.executemany(
+            'UPDATE expenses SET verified = 1 WHERE updateid = ? AND owner = ? AND {}'.format(UNVERIFIED),
+            [(updateid, owner) for updateid in updateids]
+        ).rowcount
+    if verified:
+        database.changed([owner])
+    return verified
+
+def add(database, user_data) -> None:
     """
     Adds the values from user_data to the database.
     """
-    statement = 'INSERT INTO expenses VALUES (?,?,?,?,?,?,?,?,?,?)'
-    values = tuple([user_data.get(name, '') for name in EXPECTED_INFORMATION])
+    row = values(user_data)
+    database = database.shard(row[0])
+    database.execute(INSERT, row)
+    database.changed([row[0]])
+
+@functools.lru_cache(maxsize=65536)
+def jump(owner, count) -> int:
+    """
+    Maps an owner onto one of count shards with jump consistent hashing.
+    > The owner is mixed first, so that consecutive chat ids spread evenly.
+    > Growing from count to count + 1 shards only moves the owners mapped onto the new shard.
+    """
+    if count == 1:
+        return 0
+    key = (owner & MASK) * 0x9E3779B97F4A7C15 & MASK
+    key = (key ^ (key >> 31)) * 0xBF58476D1CE4E5B9 & MASK
+    key ^= key >> 29
+    shard, following = -1, 0
+    while following < count:
+        shard = following
+        key = (key * 2862933555777941757 + 1) & MASK
+        following = int((shard + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return shard
+
+def shard_path(path, index) -> str:
+    """
+    Returns the path of a shard of a file.
+    > The first shard is the file itself, so that a single shard is the unsharded file.
+    """
+    if index == 0:
+        return path
+    root, extension = os.path.splitext(path)
+    return '{}.{}{}'.format(root, index, extension)
+
+def archive_path(path, year) -> str:
+    """
+    Returns the path of the archive of a database for a year.
+    """
+    root, extension = os.path.splitext(path)
+    return '{}-{}{}'.format(root, year, extension)
+
+def attach_limit(conn) -> int:
+    """
+    Returns the number of databases which can be attached to a connection at once.
+    > SQLite allows 10 unless it was built with a higher limit, up to 125.
+    """
+    getlimit = getattr(conn, 'getlimit', None)
+    return getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if getlimit else ATTACHED
+
+def archives(path) -> list:
+    """
+    Returns the (year, path) of every archive of a database, oldest first.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    root, extension = os.path.splitext(name)
+    pattern = re.compile(r'{}-(\d{{4}}){}$'.format(re.escape(root), re.escape(extension)))
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        (match.group(1), os.path.join(os.path.dirname(path), match.group(0)))
+        for match in map(pattern.match, names) if match
+    )
+
+def rebalance(dbname, count, previous, **options) -> int:
+    """
+    Moves every owner to its shard after the number of shards changed from previous to count.
+    > Every owner is moved in a single transaction on its source shard, with its target shard attached.
+    > Summaries, balances and the search index follow the moved expenses through the triggers.
+    > Archived expenses are moved to the archive of the target shard for the same year.
+    > Shards beyond count are left empty.
+    The bot must be stopped while owners are moved.
+    A move interrupted by a crash is completed by running the rebalance again.
+    Returns the number of owners moved.
+    """
+    router = Router(dbname, max(count, previous), **options)
+    setup(router)
+    moved = 0
+    for index, source in enumerate(router.shards):
+        owners = source.fetch(
+            ' UNION '.join(['SELECT owner FROM history'] + ['SELECT owner FROM {}'.format(table) for table in OWNED_TABLES]),
+            archives=True
+        )
+        for owner, in owners:
+            target = jump(int(owner), count)
+            if target != index:
+                move(source, router.shards[target], owner)
+                moved += 1
+    router.close()
+    return moved
+
+def move(source, target, owner) -> None:
+    """
+    Moves the rows of an owner from a source shard to a target shard.
+    """
+    conn = source.connection()
+    conn.execute('ATTACH DATABASE ? AS target', (target.dbname,))
+    try:
+        with conn:
+            for table, columns in OWNED_TABLES.items():
+                conn.execute(
+                    'INSERT OR IGNORE INTO target.{0} ({1}) SELECT {1} FROM main.{0} WHERE owner = ?'.format(table, columns),
+                    (owner,)
+                )
+                conn.execute('DELETE FROM main.{} WHERE owner = ?'.format(table), (owner,))
+            conn.execute('DELETE FROM main.summaries WHERE owner = ? AND count = 0', (owner,))
+            conn.execute('DELETE FROM main.balances WHERE owner = ? AND balance = 0', (owner,))
+    finally:
+        conn.execute('DETACH DATABASE target')
+    for year, path in archives(source.dbname):
+        move_archived(path, archive_path(target.dbname, year), owner)
+    source.changed([owner])
+    target.changed([owner])
+
+def move_archived(source, target, owner) -> None:
+    """
+    Moves the archived expenses of an owner from the archive of a source shard to the archive of a target shard for the same year.
+    """
+    conn = sqlite3.connect(source)
+    try:
+        if not conn.execute('SELECT 1 FROM expenses WHERE owner = ? LIMIT 1', (owner,)).fetchone():
+            return
+        setup_archive(target)
+        conn.execute('ATTACH DATABASE ? AS target', (target,))
+        with conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO target.expenses ({0}) SELECT {0} FROM main.expenses WHERE owner = ?'.format(', '.join(STORED)),
+                (owner,)
+            )
+            conn.execute('DELETE FROM main.expenses WHERE owner = ?', (owner,))
+        conn.execute('DETACH DATABASE target')
+    finally:
+        conn.close()
+
+########
+# MAIN #
+########
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Moves the expenses of owners to their shards after the number of shards changed.')
+    parser.add_argument('--db', default='expenses.db')
+    parser.add_argument('--shards', type=int, required=True)
+    parser.add_argument('--previous', type=int, required=True)
+    args = parser.parse_args()
+
+    moved = rebalance(args.db, args.shards, args.previous)
+    print('Moved {} owners.'.format(moved))
+
+#############
+# VARIABLES #
+#############
+
+COLUMNS = SCHEMA.columns
+
+# Databases attached to a connection at once by SQLite unless it was built otherwise, for Python versions which cannot ask it
+ATTACHED = 10
+
+# Directory times only advance at each tick of the clock, so a listing is only kept once its directory is this old
+SETTLED_NS = 10 ** 9
+
+# The home amount and conversion rate of an expense are stored when it is written, outside the schema of its fields
+# > Triggers read them instead of converting, so they never depend on the rates loaded or on functions only the bot defines
+CONVERTED = {
+    'home': ('integer', 'convert(CAST({amount} AS INTEGER), {currency}, {dt})'),
+    'rate': ('real', 'factor({currency}, {dt})'),
+}
+STORED = COLUMNS + list(CONVERTED)
+
+# Expenses written without a home amount, by other clients or archived before it was stored, are in the home currency
+HOME = 'coalesce({0}.home, CAST({0}.amount AS INTEGER))'
+SHARE = 'CAST(round(CAST(value AS INTEGER) * coalesce({0}.rate, 1)) AS INTEGER)'
+
+# Expenses whose verified status was never answered are stored with an empty verified, and are unverified too
+UNVERIFIED = 'verified IN (0, \'\')'
+
+# Parameters are numbered so that the converted columns reuse the amount, currency and date of the row
+INSERT = 'INSERT OR IGNORE INTO expenses ({}) VALUES ({})'.format(
+    ', '.join(STORED),
+    ', '.join(
+        ['?{}'.format(index) for index in range(1, len(COLUMNS) + 1)]
+        + conversions(*('?{}'.format(COLUMNS.index(name) + 1) for name in ('amount', 'currency', 'dt')))
+    )
+)
+
+SEARCH_COLUMNS = ['owner', 'description', 'shop', 'location', 'purpose']
+
+MASK = (1 << 64) - 1
+
+STOP_RETRIES = 3
+MAXIMUM_BACKOFF = 30
+
+ARCHIVE_INDEXES = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS updateidIndex ON expenses (updateid)',
+    'CREATE INDEX IF NOT EXISTS ownerDateIndex ON expenses (owner, dt, updateid)',
+    'CREATE INDEX IF NOT EXISTS ownerShopIndex ON expenses (owner, shop, dt)',
+    'CREATE INDEX IF NOT EXISTS ownerLocationIndex ON expenses (owner, location, dt)',
+    'CREATE INDEX IF NOT EXISTS ownerPaymentIndex ON expenses (owner, payment, dt)',
+    'CREATE INDEX IF NOT EXISTS ownerVerifiedIndex ON expenses (owner, verified, dt)',
+]
+
+OWNED_TABLES = {
+    'expenses': ', '.join(STORED),
+    'budgets': 'owner, period, field, value, amount',
+    'members': 'owner, member, name',
+}
+
+GRAINS = {
+    'day': 'substr({0}.dt, 1, 10)',
+    'week': 'date({0}.dt, \'weekday 0\', \'-6 days\')',
+    'month': 'substr({0}.dt, 1, 7)',
+    'year': 'substr({0}.dt, 1, 4)',
+}
+
+BUCKET_FORMATS = {
+    'day': '%Y-%m-%d',
+    'week': '%Y-%m-%d',
+    'month': '%Y-%m',
+    'year': '%Y',
+}
+
+PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+]
 
-    return execute(statement, values)
+if __name__ == '__main__':
+    main()
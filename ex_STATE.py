@@ -0,0 +1,184 @@
+import json
+import threading
+
+from collections import (
+    defaultdict,
+)
+from telegram.ext import (
+    BasePersistence,
+    ConversationHandler,
+)
+from ex_BUILTINS import (
+    SCHEMA,
+    EXPECTED_INFORMATION,
+)
+
+class Persistence(BasePersistence):
+    """
+    Stores conversation states and user data in the SQL database.
+    > Updates only mark the changed entries as dirty.
+    > Dirty entries are written in a single transaction whenever flush is called, and stay dirty until it commits.
+    > The Information in progress is stored by name.
+    > The mask of filled fields is recomputed for user data stored before it was tracked.
+    > States still awaiting an asynchronous handler are stored as their previous state, and stay dirty until resolved.
+    Chat data and bot data are not persisted.
+    Stored data never references the bot, so it is neither copied nor searched for the bot on every update.
+    """
+    def __init__(self, database):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.database = database
+        self.lock = threading.Lock()
+        self.user_data = None
+        self.conversations = {}
+        self.states = {}
+        self.stored_user_data = {}
+        self.dirty_user_data = {}
+        self.dirty_conversations = {}
+
+    @classmethod
+    def replace_bot(cls, obj) -> object:
+        return obj
+
+    def insert_bot(self, obj) -> object:
+        return obj
+
+    def get_user_data(self) -> defaultdict:
+        """
+        Loads the user data of every user.
+        """
+        if self.user_data is None:
+            self.user_data = defaultdict(dict)
+            for user_id, data in self.database.fetch('SELECT user_id, data FROM user_data'):
+                self.user_data[user_id] = decode_user_data(data)
+                self.stored_user_data[user_id] = data
+        return self.user_data
+
+    def get_chat_data(self) -> defaultdict:
+        return defaultdict(dict)
+
+    def get_bot_data(self) -> dict:
+        return {}
+
+    def get_conversations(self, name) -> dict:
+        """
+        Loads the conversation states of a conversation handler.
+        """
+        if name not in self.conversations:
+            self.conversations[name] = {
+                tuple(json.loads(key)): state for key, state in self.database.fetch(
+                    'SELECT key, state FROM conversations WHERE name = ?', (name,)
+                )
+            }
+            self.states.update(((name, key), state) for key, state in self.conversations[name].items())
+        return self.conversations[name]
+
+    def update_conversation(self, name, key, new_state) -> None:
+        """
+        Marks the conversation state as dirty if it has changed.
+        > The conversation handler shares and updates the loaded conversations itself, so the last state marked is kept apart.
+        """
+        with self.lock:
+            if self.states.get((name, key)) == new_state:
+                return
+            self.states[(name, key)] = new_state
+            self.dirty_conversations[(name, key)] = new_state
+
+    def update_user_data(self, user_id, data) -> None:
+        """
+        Marks the user data as dirty if it has changed.
+        """
+        encoded = encode_user_data(data)
+        if self.stored_user_data.get(user_id) == encoded:
+            return
+        with self.lock:
+            self.dirty_user_data[user_id] = encoded
+
+    def update_chat_data(self, chat_id, data) -> None:
+        pass
+
+    def update_bot_data(self, data) -> None:
+        pass
+
+    def flush(self) -> None:
+        """
+        Writes every dirty entry in a single transaction.
+        > Empty user data and ended conversations are deleted.
+        Entries are only marked clean once the transaction commits, unless they changed meanwhile.
+        """
+        with self.lock:
+            user_data = dict(self.dirty_user_data)
+            dirty = dict(self.dirty_conversations)
+        if not user_data and not dirty:
+            return
+        resolved = {key: resolve(state) for key, state in dirty.items()}
+        conversations = {key: state for key, (state, _) in resolved.items()}
+
+        conn = self.database.connection()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO user_data VALUES (?,?)',
+                [(user_id, data) for user_id, data in user_data.items() if data != '{}']
+            )
+            conn.executemany(
+                'DELETE FROM user_data WHERE user_id = ?',
+                [(user_id,) for user_id, data in user_data.items() if data == '{}']
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO conversations VALUES (?,?,?)',
+                [(name, json.dumps(key), state) for (name, key), state in conversations.items() if state is not None]
+            )
+            conn.executemany(
+                'DELETE FROM conversations WHERE name = ? AND key = ?',
+                [(name, json.dumps(key)) for (name, key), state in conversations.items() if state is None]
+            )
+        self.stored_user_data.update(user_data)
+
+        with self.lock:
+            for user_id, data in user_data.items():
+                if self.dirty_user_data.get(user_id) is data:
+                    del self.dirty_user_data[user_id]
+            for key, state in dirty.items():
+                if self.dirty_conversations.get(key) is state and resolved[key][1]:
+                    del self.dirty_conversations[key]
+
+def resolve(state) -> tuple:
+    """
+    Returns the conversation state to store, resolving the state left by an asynchronous handler, and whether it is final.
+    > Asynchronous handlers leave an (old state, promise) pair until their promise is resolved.
+    > The previous state is stored while the handler runs, and kept if it returned None or raised.
+    > A conversation ended by the handler has no state.
+    The conversation handler may nest the pair left by an earlier handler in the previous state.
+    """
+    if not isinstance(state, tuple):
+        return state, True
+    old_state, promise = state
+    while isinstance(old_state, tuple):
+        old_state = old_state[0]
+    if not promise.done.is_set():
+        return old_state, False
+    if promise.exception is not None:
+        return old_state, True
+    new_state = promise.result(timeout=0)
+    if new_state is None:
+        return old_state, True
+    return (None if new_state == ConversationHandler.END else new_state), True
+
+def encode_user_data(data) -> str:
+    """
+    Serialises user data compactly.
+    The Information in progress is replaced by its name.
+    """
+    data = dict(data)
+    if 'info' in data:
+        data['info'] = data['info'].name if data['info'] is not None else None
+    return json.dumps(data, separators=(',', ':'))
+
+def decode_user_data(data) -> dict:
+    """
+    Restores user data serialised by encode_user_data.
+    """
+    data = json.loads(data)
+    if 'info' in data:
+        data['info'] = EXPECTED_INFORMATION[data['info']] if data['info'] else None
+        data.setdefault('filled', SCHEMA.mask(data))
+    return data
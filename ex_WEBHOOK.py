@@ -0,0 +1,173 @@
+import collections
+import hmac
+import json
+import logging
+import queue
+import signal
+import threading
+import time
+
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+from telegram import (
+    Update,
+)
+
+logger = logging.getLogger(__name__)
+
+class Server:
+    """
+    Receives updates from Telegram on a local HTTP endpoint.
+    > Updates are handled by a fixed number of workers.
+    > Updates from the same chat are always handled by the same worker, in order.
+    > Each worker has a bounded queue; updates arriving at a full queue are deferred.
+    Deferred updates are answered with 503 so that Telegram delivers them again later.
+    Requests without the secret token given to Telegram are rejected with 403, if a secret is given.
+    """
+    def __init__(self, dispatcher, listen, port, path, workers=4, capacity=256, secret=None):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        self.queues = [queue.Queue(maxsize=max(1, capacity // workers)) for _ in range(workers)]
+        self.metrics = collections.Counter()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=10000)
+        self.threads = []
+        self.stopped = threading.Event()
+        self.httpd = ThreadingHTTPServer((listen, port), request_handler(self))
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self) -> None:
+        """
+        Starts the workers and the HTTP server.
+        """
+        for index, updates in enumerate(self.queues):
+            thread = threading.Thread(target=self.work, args=(updates,), name='webhook-{}'.format(index), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self.httpd.serve_forever, name='webhook', daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def stop(self) -> None:
+        """
+        Stops accepting updates and waits for the queued updates to be handled.
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for updates in self.queues:
+            updates.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def idle(self) -> None:
+        """
+        Blocks until the process receives SIGINT or SIGTERM.
+        """
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: self.stopped.set())
+        while not self.stopped.wait(1):
+            pass
+
+    def count(self, name) -> None:
+        """
+        Increments a metric.
+        """
+        with self.lock:
+            self.metrics[name] += 1
+
+    def collect(self) -> list:
+        """
+        Returns the metrics of the server as (name, labels, value) samples of a metrics registry.
+        """
+        with self.lock:
+            return [('webhook_updates_total', (name,), value) for name, value in self.metrics.items()]
+
+    def authorised(self, token) -> bool:
+        """
+        Returns whether a request carries the secret token, in constant time.
+        """
+        if not self.secret:
+            return True
+        return token is not None and hmac.compare_digest(token.encode(), self.secret.encode())
+
+    def receive(self, data) -> bool:
+        """
+        Queues an update for its worker.
+        Raises a ValueError if the payload is not an update object.
+        Returns False if the update was deferred because the queue is full.
+        """
+        if not isinstance(data, dict) or not isinstance(data.get('update_id'), int):
+            raise ValueError('Not an update: {!r}'.format(data)[:100])
+        update = Update.de_json(data, self.dispatcher.bot)
+        chat = update.effective_chat
+        updates = self.queues[(chat.id if chat else 0) % len(self.queues)]
+        try:
+            updates.put_nowait((time.perf_counter(), update))
+        except queue.Full:
+            self.count('deferred')
+            return False
+        self.count('received')
+        return True
+
+    def work(self, updates) -> None:
+        """
+        Handles the updates of a queue until a stop request is received.
+        """
+        while True:
+            item = updates.get()
+            if item is None:
+                return
+            received, update = item
+            try:
+                self.dispatcher.process_update(update)
+            except Exception:
+                self.count('failed')
+                logger.exception('Failed to handle update %s', update.update_id)
+            self.count('handled')
+            self.latencies.append(time.perf_counter() - received)
+
+def request_handler(server) -> type:
+    """
+    Builds the HTTP request handler class of a server.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            if self.path != server.path:
+                self.send_response(404)
+                self.end_headers()
+                return
+            if not server.authorised(self.headers.get(SECRET_HEADER)):
+                server.count('forbidden')
+                self.send_response(403)
+                self.end_headers()
+                return
+            try:
+                data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                accepted = server.receive(data)
+            except (ValueError, TypeError, KeyError, AttributeError):
+                server.count('invalid')
+                self.send_response(400)
+                self.end_headers()
+                return
+            self.send_response(200 if accepted else 503)
+            if not accepted:
+                self.send_header('Retry-After', '1')
+            self.end_headers()
+
+        def log_message(self, format, *args) -> None:
+            logger.debug(format, *args)
+
+    return Handler
+
+#############
+# VARIABLES #
+#############
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
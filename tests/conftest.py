@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+# The bot modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ex_BENCH as bench
+import ex_SQL as db
+
+@pytest.fixture
+def database(tmp_path):
+    """
+    Returns a fresh database set up in a temporary directory.
+    """
+    database = bench.temporary_database(str(tmp_path))
+    yield database
+    database.close()
+
+@pytest.fixture
+def rows():
+    """
+    Returns a function inserting synthetic rows in a database.
+    """
+    def insert(database, count, start=1, owners=100):
+        rows = bench.synthetic_rows(count, start, owners=owners)
+        database.executemany(db.INSERT, rows)
+        return rows
+    return insert
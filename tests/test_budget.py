@@ -0,0 +1,76 @@
+from datetime import (
+    datetime,
+)
+
+import ex_BENCH as bench
+import ex_BUDGET as budget
+
+def expense(amount, purpose='Food', payment='Debit', dt=None) -> tuple:
+    """
+    Returns a database row of owner 1 in the home currency, dated now unless given.
+    """
+    dt = dt or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return (1, 0, dt, 'Item', amount, '', '', purpose, payment, False, '', '', '')
+
+def thresholds(alerts) -> list:
+    return [(limit.period, limit.field, threshold) for limit, threshold in alerts]
+
+def test_record_alerts_highest_threshold_crossed(database):
+    budgets = budget.Budgets(database)
+    budgets.set(1, 'month', '', '', 10000)
+    budgets.set(1, 'day', 'purpose', 'Food', 1000)
+
+    assert thresholds(budgets.record(expense(500))) == []
+    assert thresholds(budgets.record(expense(300))) == [('day', 'purpose', 80)]
+    assert thresholds(budgets.record(expense(100, purpose='Rent'))) == []
+    assert thresholds(budgets.record(expense(7100))) == [('month', '', 80), ('day', 'purpose', 100)]
+    assert thresholds(budgets.record(expense(5000, purpose='Rent'))) == [('month', '', 100)]
+    assert thresholds(budgets.record(expense(5000))) == []
+
+def test_record_ignores_earlier_windows_and_restarts_later_ones(database):
+    budgets = budget.Budgets(database)
+    budgets.set(1, 'day', '', '', 1000)
+
+    assert thresholds(budgets.record(expense(900, dt='2000-01-01 12:00:00'))) == []
+    assert thresholds(budgets.record(expense(900, dt='2100-01-01 12:00:00'))) == [('day', '', 80)]
+    assert thresholds(budgets.record(expense(900, dt='2100-01-02 12:00:00'))) == [('day', '', 80)]
+    assert budgets.status(1, '2100-01-02')[0][1] == 900
+
+def test_record_sees_budgets_changed_after_matching(database):
+    budgets = budget.Budgets(database)
+    budgets.set(1, 'month', 'purpose', 'Food', 1000)
+    budgets.record(expense(100))
+    budgets.set(1, 'month', 'purpose', 'Food', 100)
+
+    assert thresholds(budgets.record(expense(100))) == [('month', 'purpose', 100)]
+
+def test_crossed_matches_percentages():
+    limit = budget.Budget('month', '', '', 333)
+    for before in range(0, 400):
+        for after in range(before, 400, 7):
+            expected = [t for t in budget.THRESHOLDS if before * 100 < t * 333 <= after * 100]
+            assert limit.crossed(before, after) == expected
+
+def test_record_finds_windows_once_per_period_with_100_budgets(database, monkeypatch):
+    """
+    Recording an expense matching 12 of 100 budgets finds the window of every period once, whatever the number of budgets.
+    > Its latency against recording without budgets is measured by 'python ex_BENCH.py budgets'.
+    """
+    keys = [('', ''), ('purpose', 'Purpose 1'), ('payment', 'Debit')]
+    keys += [('purpose', 'Purpose {}'.format(i)) for i in range(2, 100)]
+    limits = [(period, field, value) for field, value in keys for period in budget.PERIODS][:100]
+    rows = [expense(row[4] % 100, purpose='Purpose 1') for row in bench.synthetic_rows(2000, owners=1)]
+
+    budgets = budget.Budgets(database)
+    for period, field, value in limits:
+        budgets.set(1, period, field, value, 10 ** 9)
+
+    calls = []
+    window = budget.window
+    monkeypatch.setattr(budget, 'window', lambda period, dt: calls.append(period) or window(period, dt))
+    budgets = budget.Budgets(database)
+    budgets.load(1)
+    del calls[:]
+    for row in rows:
+        budgets.record(row)
+    assert len(calls) == len(rows) * len(budget.PERIODS)
@@ -0,0 +1,39 @@
+import pytest
+
+from ex_BUILTINS import (
+    Information,
+    Schema,
+    SCHEMA,
+)
+
+def test_missing_follows_the_order_of_requested_fields():
+    data = {}
+    requested = []
+    while SCHEMA.missing[SCHEMA.mask(data) & SCHEMA.requested] is not None:
+        field = SCHEMA.missing[SCHEMA.mask(data) & SCHEMA.requested]
+        requested.append(field.name)
+        data[field.name] = ''
+    assert requested == [field.name for field in SCHEMA.fields.values() if not field.auto]
+
+    # Automatic fields and fields filled out of order do not change the next field
+    data = {'owner': 1, 'updateid': 2, 'amount': 100}
+    assert SCHEMA.missing[SCHEMA.mask(data) & SCHEMA.requested].name == 'datetime'
+    data['datetime'] = ''
+    assert SCHEMA.missing[SCHEMA.mask(data) & SCHEMA.requested].name == 'description'
+
+def test_required_mask_holds_the_required_fields():
+    required = {'datetime', 'description', 'amount'}
+    assert SCHEMA.mask(dict.fromkeys(required)) & SCHEMA.required == SCHEMA.required
+    for name in required:
+        assert SCHEMA.mask(dict.fromkeys(required - {name})) & SCHEMA.required != SCHEMA.required
+
+def test_values_follow_the_columns():
+    row = SCHEMA.values({'amount': 100, 'owner': 1, 'unknown': 'x'})
+    assert len(row) == len(SCHEMA.columns)
+    assert row[SCHEMA.fields['owner'].index] == 1 and row[SCHEMA.fields['amount'].index] == 100
+    assert row[SCHEMA.fields['shop'].index] == ''
+
+def test_fields_of_a_state_must_accept_the_same_replies():
+    Schema('same', [Information('a', state=1, pattern='x'), Information('b', state=1, pattern='x')])
+    with pytest.raises(ValueError):
+        Schema('different', [Information('a', state=1, pattern='x'), Information('b', state=1, pattern='y')])
@@ -0,0 +1,57 @@
+import bisect
+import re
+
+from datetime import (
+    datetime,
+)
+
+import ex_BOT as bot
+import ex_DIGEST as digest
+import ex_REPLAY as replay
+import ex_SQL as db
+
+OWNERS = 200
+
+def expenses(owner) -> list:
+    """
+    Returns between 1 and 4 rows of an owner spent today, cycling through unverified, unanswered and verified.
+    """
+    return [
+        (owner, owner * 10 + i, '2026-01-04 19:{:02d}:00'.format(i), 'Item', 100 * (i + 1), '', '', '', 'Cash',
+         [False, '', True][(owner + i) % 3], '', '', '')
+        for i in range(owner % 4 + 1)
+    ]
+
+def test_digests_are_paced_sent_once_and_counted(database):
+    clock = replay.FakeClock(datetime(2026, 1, 4, 20))
+    sends = []
+    fake = replay.FakeBot()
+    fake.send_message = lambda chat_id, text, **kwargs: sends.append((chat_id, text, clock.monotonic()))
+    rows = {owner: expenses(owner) for owner in range(1, OWNERS + 1)}
+    database.executemany(db.INSERT, [row for owner in rows for row in rows[owner]])
+
+    def run(hours) -> list:
+        scheduler = digest.Scheduler(
+            database, digest.TokenBucket(bot.DIGEST_RATE, bot.DIGEST_BURST, clock.monotonic, clock.sleep), bot.compose_digest, clock.now
+        )
+        if not database.main.fetch('SELECT 1 FROM schedules'):
+            for owner in rows:
+                scheduler.set(owner, 'daily' if owner % 2 else 'weekly', 21)
+        clock.advance(hours=hours)
+        sends.clear()
+        assert scheduler.run(fake) == len(sends)
+        return list(sends)
+
+    sent = run(1)
+    assert sorted(chat for chat, _, _ in sent) == list(rows)
+    times = [sent_at for _, _, sent_at in sent]
+    assert max(bisect.bisect_left(times, sent_at + 1) - index for index, sent_at in enumerate(times)) <= 30
+    for owner, text, _ in sent:
+        spent = re.search(r'Spent [a-z ]+: (.+) over (\d+) transactions', text)
+        pending = re.search(r'(\d+) transactions are not verified yet', text)
+        assert spent.group(1) == bot.format_amount(sum(row[4] for row in rows[owner]))
+        assert int(spent.group(2)) == len(rows[owner])
+        assert int(pending.group(1) if pending else 0) == sum(row[9] is not True for row in rows[owner])
+
+    assert run(0) == []
+    assert sorted(chat for chat, _, _ in run(24)) == [owner for owner in rows if owner % 2]
@@ -0,0 +1,70 @@
+import csv
+import json
+
+import pytest
+
+from datetime import (
+    datetime,
+)
+
+import ex_ARCHIVE as archiver
+import ex_EXPORT as export
+import ex_QUERY as query
+import ex_SQL as db
+
+@pytest.fixture
+def router(tmp_path):
+    """
+    Returns a database of three shards with the expenses of two owners on different shards, one of them archived.
+    """
+    router = db.Router(str(tmp_path / 'sharded.db'), 3)
+    db.setup(router)
+    other = next(owner for owner in range(2, 100) if router.index(owner) != router.index(1))
+    rows = [
+        (1, 1, '2023-05-01 12:00:00', 'Lunch', 1050, 'Hawker', '', 'Food', 'Debit', True, 'SGD', '', ''),
+        (other, 2, '2024-02-01 09:30:00', 'Taxi', 2300, '', 'Airport', 'Transport', 'Credit', '', '', '', ''),
+        (1, 3, '2024-03-01 19:00:00', 'Dinner, late', 905, 'Bistro', '', 'Food', 'PayPal', False, 'JPY', '', ''),
+    ]
+    for row in rows:
+        router.shard(row[0]).execute(db.INSERT, row)
+    archiver.archive(router, datetime(2024, 1, 1), 0)
+    yield router, other
+    router.close()
+
+def test_export_streams_every_shard_and_archive_in_chunks(router):
+    database, other = router
+    chunks = list(export.iterate(database, query.Filter([1, other]), size=2))
+    assert [[row[1] for row in chunk] for chunk in chunks] == [[3, 2], [1]]
+
+def test_csv_and_jsonl_exports_hold_the_same_records(router, tmp_path):
+    database, other = router
+    filter = query.Filter([1, other])
+    assert export.export(database, filter, str(tmp_path / 'expenses.csv'), 'csv') == 3
+    assert export.export(database, filter, str(tmp_path / 'expenses.jsonl'), 'jsonl') == 3
+
+    with open(tmp_path / 'expenses.csv', newline='', encoding='utf-8') as file:
+        records = list(csv.DictReader(file))
+    with open(tmp_path / 'expenses.jsonl', encoding='utf-8') as file:
+        lines = [json.loads(line) for line in file]
+    assert [line['updateid'] for line in lines] == [3, 2, 1]
+    assert [dict(line, updateid=str(line['updateid'])) for line in lines] == records
+
+    assert list(records[0]) == export.COLUMNS
+    assert [record['description'] for record in records] == ['Dinner, late', 'Taxi', 'Lunch']
+    assert [record['amount'] for record in records] == ['905', '23.00', '10.50']
+    assert [record['currency'] for record in records] == ['JPY', 'SGD', 'SGD']
+    assert [record['verified'] for record in records] == ['No', '', 'Yes']
+
+def test_parquet_export_stores_decimal_amounts(router, tmp_path):
+    pyarrow = pytest.importorskip('pyarrow.parquet')
+    database, other = router
+    path = str(tmp_path / 'expenses.parquet')
+    assert export.export(database, query.Filter([1, other]), path, 'parquet') == 3
+    table = pyarrow.read_table(path)
+    assert table.column_names == export.COLUMNS
+    assert [str(amount) for amount in table.column('amount').to_pylist()] == ['905.00', '23.00', '10.50']
+
+def test_unsupported_formats_are_rejected(router, tmp_path):
+    database, other = router
+    with pytest.raises(export.InputError):
+        export.export(database, query.Filter([1]), str(tmp_path / 'expenses.xml'), 'xml')
@@ -0,0 +1,155 @@
+import concurrent.futures
+import io
+import os
+
+import pytest
+
+from telegram.error import (
+    NetworkError,
+)
+
+import ex_IMAGE as image
+import ex_METRICS as metrics
+
+from ex_REPLAY import (
+    FakeBot,
+)
+
+def png(colour=(200, 10, 10)) -> bytes:
+    """
+    Returns the content of a small PNG image.
+    """
+    Image = pytest.importorskip('PIL.Image')
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), colour).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+@pytest.fixture
+def registry():
+    return metrics.Registry()
+
+@pytest.fixture
+def pipeline(database, tmp_path, registry):
+    pipeline = image.Pipeline(database, str(tmp_path / 'receipts'), workers=4, backoff=0, metrics=registry)
+    yield pipeline
+    pipeline.stop()
+
+def stored(directory) -> list:
+    """
+    Returns the names of every file stored below a directory.
+    """
+    return sorted(name for _, _, names in os.walk(directory) for name in names)
+
+def test_download_retries_network_errors(database, pipeline, registry):
+    bot = FakeBot(files={'receipt': png()}, failures={'receipt': 2})
+    digest, path = pipeline.submit(bot, 'receipt', 1).result()
+
+    assert bot.downloads['receipt'] == 3
+    assert registry.counters['image_download_retries_total'] == {(): 2}
+    assert os.path.exists(path)
+    assert database.fetch('SELECT updateid, hash, format FROM images') == [(1, digest, 'jpg' if pipeline.processes else 'png')]
+
+def test_download_gives_up_after_retries(database, pipeline, registry):
+    bot = FakeBot(files={'receipt': png()}, failures={'receipt': pipeline.retries})
+    with pytest.raises(NetworkError):
+        pipeline.submit(bot, 'receipt', 1).result()
+
+    assert bot.downloads['receipt'] == pipeline.retries
+    assert registry.counters['image_failures_total'] == {(): 1}
+    assert database.fetch('SELECT * FROM images') == []
+
+def test_download_backs_off_exponentially(database, tmp_path, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(image.time, 'sleep', sleeps.append)
+    pipeline = image.Pipeline(database, str(tmp_path / 'receipts'), backoff=0.5)
+    bot = FakeBot(files={'receipt': b'data'}, failures={'receipt': 2})
+    try:
+        assert pipeline.download(bot, 'receipt') == b'data'
+    finally:
+        pipeline.stop()
+    assert sleeps == [0.5, 1.0]
+
+def test_identical_images_are_stored_once(database, pipeline, tmp_path):
+    data = png()
+    bot = FakeBot(files={'first': data, 'second': data})
+    first = pipeline.submit(bot, 'first', 1).result()
+    second = pipeline.submit(bot, 'second', 2).result()
+
+    assert first == second
+    assert len(database.fetch('SELECT DISTINCT hash, path FROM images')) == 1
+    assert database.fetch('SELECT updateid FROM images ORDER BY updateid') == [(1,), (2,)]
+    assert len(stored(tmp_path / 'receipts')) == (2 if pipeline.processes else 1)
+
+def test_identical_concurrent_images_are_stored_once(database, pipeline, tmp_path):
+    data = png((10, 200, 10))
+    files = {'receipt{}'.format(i): data for i in range(16)}
+    bot = FakeBot(files=files)
+    futures = [pipeline.submit(bot, file_id, i) for i, file_id in enumerate(files, 1)]
+    results = {future.result() for future in concurrent.futures.as_completed(futures)}
+
+    assert len(results) == 1
+    assert database.fetch('SELECT COUNT(*), COUNT(DISTINCT hash) FROM images') == [(16, 1)]
+    names = stored(tmp_path / 'receipts')
+    assert not [name for name in names if name.endswith('.tmp')]
+    assert len(names) == (2 if pipeline.processes else 1)
+
+def test_failed_images_are_not_recorded(database, pipeline, registry, tmp_path):
+    if not pipeline.processes:
+        pytest.skip('images are only decoded when Pillow is installed')
+    bot = FakeBot(files={'receipt': b'\x89PNG\r\n\x1a\nbroken'})
+    with pytest.raises(Exception):
+        pipeline.submit(bot, 'receipt', 1).result()
+
+    assert registry.counters['image_failures_total'] == {(): 1}
+    assert database.fetch('SELECT * FROM images') == []
+    assert stored(tmp_path / 'receipts') == []
+
+def test_normalise_tolerates_concurrent_normalise(tmp_path, monkeypatch):
+    Image = pytest.importorskip('PIL.Image')
+    digest = 'ab' * 32
+    source = tmp_path / (digest + '.png')
+    source.write_bytes(png())
+    full, thumbnail = image.normalise(str(source), digest)
+
+    # Another process stores the same image, and normalises it once this one has checked for it
+    source.write_bytes(png())
+    opened = []
+    def open(path):
+        opened.append(path)
+        os.remove(path)
+        raise FileNotFoundError(path)
+    exists = iter([False])
+    monkeypatch.setattr(image.os.path, 'exists', lambda path: next(exists, os.access(path, os.F_OK)))
+    monkeypatch.setattr(Image, 'open', open)
+
+    assert image.normalise(str(source), digest) == (full, thumbnail)
+    assert opened == [str(source)]
+    assert not source.exists()
+
+def test_normalise_bounds_the_copy_and_thumbnail(tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    digest = 'cd' * 32
+    source = tmp_path / (digest + '.png')
+    Image.new('RGBA', (4096, 1024), (10, 20, 200, 128)).save(str(source), 'PNG')
+
+    full, thumbnail = image.normalise(str(source), digest)
+    assert not source.exists()
+    assert full == str(tmp_path / (digest + image.FULL_SUFFIX))
+    with Image.open(full) as copy:
+        assert (copy.format, copy.mode, copy.size) == ('JPEG', 'RGB', (image.FULL_SIZE, image.FULL_SIZE // 4))
+    with Image.open(thumbnail) as small:
+        assert (small.format, small.size) == ('JPEG', (image.THUMBNAIL_SIZE, image.THUMBNAIL_SIZE // 4))
+
+def test_normalise_decodes_large_jpeg_at_reduced_scale(tmp_path, monkeypatch):
+    Image = pytest.importorskip('PIL.Image')
+    digest = 'ef' * 32
+    source = tmp_path / (digest + '.jpg')
+    Image.new('RGB', (8192, 4096), 'white').save(str(source), 'JPEG')
+    decoded = []
+    convert = Image.Image.convert
+    monkeypatch.setattr(Image.Image, 'convert', lambda self, *args: decoded.append(self.size) or convert(self, *args))
+
+    full, _ = image.normalise(str(source), digest)
+    assert decoded == [(4096, 2048)]
+    with Image.open(full) as copy:
+        assert copy.size == (image.FULL_SIZE, image.FULL_SIZE // 2)
@@ -0,0 +1,73 @@
+import threading
+
+from datetime import (
+    datetime,
+)
+
+import ex_ARCHIVE as archiver
+import ex_IMPORT as importer
+import ex_SQL as db
+
+HEADER = 'description,datetime,amount\n'
+
+def write(path, lines) -> str:
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(HEADER + ''.join(line + '\n' for line in lines))
+    return path
+
+def run(database, path, owner, batch_size=10000) -> dict:
+    report = importer.Report(path + '.errors')
+    try:
+        return importer.import_file(database, path, owner, report, batch_size)
+    finally:
+        report.close()
+
+def test_duplicates_are_skipped(database, tmp_path):
+    lines = ['Lunch,2020-01-02 10:00,12.50', 'Coffee,2024-01-03 11:00,4.20', 'Lunch,2020-01-02 10:00,12.50', 'Bad,,1.00']
+    path = write(str(tmp_path / 'first.csv'), lines)
+    assert run(database, path, 1, batch_size=2) == {'imported': 2, 'duplicate': 1, 'invalid': 1}
+
+    archiver.archive(database, datetime(2023, 1, 1), 0)
+    assert run(database, path, 1) == {'imported': 0, 'duplicate': 3, 'invalid': 1}
+    assert run(database, path, 2) == {'imported': 2, 'duplicate': 1, 'invalid': 1}
+    with open(path + '.errors', encoding='utf-8') as file:
+        assert file.read().splitlines()[1:] == ['3,duplicate', '4,date is required']
+
+def test_currencies_without_rates_are_rejected(database, tmp_path):
+    path = write(str(tmp_path / 'foreign.csv'), ['Lunch,2024-01-02 10:00,"12.50 USD"', 'Coffee,2024-01-03 11:00,4.20'])
+    assert run(database, path, 1) == {'imported': 1, 'duplicate': 0, 'invalid': 1}
+    with open(path + '.errors', encoding='utf-8') as file:
+        assert file.read().splitlines()[1:] == ['1,no exchange rate for USD']
+
+    rates = tmp_path / 'rates.csv'
+    rates.write_text('date,currency,rate\n2020-01-01,USD,1.35\n')
+    database.rates.load(str(rates))
+    assert run(database, path, 1) == {'imported': 1, 'duplicate': 1, 'invalid': 0}
+    assert database.fetch('SELECT amount, currency, home FROM expenses WHERE description = ?', ('Lunch',)) == [(1250, 'USD', 1688)]
+
+def test_update_ids_are_unique_across_concurrent_imports(tmp_path):
+    database = db.Router(str(tmp_path / 'sharded.db'), 2)
+    db.setup(database)
+    owners = [1, next(owner for owner in range(2, 100) if database.index(owner) != database.index(1))]
+    paths = [
+        write(str(tmp_path / '{}.csv'.format(owner)), ['Item {},2024-01-01 {:02d}:{:02d},1.00'.format(i, i // 60 % 24, i % 60) for i in range(3000)])
+        for owner in owners
+    ]
+    threads = [threading.Thread(target=run, args=(database, path, owner, 100)) for owner, path in zip(owners, paths)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    updateids = [updateid for shard in database.shards for updateid, in shard.fetch('SELECT updateid FROM expenses')]
+    assert len(updateids) == 6000
+    assert len(set(updateids)) == 6000
+    assert max(updateids) < 0
+    database.close()
+
+def test_sequence_starts_below_existing_update_ids(database, tmp_path):
+    database.execute(db.INSERT, (1, -50, '2024-01-01 00:00:00', 'Old', 100, '', '', '', '', '', 'SGD', '', ''))
+    database.execute('DELETE FROM sequences')
+    db.setup(database)
+    assert db.allocate(database, 'import', 3) == -51
+    assert db.allocate(database, 'import', 1) == -54
@@ -0,0 +1,62 @@
+import pytest
+
+import ex_LEDGER as ledger
+import ex_SQL as db
+
+from ex_REPLAY import (
+    Harness,
+)
+
+@pytest.fixture
+def harness(tmp_path):
+    harness = Harness(str(tmp_path))
+    yield harness
+    harness.close()
+
+def test_split_gives_the_units_left_over_to_the_first_members():
+    assert ledger.split(1000, [3, 1, 2, 1]) == {1: 334, 2: 333, 3: 333}
+    assert ledger.rescale({1: 334, 2: 333, 3: 333}, 1001) == {1: 335, 2: 333, 3: 333}
+    assert ledger.rescale({1: 0, 2: 0}, 5) == {1: 3, 2: 2}
+    assert ledger.decode(ledger.encode({2: 1, 10: 2})) == {2: 1, 10: 2}
+
+@pytest.mark.parametrize('balances, transfers', [
+    ({}, []),
+    ({1: 500, 2: -500}, [(2, 1, 500)]),
+    ({1: 700, 2: 300, 3: -300, 4: -700}, [(4, 1, 700), (3, 2, 300)]),
+    ({1: 2000, 2: -550, 3: -1450}, [(3, 1, 1450), (2, 1, 550)]),
+    ({1: 600, 2: 400, 3: -500, 4: -500}, [(3, 1, 500), (4, 2, 400), (4, 1, 100)]),
+])
+def test_settle_pairs_exact_debts_then_the_largest_balances(balances, transfers):
+    assert ledger.settle(balances) == transfers
+
+def test_settle_needs_fewer_transfers_than_members():
+    balances = {member: (member * 7919) % 1000 - 500 for member in range(1, 40)}
+    balances[40] = -sum(balances.values())
+    transfers = ledger.settle(balances)
+    assert len(transfers) < len(balances)
+
+    settled = dict(balances)
+    for debtor, creditor, amount in transfers:
+        assert amount > 0
+        settled[debtor] += amount
+        settled[creditor] -= amount
+    assert not any(settled.values())
+
+def test_settle_command_lists_the_greedy_transfers(harness, monkeypatch):
+    replies = []
+    monkeypatch.setattr(harness.bot, 'send_message', lambda chat_id, text, **kwargs: replies.append(text))
+    for sender in (21, 22, 23):
+        harness.send(harness.message(-5, '/join', sender=sender))
+    shard = harness.database.shard(-5)
+    shard.executemany(db.INSERT, [
+        (-5, 1, '2024-01-02 12:00:00', 'Dinner', 3000, '', '', '', '', '', 'SGD', '', ''),
+        (-5, 2, '2024-01-03 12:00:00', 'Taxi', 900, '', '', '', '', '', 'SGD', '', ''),
+    ])
+    shard.changed([-5])
+    harness.send(harness.message(-5, '/split 1', sender=21))
+    harness.send(harness.message(-5, '/split 2 Member22 Member23', sender=22))
+    assert dict(harness.dispatcher.bot_data['ledger'].balances(-5)) == {21: 2000, 22: -550, 23: -1450}
+
+    del replies[:]
+    harness.send(harness.message(-5, '/settle', sender=21))
+    assert replies == ['Member23 pays Member21 14.50\nMember22 pays Member21 5.50']
@@ -0,0 +1,98 @@
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from telegram.ext import (
+    ConversationHandler,
+)
+
+import ex_METRICS as metrics
+
+def test_histograms_merge_the_observations_of_every_thread():
+    registry = metrics.Registry(buckets=(0.1, 1.0))
+    histogram = registry.histogram('handler_seconds', ('add',))
+    threads = [threading.Thread(target=lambda: [histogram.observe(value) for value in (0.05, 0.5, 5)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert registry.histogram('handler_seconds', ('add',)) is histogram
+    counts, total = histogram.snapshot()
+    assert counts == [4, 4, 4] and total == pytest.approx(22.2)
+
+def test_export_follows_the_exposition_format():
+    registry = metrics.Registry(prefix='', buckets=(0.1, 1.0))
+    registry.observe('handler_seconds', ('add',), 0.05)
+    registry.observe('handler_seconds', ('add',), 2)
+    registry.count('webhook_updates_total', ('accepted',))
+    registry.count('webhook_updates_total', ('accepted',), 2)
+    registry.count('handler_errors_total', ('say "hi"\n',))
+    registry.collect(lambda: [('writer_up', ('main',), 1)])
+    registry.collect(lambda: 1 / 0)
+    lines = registry.export().splitlines()
+
+    assert '# TYPE handler_seconds histogram' in lines
+    assert [line for line in lines if line.startswith('handler_seconds_')] == [
+        'handler_seconds_bucket{handler="add",le="0.1"} 1',
+        'handler_seconds_bucket{handler="add",le="1.0"} 1',
+        'handler_seconds_bucket{handler="add",le="+Inf"} 2',
+        'handler_seconds_sum{handler="add"} 2.05',
+        'handler_seconds_count{handler="add"} 2',
+    ]
+    assert 'webhook_updates_total{result="accepted"} 3' in lines
+    assert 'handler_errors_total{handler="say \\"hi\\"\\n"} 1' in lines
+    assert 'writer_up{journal="main"} 1' in lines
+
+def test_statements_are_labelled_by_their_shape():
+    assert metrics.shape("SELECT *  FROM expenses\nWHERE owner IN (1, 2, ?) AND shop = 'it''s' LIMIT 10") == (
+        'SELECT * FROM expenses WHERE owner IN (?) AND shop = ? LIMIT ?'
+    )
+    registry = metrics.Registry()
+    registry.statement('SELECT 1 FROM expenses WHERE owner = 5', 0.01)
+    registry.statement('SELECT 1 FROM expenses WHERE owner = 6', 0.01)
+    assert list(registry.histograms['sql_seconds']) == [('SELECT ? FROM expenses WHERE owner = ?',)]
+
+def test_timed_callbacks_count_errors_and_conversations():
+    registry = metrics.Registry()
+
+    def add_start(update, context):
+        return 1
+
+    def add_cancel(update, context):
+        return ConversationHandler.END
+
+    def broken(update, context):
+        raise KeyError
+
+    assert metrics.timed(registry, add_start, 'add', True)(None, None) == 1
+    assert metrics.timed(registry, add_cancel, 'add')(None, None) == ConversationHandler.END
+    with pytest.raises(KeyError):
+        metrics.timed(registry, broken)(None, None)
+
+    assert registry.counters['conversations_total'] == {('add', 'started'): 1, ('add', 'cancelled'): 1}
+    assert registry.counters['handler_errors_total'] == {('broken',): 1}
+    assert sum(registry.histogram('handler_seconds', ('broken',)).snapshot()[0]) == 1
+
+def test_exporter_serves_metrics_and_health(tmp_path):
+    registry = metrics.Registry()
+    problems = []
+    registry.check(lambda: problems)
+    exporter = metrics.Exporter(registry, port=0, path=str(tmp_path / 'metrics.prom'), interval=60)
+    exporter.start()
+    try:
+        url = 'http://127.0.0.1:{}'.format(exporter.port)
+        with urllib.request.urlopen(url + metrics.HEALTH_PATH) as response:
+            assert response.read() == b'ok\n'
+        with urllib.request.urlopen(url + metrics.METRICS_PATH) as response:
+            assert response.read().decode('utf-8') == registry.export()
+
+        problems.append('writer stopped')
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + metrics.HEALTH_PATH)
+        assert error.value.code == 503 and error.value.read() == b'writer stopped\n'
+    finally:
+        exporter.stop()
+    assert (tmp_path / 'metrics.prom').read_text(encoding='utf-8') == registry.export()
@@ -0,0 +1,188 @@
+import os
+
+import pytest
+
+from datetime import (
+    datetime,
+)
+
+import ex_ANALYTICS as analytics
+import ex_ARCHIVE as archiver
+import ex_QUERY as query
+import ex_SQL as db
+
+def full_scans(database) -> list:
+    """
+    Returns the statement and plan of every filter shape which scans the expenses without an index.
+    """
+    scans = []
+    for filter in query.shapes():
+        plan = query.explain(database, filter)
+        if any(detail.startswith('SCAN expenses') and 'INDEX' not in detail for detail in plan):
+            scans.append((query.compile(filter.shape()), plan))
+    return scans
+
+@pytest.mark.parametrize('count', [0, 5000])
+def test_no_shape_scans_expenses(database, rows, count):
+    rows(database, count)
+    database.execute('ANALYZE')
+    assert full_scans(database) == []
+
+def test_no_shape_scans_archived_expenses(database, rows):
+    rows(database, 5000)
+    archiver.archive(database, datetime(2100, 1, 1), 0)
+    database.execute('ANALYZE')
+    assert full_scans(database) == []
+
+def expense(updateid, dt, description, amount=1000) -> tuple:
+    return (1, updateid, dt, description, amount, 'Hawker', '', 'Food', 'Debit', '', 'SGD', '', '')
+
+def test_find_includes_archived_expenses(database):
+    database.executemany(db.INSERT, [
+        expense(1, '2001-03-01 12:00:00', 'Chicken_rice'),
+        expense(2, '2002-03-01 12:00:00', 'Chicken soup'),
+        expense(3, '2002-04-01 12:00:00', 'Noodles'),
+        expense(4, '2100-03-01 12:00:00', 'Chicken wings'),
+    ])
+    archiver.archive(database, datetime(2100, 1, 1), 0)
+
+    assert [row[1] for row in query.find(database, 1, 'chicken')] == [4, 2, 1]
+    assert [row[1] for row in query.find(database, 1, 'chicken', 2)] == [4, 2]
+    assert [row[1] for row in query.find(database, 1, 'chicken_rice')] == [1]
+    assert [row[1] for row in query.find(database, 1, 'chickenXrice')] == []
+
+def test_report_includes_archived_years(database):
+    pytest.importorskip('numpy')
+    database.executemany(db.INSERT, [expense(1, '2023-05-01 12:00:00', 'Lunch', 1000), expense(2, '2024-02-01 12:00:00', 'Lunch', 500)])
+    cache = analytics.Cache(database)
+    assert cache.columns(1).size == 2
+
+    archiver.archive(database, datetime(2024, 1, 1), 0)
+    now = datetime(2024, 3, 15)
+    assert cache.columns(1, analytics.since(now, 2)).size == 1
+    columns = cache.columns(1, analytics.since(now, 12))
+    assert columns.size == 2
+    assert cache.columns(1, analytics.since(now, 2)) is columns
+
+def test_unanswered_expenses_are_unverified_everywhere(database):
+    database.executemany(db.INSERT, [
+        (1, updateid, '2024-01-0{} 12:00:00'.format(updateid), 'Item', 100, '', '', '', 'Debit', verified, 'SGD', '', '')
+        for updateid, verified in ((1, False), (2, ''), (3, True))
+    ])
+    pending = query.Filter([1], verified=False)
+    assert [row[1] for row in query.search(database, pending)] == [2, 1]
+    assert [row[1] for row in query.page(database, pending)[0]] == [2, 1]
+    assert [row[1] for row in query.search(database, query.Filter([1], verified=True))] == [3]
+
+    assert db.verify(database, 1, [1, 2, 3]) == 2
+    assert query.search(database, pending) == []
+
+def test_report_reads_home_amounts_stored_when_written(database, tmp_path):
+    pytest.importorskip('numpy')
+    rates = tmp_path / 'rates.csv'
+    rates.write_text('date,currency,rate\n2020-01-01,USD,1.35\n')
+    database.rates.load(str(rates))
+    row = (1, 1, '2024-01-02 12:00:00', 'Lunch', 1000, '', '', 'Food', 'Debit', '', 'USD', '', '')
+    database.execute(db.INSERT, row)
+    database.execute(db.INSERT, expense(2, '2024-01-03 12:00:00', 'Coffee', 500))
+
+    rates.write_text('date,currency,rate\n2020-01-01,USD,2\n')
+    database.rates.load(str(rates))
+    columns = analytics.Cache(database).columns(1)
+    assert sorted(columns.amount.tolist()) == [500, 1350]
+    assert not columns.amend(row)
+    assert columns.amend(expense(2, '2024-01-03 12:00:00', 'Coffee', 700))
+    assert sorted(columns.amount.tolist()) == [700, 1350]
+
+def test_pages_continue_from_the_keyset_cursor(database):
+    dates = ['2024-01-01', '2024-01-02', '2024-01-02', '2024-01-02', '2024-01-03', '2024-01-04', '2024-01-05']
+    database.executemany(db.INSERT, [expense(updateid, date + ' 12:00:00', 'Item') for updateid, date in enumerate(dates, 1)])
+    database.execute(db.INSERT, (2, 8, '2024-01-03 12:00:00', 'Other', 100, '', '', '', '', '', 'SGD', '', ''))
+    filter = query.Filter([1])
+
+    def cursor(row) -> tuple:
+        return row[2], row[1]
+
+    first, more = query.page(database, filter, size=3)
+    assert [row[1] for row in first] == [7, 6, 5] and more
+    second, more = query.page(database, filter, cursor(first[-1]), size=3)
+    assert [row[1] for row in second] == [4, 3, 2] and more
+    third, more = query.page(database, filter, cursor(second[-1]), size=3)
+    assert [row[1] for row in third] == [1] and not more
+
+    back, more = query.page(database, filter, cursor(third[0]), forward=False, size=3)
+    assert [row[1] for row in back] == [4, 3, 2] and more
+    back, more = query.page(database, filter, cursor(back[0]), forward=False, size=3)
+    assert [row[1] for row in back] == [7, 6, 5] and not more
+
+def test_report_totals_trends_and_breakdowns(database):
+    pytest.importorskip('numpy')
+    database.executemany(db.INSERT, [
+        (1, 1, '2023-12-10 12:00:00', 'Lunch', 400, 'Hawker', '', 'Food', 'Debit', '', 'SGD', '', ''),
+        (1, 2, '2024-01-05 12:00:00', 'Lunch', 1000, 'Hawker', '', 'Food', 'Debit', '', 'SGD', '', ''),
+        (1, 3, '2024-01-20 12:00:00', 'Taxi', 500, 'Taxi', '', 'Transport', 'Credit', '', 'SGD', '', ''),
+        (1, 4, '2024-03-01 12:00:00', 'Dinner', 300, 'Bistro', '', 'Food', 'Debit', '', 'SGD', '', ''),
+        (1, 5, '2024-03-02 12:00:00', 'Dinner', 300, 'Bistro', '', 'Food', 'Debit', '', 'SGD', '', ''),
+        (1, 6, '2024-04-01 12:00:00', 'Later', 9999, 'Bistro', '', 'Food', 'Debit', '', 'SGD', '', ''),
+    ])
+    report = analytics.report(analytics.Cache(database).columns(1), datetime(2024, 3, 15), months=3, window=2)
+
+    assert report['months'] == ['2024-01', '2024-02', '2024-03']
+    assert report['totals'] == [1500, 0, 600]
+    assert report['deltas'] == [1100, -1500, 600]
+    assert report['count'] == 4 and report['total'] == 2100
+    assert len(report['daily']) == 75 and report['daily'][[4, 19, 60, 61]].tolist() == [1000, 500, 300, 300]
+    assert report['moving'][59:62].tolist() == [150, 300, 150]
+    assert report['purpose'] == [('Food', 1600), ('Transport', 500)]
+    assert report['shop'] == [('Hawker', 1000), ('Bistro', 600), ('Taxi', 500)]
+    assert report['payment'] == [('Debit', 1600), ('Credit', 500)]
+    assert report['percentiles'][0] == (50, 400)
+
+def test_find_matches_word_prefixes_of_the_owner_only(database):
+    database.executemany(db.INSERT, [
+        expense(1, '2024-01-01 12:00:00', 'Chicken rice'),
+        expense(2, '2024-01-02 12:00:00', 'Groceries'),
+        (1, 3, '2024-01-03 12:00:00', 'Dinner', 1000, 'Chick-fil-A', 'Airport', 'Food', 'Debit', '', 'SGD', '', ''),
+        (2, 4, '2024-01-04 12:00:00', 'Chicken rice', 1000, '', '', '', 'Debit', '', 'SGD', '', ''),
+        (11, 5, '2024-01-05 12:00:00', 'Chicken rice', 1000, '', '', '', 'Debit', '', 'SGD', '', ''),
+    ])
+    assert sorted(row[1] for row in query.find(database, 1, 'chi')) == [1, 3]
+    assert [row[1] for row in query.find(database, 1, 'chick rice')] == [1]
+    assert [row[1] for row in query.find(database, 1, 'airport')] == [3]
+    assert [row[1] for row in query.find(database, 1, 'hicken')] == []
+    assert [row[1] for row in query.find(database, 2, 'chicken')] == [4]
+
+    db.update(database, 1, 1, {'description': 'Noodles'})
+    database.execute('DELETE FROM expenses WHERE updateid = 3')
+    assert query.find(database, 1, 'chicken') == []
+    assert [row[1] for row in query.find(database, 1, 'noodle')] == [1]
+    assert db.rebuild_search(database) == 4
+
+def attached(database) -> list:
+    return [name for _, name, _ in database.connection().execute('PRAGMA database_list') if name.startswith('archive_')]
+
+def test_history_attaches_only_the_archives_a_query_needs(database, monkeypatch):
+    database.executemany(db.INSERT, [
+        expense(updateid, '{}-03-01 12:00:00'.format(year), 'Lunch') for updateid, year in enumerate((2001, 2002, 2003, 2100), 1)
+    ])
+    archiver.archive(database, datetime(2100, 1, 1), 0)
+    assert database.fetch('SELECT COUNT(*) FROM expenses') == [(1,)]
+
+    assert query.by_updateid(database, 2)[1] == 2
+    assert attached(database) == ['archive_2001', 'archive_2002', 'archive_2003']
+    assert database.fetch('SELECT COUNT(*) FROM history', archives=True, since='2003-01') == [(2,)]
+    assert attached(database) == ['archive_2003']
+    assert database.fetch('SELECT COUNT(*) FROM history', archives=True, since='2002') == [(3,)]
+    assert attached(database) == ['archive_2003', 'archive_2002']
+
+    # The directory is only listed again once it changed
+    listed = []
+    archives = db.archives
+    monkeypatch.setattr(db, 'archives', lambda path: listed.append(path) or archives(path))
+    directory = os.path.dirname(database.dbname)
+    os.utime(directory, ns=(10 ** 18, 10 ** 18))
+    for _ in range(3):
+        assert len(database.archives()) == 3
+    assert len(listed) == 1
+    os.utime(directory, ns=(10 ** 18 + 1, 10 ** 18 + 1))
+    assert len(database.archives()) == 3 and len(listed) == 2
@@ -0,0 +1,103 @@
+import io
+import threading
+import time
+
+import pytest
+
+from concurrent.futures import (
+    Future,
+)
+
+import ex_OCR as ocr
+
+from ex_REPLAY import (
+    Harness,
+)
+
+@pytest.fixture
+def reading(monkeypatch):
+    """
+    Stands in for tesseract, reading every receipt only once released.
+    """
+    release = threading.Event()
+    def extract(path, timeout=0):
+        release.wait(10)
+        return {'shop': 'Receipt Mart', 'datetime': '2024-05-06 07:08:00'}
+    monkeypatch.setattr(ocr, 'pytesseract', object())
+    monkeypatch.setattr(ocr, 'extract', extract)
+    return release
+
+@pytest.fixture
+def harness(tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), 'white').save(buffer, 'PNG')
+    harness = Harness(str(tmp_path))
+    harness.bot.files['receipt'] = buffer.getvalue()
+    yield harness
+    harness.close()
+
+def wait(condition, timeout=10) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def test_image_does_not_wait_for_the_receipt(harness, reading):
+    harness.send(harness.message(7, '/add'))
+    start = time.perf_counter()
+    harness.send(harness.message(7, photo='receipt'))
+    assert time.perf_counter() - start < 1
+
+    user_data = harness.dispatcher.user_data[7]
+    assert 'shop' not in user_data
+    reading.set()
+    assert wait(lambda: 'receipt' in user_data)
+
+    harness.send(harness.message(7, 'Lunch'))
+    assert user_data['shop'] == 'Receipt Mart'
+    assert user_data['datetime'] == '2024-05-06 07:08:00'
+
+def test_receipt_amends_recorded_expense(harness, reading):
+    for text in ['/simple\nCoffee\n4.20\n\nRaffles Place\nBreakfast', 'Debit']:
+        harness.send(harness.message(8, text))
+    harness.send(harness.message(8, photo='receipt'))
+    assert not harness.dispatcher.user_data[8]
+
+    reading.set()
+    shop = 'SELECT shop FROM expenses WHERE owner = ?'
+    assert wait(lambda: harness.database.shard(8).fetch(shop, (8,)) == [('Receipt Mart',)])
+
+class HungTesseract:
+    """
+    Stands in for pytesseract, hanging on the first image until killed by its timeout.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def image_to_string(self, image, timeout=0):
+        self.calls += 1
+        if self.calls == 1:
+            time.sleep(timeout or 60)
+            raise RuntimeError('Tesseract process timeout')
+        return 'Receipt Mart\nTotal 4.20'
+
+def test_hung_recognition_times_out_and_frees_the_worker(database, tmp_path, monkeypatch):
+    Image = pytest.importorskip('PIL.Image')
+    monkeypatch.setattr(ocr, 'pytesseract', HungTesseract())
+    monkeypatch.setattr(ocr, 'Image', Image, raising=False)
+    reader = ocr.Reader(database, workers=1, timeout=0.2)
+    futures = []
+    for digest in ('hung', 'next'):
+        path = str(tmp_path / '{}.png'.format(digest))
+        Image.new('RGB', (8, 8), 'white').save(path)
+        stored = Future()
+        stored.set_result((digest, path))
+        futures.append(reader.submit(stored))
+
+    assert futures[0].result(timeout=5) == {}
+    assert futures[1].result(timeout=5) == {'shop': 'Receipt Mart', 'amount': 420}
+    assert database.fetch('SELECT hash FROM ocr') == [('next',)]
+    reader.stop()
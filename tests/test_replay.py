@@ -0,0 +1,111 @@
+import threading
+import time
+import types
+
+from concurrent.futures import (
+    Future,
+)
+from datetime import (
+    datetime,
+)
+
+import pytest
+
+import ex_BOT as bot
+import ex_CHART as chart
+import ex_SQL as db
+
+from ex_REPLAY import (
+    Harness,
+)
+
+@pytest.fixture
+def harness(tmp_path):
+    harness = Harness(str(tmp_path))
+    yield harness
+    harness.close()
+
+def wait(condition, timeout=10) -> bool:
+    """
+    Waits until a condition holds or the timeout expires.
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def count(harness, chat) -> int:
+    return harness.database.shard(chat).fetch('SELECT COUNT(*) FROM expenses WHERE owner = ?', (chat,))[0][0]
+
+def test_import_document(harness):
+    harness.bot.files['expenses.csv'] = (
+        'date,description,amount,shop,location,purpose,payment\n'
+        '2024-01-02 10:00:00,Lunch,12.50,Hawker,Clementi,Work,Credit\n'
+        '2024-01-03 11:00:00,Coffee,4.20,Starbucks,Raffles,Breakfast,Debit\n'
+    ).encode()
+    harness.send(harness.message(7, '/import'))
+    harness.send(harness.message(7, document='expenses.csv'))
+
+    assert wait(lambda: count(harness, 7) == 2)
+    assert harness.bot.downloads['expenses.csv'] == 1
+
+def test_import_state_is_persisted(harness):
+    harness.bot.files['expenses.csv'] = b'date,description,amount\n2024-01-02 10:00:00,Lunch,12.50\n'
+    harness.send(harness.message(9, '/import'))
+    harness.send(harness.message(9, document='expenses.csv'))
+    harness.persistence.flush()
+    states = 'SELECT state FROM conversations WHERE name = ?'
+
+    def ended():
+        harness.persistence.flush()
+        return harness.database.main.fetch(states, ('import',)) == []
+    assert wait(ended)
+    assert count(harness, 9) == 1
+
+def test_charts_are_sent_by_the_job_queue(harness, tmp_path, monkeypatch):
+    pytest.importorskip('numpy')
+    path = tmp_path / 'chart.png'
+    path.write_bytes(b'chart')
+    future = Future()
+    sent = []
+    monkeypatch.setattr(chart, 'matplotlib', object())
+    monkeypatch.setattr(harness.charts, 'chart', lambda *args: future)
+    monkeypatch.setattr(harness.bot, 'send_photo', lambda chat_id, photo, **kwargs: sent.append(threading.current_thread()))
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    harness.database.shard(11).execute(db.INSERT, (11, 1, now, 'Lunch', 1250, '', '', '', '', '', 'SGD', '', ''))
+    harness.database.shard(11).changed([11])
+    harness.send(harness.message(11, '/report 6 bar'))
+
+    renderer = threading.Thread(target=future.set_result, args=(str(path),), name='renderer')
+    renderer.start()
+    renderer.join()
+    assert wait(lambda: sent)
+    assert sent[0] is not renderer
+
+def test_amounts_in_currencies_without_rates_are_rejected(harness, tmp_path):
+    for text in ['/add', '/date', 'Lunch', '12.50 USD']:
+        harness.send(harness.message(13, text))
+    assert 'amount' not in harness.dispatcher.user_data[13]
+
+    path = tmp_path / 'rates.csv'
+    path.write_text('date,currency,rate\n2020-01-01,USD,1.35\n')
+    harness.database.rates.load(str(path))
+    harness.send(harness.message(13, '12.50 USD'))
+    assert harness.dispatcher.user_data[13]['amount'] == 1250
+    assert harness.dispatcher.user_data[13]['currency'] == 'USD'
+
+def test_split_shares_follow_the_amount(harness):
+    for sender in (21, 22):
+        harness.send(harness.message(-5, '/join', sender=sender))
+    shard = harness.database.shard(-5)
+    shard.execute(db.INSERT, (-5, 1, '2024-01-02 12:00:00', 'Dinner', 1000, '', '', '', '', '', 'SGD', '', ''))
+    shard.changed([-5])
+    harness.send(harness.message(-5, '/split 1', sender=22))
+    assert shard.fetch('SELECT payer, shares FROM expenses') == [(22, '{"21":500,"22":500}')]
+
+    row, _ = bot.amend(types.SimpleNamespace(bot_data=harness.dispatcher.bot_data), -5, 1, {'amount': 1001})
+    assert bot.field_value(row, 'amount') == 1001
+    assert shard.fetch('SELECT shares FROM expenses') == [('{"21":501,"22":500}',)]
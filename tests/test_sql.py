@@ -0,0 +1,178 @@
+import json
+import sqlite3
+import threading
+
+import pytest
+
+from datetime import (
+    datetime,
+)
+
+import ex_BENCH as bench
+import ex_QUERY as query
+import ex_SQL as db
+
+def load_rates(database, tmp_path, rate) -> None:
+    path = tmp_path / 'rates.csv'
+    path.write_text('date,currency,rate\n2026-01-01,USD,{}\n'.format(rate))
+    database.rates.load(str(path))
+
+def expense(updateid, amount, currency='USD', payer='', shares='') -> tuple:
+    dt = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return (1, updateid, dt, 'Item', amount, '', '', '', 'Cash', False, currency, payer, shares)
+
+def totals(database) -> list:
+    return database.fetch('SELECT total FROM summaries WHERE count != 0') + database.fetch('SELECT balance FROM balances WHERE balance != 0')
+
+def test_connections_are_kept_per_thread(database):
+    conn = database.connection()
+    assert database.connection() is conn
+    assert database.fetch('PRAGMA journal_mode') == [('wal',)]
+    assert database.fetch('PRAGMA busy_timeout') == [(5000,)]
+
+    others = []
+    thread = threading.Thread(target=lambda: others.append(database.connection()))
+    thread.start()
+    thread.join()
+    assert others[0] is not conn
+    assert len(database.connections) == 2
+
+    database.close()
+    assert database.connections == []
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute('SELECT 1')
+    assert database.connection() is not conn
+    assert database.fetch('SELECT 1') == [(1,)]
+
+def test_summaries_follow_writes_and_are_repaired(database):
+    rows = [
+        (1, 1, '2024-03-04 12:00:00', 'Lunch', 1200, '', '', '', 'Credit', True, 'SGD', '', ''),
+        (1, 2, '2024-03-05 12:00:00', 'Dinner', 3000, '', '', '', 'Credit', True, 'SGD', '', ''),
+        (1, 3, '2024-03-05 13:00:00', 'Coffee', 450, '', '', '', 'Debit', False, 'SGD', '', ''),
+        (1, 4, '2024-02-05 13:00:00', 'Book', 2000, '', '', '', 'Debit', False, 'SGD', '', ''),
+    ]
+    database.executemany(db.INSERT, rows)
+    now = datetime(2024, 3, 5, 18)
+    assert db.summary(database, 1, 'month', now) == [('Credit', 1, 4200, 2), ('Debit', 0, 450, 1)]
+    assert db.summary(database, 1, 'day', now) == [('Credit', 1, 3000, 1), ('Debit', 0, 450, 1)]
+
+    db.update(database, 1, 2, {'payment': 'Debit', 'amount': 2500})
+    database.execute('DELETE FROM expenses WHERE updateid = 3')
+    db.update(database, 1, 4, {'datetime': '2024-03-01 09:00:00'})
+    assert db.summary(database, 1, 'month', now) == [('Credit', 1, 1200, 1), ('Debit', 0, 2000, 1), ('Debit', 1, 2500, 1)]
+    assert db.summary(database, 1, 'month', datetime(2024, 2, 1)) == []
+    assert db.rebuild_summaries(database, repair=False) == 0
+
+    database.execute('UPDATE summaries SET total = total + 1 WHERE grain = ? AND count != 0', ('year',))
+    assert db.rebuild_summaries(database) == 6
+    assert db.rebuild_summaries(database, repair=False) == 0
+    assert db.summary(database, 1, 'year', now) == [('Credit', 1, 1200, 1), ('Debit', 0, 2000, 1), ('Debit', 1, 2500, 1)]
+
+def test_home_amounts_are_kept_when_rates_are_reloaded(database, tmp_path):
+    load_rates(database, tmp_path, '1.35')
+    database.execute(db.INSERT, expense(1, 1000))
+    database.execute(db.INSERT, expense(2, 999, payer=7, shares=json.dumps({'7': 333, '8': 666})))
+    assert database.fetch('SELECT home, rate FROM expenses ORDER BY updateid') == [(1350, 1.35), (1349, 1.35)]
+
+    load_rates(database, tmp_path, '2')
+    db.update(database, 1, 1, {'amount': 500})
+    assert database.fetch('SELECT home FROM expenses WHERE updateid = 1') == [(1000,)]
+    assert db.rebuild_summaries(database, repair=False) == 0
+    assert db.balances(database, 1) == [(7, 899), (8, -899)]
+
+    database.execute('DELETE FROM expenses')
+    assert totals(database) == []
+
+def test_update_converts_with_the_changed_currency_and_date(database, tmp_path):
+    path = tmp_path / 'rates.csv'
+    path.write_text('date,currency,rate\n2020-01-01,USD,1.25\n2026-01-01,USD,1.5\n')
+    database.rates.load(str(path))
+    database.execute(db.INSERT, expense(1, 1000, currency='SGD'))
+
+    db.update(database, 1, 1, {'currency': 'USD', 'datetime': '2024-06-01 12:00:00'})
+    assert database.fetch('SELECT home, rate FROM expenses') == [(1250, 1.25)]
+    db.update(database, 1, 1, {'datetime': '2026-06-01 12:00:00'})
+    assert database.fetch('SELECT home, rate FROM expenses') == [(1500, 1.5)]
+
+def test_raw_clients_can_write_expenses(database, tmp_path):
+    load_rates(database, tmp_path, '1.35')
+    database.execute(db.INSERT, expense(1, 1000))
+    conn = sqlite3.connect(database.dbname)
+    with conn:
+        conn.execute('INSERT INTO expenses ({}) VALUES ({})'.format(', '.join(db.COLUMNS), ','.join('?' * len(db.COLUMNS))), expense(2, 400, ''))
+        conn.execute('UPDATE expenses SET amount = amount + 1, shares = ?, payer = 7', (json.dumps({'8': 100}),))
+    assert db.rebuild_summaries(database, repair=False) == 0
+    assert db.rebuild_balances(database, repair=False) == 0
+    with conn:
+        conn.execute('DELETE FROM expenses')
+    conn.close()
+    assert totals(database) == []
+
+def test_amount_filters_compare_home_amounts(database, tmp_path):
+    load_rates(database, tmp_path, '1.35')
+    database.execute(db.INSERT, expense(1, 1000))
+    database.execute(db.INSERT, expense(2, 1100, currency=''))
+
+    for period in ('all', 'year'):
+        for above, expected in ((True, [1]), (False, [2])):
+            filter = query.Filter([1], period=period, above=above, amount=1200)
+            assert [row[1] for row in query.search(database, filter)] == expected
+
+def test_router_keeps_the_rows_of_every_shard_apart(tmp_path):
+    router = db.Router(str(tmp_path / 'sharded.db'), 3)
+    db.setup(router)
+    rows = bench.synthetic_rows(300, owners=30)
+    for shard, group in router.partition(range(1, 31)):
+        shard.executemany(db.INSERT, [row for row in rows if row[0] in group])
+
+    counts = router.fan_out('SELECT COUNT(*) FROM expenses')
+    assert len(counts) == 3 and all(count for (count,), in counts)
+    assert sum(count for (count,), in counts) == len(rows)
+    assert router.fetch('SELECT COUNT(*) FROM expenses') == router.main.fetch('SELECT COUNT(*) FROM expenses')
+    assert all(query.by_updateid(router, row[1]) == row for row in rows[::37])
+
+    filter = query.Filter(range(1, 31), order='amount')
+    assert [row[4] for row in query.search(router, filter)] == sorted((row[4] for row in rows), reverse=True)
+    router.close()
+
+def test_amount_order_follows_home_amounts_across_shards(tmp_path):
+    router = db.Router(str(tmp_path / 'sharded.db'), 3)
+    db.setup(router)
+    load_rates(router, tmp_path, '1.35')
+    owners = [1] + [owner for owner in range(2, 100) if router.index(owner) != router.index(1)][:1]
+    rows = [
+        (owners[0], 1, '2026-01-02 00:00:00', 'Item', 1000, '', '', '', 'Cash', False, 'USD', '', ''),
+        (owners[0], 2, '2026-01-02 00:00:00', 'Item', 1200, '', '', '', 'Cash', False, 'SGD', '', ''),
+        (owners[1], 3, '2026-01-02 00:00:00', 'Item', 1300, '', '', '', 'Cash', False, 'SGD', '', ''),
+        (owners[1], 4, '2026-01-02 00:00:00', 'Item', 900, '', '', '', 'Cash', False, 'USD', '', ''),
+    ]
+    for row in rows:
+        router.shard(row[0]).execute(db.INSERT, row)
+
+    for period in ('all', 'year'):
+        filter = query.Filter(owners, period=period, order='amount')
+        found = query.search(router, filter)
+        assert [row[1] for row in found] == [1, 3, 4, 2]
+        assert found[0] == rows[0]
+    router.close()
+
+def test_writer_replays_journal_torn_by_a_crash(database, tmp_path):
+    journal = tmp_path / 'expenses.journal'
+    rows = [expense(updateid, 100 * updateid, currency='SGD') for updateid in (1, 2, 3)]
+    journal.write_text(''.join(json.dumps(row) + '\n' for row in rows[:2]) + json.dumps(rows[2])[:-7])
+
+    writer = db.Writer(database, str(journal))
+    writer.start()
+    writer.stop()
+    assert database.fetch('SELECT updateid FROM expenses ORDER BY updateid') == [(1,), (2,)]
+    assert journal.read_text() == ''
+
+def test_writer_refuses_journal_corrupt_before_its_last_line(database, tmp_path):
+    journal = tmp_path / 'expenses.journal'
+    rows = [expense(updateid, 100, currency='SGD') for updateid in (1, 2)]
+    journal.write_text(json.dumps(rows[0])[:-7] + '\n' + json.dumps(rows[1]) + '\n')
+
+    with pytest.raises(ValueError):
+        db.Writer(database, str(journal)).start()
+    assert database.fetch('SELECT COUNT(*) FROM expenses') == [(0,)]
+    assert journal.read_text().count('\n') == 2
@@ -0,0 +1,59 @@
+import pytest
+
+from telegram.ext import (
+    ConversationHandler,
+)
+from telegram.ext.utils.promise import (
+    Promise,
+)
+
+import ex_STATE as state
+
+@pytest.fixture
+def persistence(database):
+    persistence = state.Persistence(database)
+    persistence.get_user_data()
+    persistence.get_conversations('import')
+    return persistence
+
+def stored(database) -> dict:
+    return dict(database.fetch('SELECT key, state FROM conversations WHERE name = ?', ('import',)))
+
+def test_pending_states_store_the_previous_state(database, persistence):
+    promise = Promise(lambda: ConversationHandler.END, (), {})
+    persistence.update_conversation('import', (1, 1), (4, promise))
+    persistence.flush()
+    assert stored(database) == {'[1, 1]': 4}
+    assert persistence.dirty_conversations
+
+    promise.run()
+    persistence.flush()
+    assert stored(database) == {}
+    assert not persistence.dirty_conversations
+
+def test_failed_handlers_keep_the_previous_state(database, persistence):
+    def fail():
+        raise ValueError('failed')
+    promise = Promise(fail, (), {})
+    promise.run()
+    persistence.update_conversation('import', (1, 1), (4, promise))
+    persistence.flush()
+    assert stored(database) == {'[1, 1]': 4}
+
+def test_failed_flush_keeps_every_dirty_entry(database, persistence):
+    persistence.update_user_data(1, {'owner': 1})
+    persistence.update_user_data(2, {'owner': 2})
+    persistence.update_conversation('import', (1, 1), object())
+    with pytest.raises(Exception):
+        persistence.flush()
+    assert set(persistence.dirty_user_data) == {1, 2}
+
+    persistence.update_conversation('import', (1, 1), 4)
+    persistence.flush()
+    assert dict(database.fetch('SELECT user_id, data FROM user_data')) == {1: '{"owner":1}', 2: '{"owner":2}'}
+    assert not persistence.dirty_user_data and not persistence.dirty_conversations
+
+def test_updates_do_not_copy_user_data(persistence):
+    data = {'owner': 1}
+    assert persistence.replace_bot(data) is data
+    assert persistence.insert_bot(data) is data
@@ -0,0 +1,52 @@
+import http.client
+import json
+
+import pytest
+
+import ex_WEBHOOK as webhook
+
+from ex_BENCH import (
+    NullDispatcher,
+)
+
+UPDATE = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'Hi'}}
+
+@pytest.fixture
+def server():
+    server = webhook.Server(NullDispatcher(), '127.0.0.1', 0, '/telegram', secret='s3cret')
+    server.start()
+    yield server
+    server.stop()
+
+def post(server, body, secret='s3cret') -> int:
+    conn = http.client.HTTPConnection('127.0.0.1', server.port)
+    headers = {'Content-Type': 'application/json'}
+    if secret is not None:
+        headers[webhook.SECRET_HEADER] = secret
+    conn.request('POST', '/telegram', body, headers)
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+@pytest.mark.parametrize('secret', [None, '', 'wrong'])
+def test_requests_without_the_secret_are_forbidden(server, secret):
+    assert post(server, json.dumps(UPDATE), secret) == 403
+    assert server.metrics['forbidden'] == 1
+    assert server.metrics['received'] == 0
+
+@pytest.mark.parametrize('body', ['[]', '"update"', '1', 'null', '{}', '{"update_id": "1"}', '{"update_id": 1, "message": 5}', 'not json'])
+def test_payloads_which_are_not_updates_are_rejected(server, body):
+    assert post(server, body) == 400
+    assert server.metrics['invalid'] == 1
+
+def test_updates_are_received(server):
+    assert post(server, json.dumps(UPDATE)) == 200
+    assert server.metrics['received'] == 1
+
+def test_no_secret_accepts_every_request():
+    server = webhook.Server(NullDispatcher(), '127.0.0.1', 0, '/telegram')
+    server.start()
+    try:
+        assert post(server, json.dumps(UPDATE), None) == 200
+    finally:
+        server.stop()